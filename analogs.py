@@ -0,0 +1,489 @@
+"""Analog methods: AnEn baseline and embedding-space retrieval.
+
+For each station and lead time, the AnEn finds the k historical days whose
+normalized WRF predictors (see `utils.normalize_images`) are closest to the
+current forecast at that station and lead time, and uses the observed rainfall
+("rr_obs") on those days as the ensemble.
+
+Embedding retrieval instead compares whole forecast days in the space learned
+by the CNN (output of its Dense(100) layer), to find past days most like today.
+"""
+import numpy
+from scipy.spatial import cKDTree
+
+KDTREE_METHOD_NAME = 'kdtree'
+BRUTE_FORCE_METHOD_NAME = 'brute_force'
+VALID_SEARCH_METHOD_NAMES = [KDTREE_METHOD_NAME, BRUTE_FORCE_METHOD_NAME]
+
+NUM_ANALOGS = 20
+NUM_QUERIES_PER_BLOCK = 1000
+
+MEMBER_MATRIX_KEY = 'member_matrix'
+ANALOG_INDEX_MATRIX_KEY = 'analog_index_matrix'
+DISTANCE_MATRIX_KEY = 'distance_matrix'
+
+EUCLIDEAN_METRIC_NAME = 'euclidean'
+COSINE_METRIC_NAME = 'cosine'
+VALID_METRIC_NAMES = [EUCLIDEAN_METRIC_NAME, COSINE_METRIC_NAME]
+NUM_RETRIEVED_DAYS = 10
+
+EMBEDDING_MATRIX_KEY = 'embedding_matrix'
+OBSERVATION_MATRIX_KEY = 'observation_matrix'
+TIMES_KEY = 'times_unix_sec'
+LAYER_NAME_KEY = 'layer_name'
+
+
+def _get_feature_matrix(predictor_matrix, predictor_weights,
+                        lead_window_half_width):
+    """Converts predictors to weighted feature vectors per station and lead.
+    E = number of examples (days)
+    L = number of lead times
+    S = number of stations
+    C = number of predictors
+    F = number of features
+    :param predictor_matrix: E-by-L-by-S-by-C numpy array of normalized
+        predictors.
+    :param predictor_weights: length-C numpy array of weights.
+    :param lead_window_half_width: Number of neighbouring lead times on each
+        side whose predictors are appended (clipped at the first and last lead
+        time).  With 0, only the lead time itself is used.
+    :return: feature_matrix: L-by-S-by-E-by-F numpy array (float32), where
+        F = C * (2 * lead_window_half_width + 1).
+    """
+
+    num_lead_times = predictor_matrix.shape[1]
+    weighted_matrix = predictor_matrix * predictor_weights
+
+    feature_matrices = []
+    for this_offset in range(-lead_window_half_width,
+                             lead_window_half_width + 1):
+        these_lead_indices = numpy.clip(
+            numpy.arange(num_lead_times) + this_offset, 0, num_lead_times - 1)
+        feature_matrices.append(weighted_matrix[:, these_lead_indices, ...])
+
+    feature_matrix = numpy.concatenate(feature_matrices, axis=-1)
+    return numpy.ascontiguousarray(
+        numpy.transpose(feature_matrix, (1, 2, 0, 3)), dtype=numpy.float32)
+
+
+class AnalogEnsemble(object):
+    """Analog-ensemble search index over historical forecasts.
+    H = number of historical days
+    L = number of lead times
+    S = number of stations
+    C = number of predictors
+    One index is kept per station and lead time.
+    """
+
+    def __init__(self, predictor_matrix, observation_matrix,
+                 predictor_weights=None, lead_window_half_width=0,
+                 search_method=KDTREE_METHOD_NAME):
+        """Builds the search index.
+        :param predictor_matrix: H-by-L-by-S-by-C numpy array of normalized
+            predictors (output of `utils.normalize_images`).
+        :param observation_matrix: numpy array of observed rainfall, either
+            H-by-L-by-S or H-by-(L*S) (the `utils.read_image_file` target
+            layout).
+        :param predictor_weights: length-C numpy array of predictor weights.
+            If None, all predictors are weighted equally.
+        :param lead_window_half_width: See doc for `_get_feature_matrix`.
+        :param search_method: Either "kdtree" (one `scipy.spatial.cKDTree` per
+            station and lead time) or "brute_force" (blocked vectorized
+            distances).
+        :raises: ValueError: if `search_method` is not recognized.
+        """
+
+        if search_method not in VALID_SEARCH_METHOD_NAMES:
+            error_string = (
+                'Search method ("{0:s}") is not in the following list:\n{1:s}'
+            ).format(search_method, str(VALID_SEARCH_METHOD_NAMES))
+            raise ValueError(error_string)
+
+        num_predictors = predictor_matrix.shape[-1]
+        if predictor_weights is None:
+            predictor_weights = numpy.ones(num_predictors)
+
+        self.predictor_weights = numpy.array(predictor_weights, dtype=float)
+        self.lead_window_half_width = lead_window_half_width
+        self.search_method = search_method
+
+        self.observation_matrix = numpy.reshape(
+            numpy.asarray(observation_matrix, dtype=numpy.float32),
+            predictor_matrix.shape[:3])
+        self.feature_matrix = _get_feature_matrix(
+            predictor_matrix, self.predictor_weights, lead_window_half_width)
+
+        num_lead_times, num_stations = self.feature_matrix.shape[:2]
+        self.kd_trees = None
+
+        if search_method == KDTREE_METHOD_NAME:
+            self.kd_trees = [
+                [cKDTree(self.feature_matrix[l, s, ...])
+                 for s in range(num_stations)]
+                for l in range(num_lead_times)
+            ]
+        else:
+            self.squared_norm_matrix = numpy.sum(
+                self.feature_matrix.astype(float) ** 2, axis=-1)
+
+    def _search_brute_force(self, lead_index, station_index, query_matrix,
+                            num_analogs):
+        """Finds nearest historical days by blocked vectorized distances.
+        E = number of query days
+        :param lead_index: Lead-time index.
+        :param station_index: Station index.
+        :param query_matrix: E-by-F numpy array of query features.
+        :param num_analogs: Number of analogs (k).
+        :return: distance_matrix: E-by-k numpy array of distances (sorted).
+        :return: index_matrix: E-by-k numpy array of historical-day indices.
+        """
+
+        historical_matrix = self.feature_matrix[
+            lead_index, station_index, ...].astype(float)
+        historical_norms = self.squared_norm_matrix[lead_index, station_index]
+
+        num_queries = query_matrix.shape[0]
+        distance_matrix = numpy.empty((num_queries, num_analogs))
+        index_matrix = numpy.empty((num_queries, num_analogs), dtype=int)
+
+        for i in range(0, num_queries, NUM_QUERIES_PER_BLOCK):
+            this_query_matrix = query_matrix[
+                i:(i + NUM_QUERIES_PER_BLOCK), :].astype(float)
+
+            # |q - h|^2 = |q|^2 + |h|^2 - 2 q.h, for the whole block at once.
+            this_squared_distance_matrix = (
+                numpy.sum(this_query_matrix ** 2, axis=1)[:, numpy.newaxis] +
+                historical_norms[numpy.newaxis, :] -
+                2 * numpy.dot(this_query_matrix, historical_matrix.T)
+            )
+            numpy.maximum(this_squared_distance_matrix, 0.,
+                          out=this_squared_distance_matrix)
+
+            these_indices = numpy.argpartition(
+                this_squared_distance_matrix, num_analogs - 1, axis=1
+            )[:, :num_analogs]
+            these_distances = numpy.take_along_axis(
+                this_squared_distance_matrix, these_indices, axis=1)
+            these_orders = numpy.argsort(these_distances, axis=1)
+
+            distance_matrix[i:(i + NUM_QUERIES_PER_BLOCK), :] = numpy.sqrt(
+                numpy.take_along_axis(these_distances, these_orders, axis=1))
+            index_matrix[i:(i + NUM_QUERIES_PER_BLOCK), :] = (
+                numpy.take_along_axis(these_indices, these_orders, axis=1))
+
+        return distance_matrix, index_matrix
+
+    def predict(self, predictor_matrix, num_analogs=NUM_ANALOGS,
+                exclude_indices=None):
+        """Finds analogs and returns their observations as an ensemble.
+        E = number of forecast days
+        k = number of analogs
+        :param predictor_matrix: E-by-L-by-S-by-C numpy array of normalized
+            predictors.
+        :param num_analogs: Number of analogs (k).
+        :param exclude_indices: length-E numpy array of historical-day indices
+            to exclude for each forecast day (e.g., the day itself, when the
+            forecast days are part of the historical set).  If None, nothing is
+            excluded.
+        :return: anen_dict: Dictionary with the following keys.
+        anen_dict['member_matrix']: E-by-k-by-L-by-S numpy array of observed
+            rainfall on the analog days.
+        anen_dict['analog_index_matrix']: E-by-k-by-L-by-S numpy array of
+            historical-day indices.
+        anen_dict['distance_matrix']: E-by-k-by-L-by-S numpy array of
+            distances.
+        :raises: ValueError: if `num_analogs` (plus 1, if `exclude_indices` is
+            given) is not in 1...H, where H = number of historical days.
+        """
+
+        num_neighbours = num_analogs + int(exclude_indices is not None)
+        num_historical_days = self.observation_matrix.shape[0]
+
+        if num_analogs < 1 or num_neighbours > num_historical_days:
+            error_string = (
+                'Need 1 <= num_analogs{0:s} <= number of historical days '
+                '({1:d}); got num_analogs = {2:d}.'
+            ).format(
+                ' + 1' if exclude_indices is not None else '',
+                num_historical_days, num_analogs
+            )
+            raise ValueError(error_string)
+
+        query_matrix = _get_feature_matrix(
+            predictor_matrix, self.predictor_weights,
+            self.lead_window_half_width)
+        num_lead_times, num_stations, num_queries = query_matrix.shape[:3]
+
+        index_matrix = numpy.empty(
+            (num_queries, num_analogs, num_lead_times, num_stations), dtype=int)
+        distance_matrix = numpy.empty(
+            (num_queries, num_analogs, num_lead_times, num_stations))
+
+        for l in range(num_lead_times):
+            for s in range(num_stations):
+                if self.search_method == KDTREE_METHOD_NAME:
+                    these_distances, these_indices = self.kd_trees[l][s].query(
+                        query_matrix[l, s, ...], k=num_neighbours)
+                    these_distances = numpy.reshape(
+                        these_distances, (num_queries, num_neighbours))
+                    these_indices = numpy.reshape(
+                        these_indices, (num_queries, num_neighbours))
+                else:
+                    these_distances, these_indices = self._search_brute_force(
+                        l, s, query_matrix[l, s, ...], num_neighbours)
+
+                if exclude_indices is not None:
+                    # Drop the excluded day if found, else the farthest analog.
+                    these_keep_flags = (
+                        these_indices != exclude_indices[:, numpy.newaxis])
+                    these_keep_flags[
+                        numpy.all(these_keep_flags, axis=1), -1] = False
+                    these_indices = numpy.reshape(
+                        these_indices[these_keep_flags],
+                        (num_queries, num_analogs))
+                    these_distances = numpy.reshape(
+                        these_distances[these_keep_flags],
+                        (num_queries, num_analogs))
+
+                index_matrix[..., l, s] = these_indices
+                distance_matrix[..., l, s] = these_distances
+
+        lead_index_matrix = numpy.arange(num_lead_times)[
+            numpy.newaxis, numpy.newaxis, :, numpy.newaxis]
+        station_index_matrix = numpy.arange(num_stations)[
+            numpy.newaxis, numpy.newaxis, numpy.newaxis, :]
+
+        return {
+            MEMBER_MATRIX_KEY: self.observation_matrix[
+                index_matrix, lead_index_matrix, station_index_matrix],
+            ANALOG_INDEX_MATRIX_KEY: index_matrix,
+            DISTANCE_MATRIX_KEY: distance_matrix
+        }
+
+
+def _get_embedding_layer_name(cnn_model_object):
+    """Returns name of the embedding layer (last Dense layer before output).
+    :param cnn_model_object: Trained instance of `keras.models.Model`.
+    :return: layer_name: Name of layer.
+    :raises: ValueError: if the model has fewer than two Dense layers.
+    """
+
+    dense_layer_names = [
+        l.name for l in cnn_model_object.layers
+        if type(l).__name__ == 'Dense'
+    ]
+
+    if len(dense_layer_names) < 2:
+        raise ValueError('Model needs at least two Dense layers to have an '
+                         'embedding layer.')
+
+    return dense_layer_names[-2]
+
+
+class EmbeddingIndex(object):
+    """Exact nearest-neighbour index over CNN embeddings of forecast days.
+    H = number of historical days
+    F = number of embedding features
+    Embeddings are stored as float16 (for compact files) and searched as
+    float32 with one matrix product per query block, which takes milliseconds
+    for a multi-year archive.
+    """
+
+    def __init__(self, embedding_matrix, observation_matrix,
+                 times_unix_sec=None, layer_name=None):
+        """Creates index.
+        :param embedding_matrix: H-by-F numpy array of embeddings.
+        :param observation_matrix: numpy array of observed rainfall with first
+            axis of length H (any trailing shape, e.g. L x S).
+        :param times_unix_sec: length-H numpy array of valid times.  If None,
+            days are numbered 0...(H - 1).
+        :param layer_name: Name of layer that produced the embeddings.
+        """
+
+        self.embedding_matrix = numpy.asarray(
+            embedding_matrix, dtype=numpy.float16)
+        self.observation_matrix = numpy.asarray(
+            observation_matrix, dtype=numpy.float32)
+        self.times_unix_sec = (
+            numpy.arange(self.embedding_matrix.shape[0]) if times_unix_sec is None
+            else numpy.asarray(times_unix_sec)
+        )
+        self.layer_name = layer_name
+
+        self._search_matrix = self.embedding_matrix.astype(numpy.float32)
+        self._squared_norms = numpy.sum(self._search_matrix ** 2, axis=1)
+
+    def query(self, embedding_matrix, num_neighbours=NUM_RETRIEVED_DAYS,
+              metric_name=EUCLIDEAN_METRIC_NAME):
+        """Finds the most similar historical days.
+        E = number of query days
+        k = number of neighbours
+        :param embedding_matrix: E-by-F numpy array of query embeddings.
+        :param num_neighbours: Number of neighbours (k).
+        :param metric_name: Either "euclidean" or "cosine".
+        :return: retrieval_dict: Dictionary with the following keys.
+        retrieval_dict['analog_index_matrix']: E-by-k numpy array of
+            historical-day indices, most similar first.
+        retrieval_dict['distance_matrix']: E-by-k numpy array of distances
+            (1 - cosine similarity for "cosine").
+        retrieval_dict['observation_matrix']: Observations on the retrieved
+            days (E x k x trailing shape).
+        retrieval_dict['times_unix_sec']: E-by-k numpy array of valid times.
+        :raises: ValueError: if `metric_name` is not recognized.
+        """
+
+        if metric_name not in VALID_METRIC_NAMES:
+            error_string = (
+                'Metric ("{0:s}") is not in the following list:\n{1:s}'
+            ).format(metric_name, str(VALID_METRIC_NAMES))
+            raise ValueError(error_string)
+
+        query_matrix = numpy.atleast_2d(
+            numpy.asarray(embedding_matrix, dtype=numpy.float32))
+        num_neighbours = min([num_neighbours, self._search_matrix.shape[0]])
+        product_matrix = numpy.dot(query_matrix, self._search_matrix.T)
+
+        if metric_name == COSINE_METRIC_NAME:
+            these_norms = numpy.sqrt(numpy.outer(
+                numpy.sum(query_matrix ** 2, axis=1), self._squared_norms))
+            distance_matrix = 1. - product_matrix / numpy.maximum(
+                these_norms, numpy.finfo(numpy.float32).tiny)
+        else:
+            distance_matrix = numpy.sqrt(numpy.maximum(
+                numpy.sum(query_matrix ** 2, axis=1)[:, numpy.newaxis] +
+                self._squared_norms[numpy.newaxis, :] - 2 * product_matrix,
+                0.
+            ))
+
+        index_matrix = numpy.argpartition(
+            distance_matrix, num_neighbours - 1, axis=1)[:, :num_neighbours]
+        distance_matrix = numpy.take_along_axis(
+            distance_matrix, index_matrix, axis=1)
+        these_orders = numpy.argsort(distance_matrix, axis=1)
+        index_matrix = numpy.take_along_axis(index_matrix, these_orders, axis=1)
+
+        return {
+            ANALOG_INDEX_MATRIX_KEY: index_matrix,
+            DISTANCE_MATRIX_KEY: numpy.take_along_axis(
+                distance_matrix, these_orders, axis=1),
+            OBSERVATION_MATRIX_KEY: self.observation_matrix[index_matrix, ...],
+            TIMES_KEY: self.times_unix_sec[index_matrix]
+        }
+
+    def query_predictors(self, cnn_model_object, predictor_matrix,
+                         num_neighbours=NUM_RETRIEVED_DAYS,
+                         metric_name=EUCLIDEAN_METRIC_NAME):
+        """Embeds new forecast days with the CNN, then queries the index.
+        :param cnn_model_object: Trained instance of `keras.models.Model` (the
+            one used to build the index).
+        :param predictor_matrix: E-by-M-by-N-by-C numpy array of normalized
+            predictors.
+        :param num_neighbours: See doc for `query`.
+        :param metric_name: Same.
+        :return: retrieval_dict: Same.
+        """
+
+        import utils
+
+        layer_name = self.layer_name
+        if layer_name is None:
+            layer_name = _get_embedding_layer_name(cnn_model_object)
+
+        embedding_matrix = utils.apply_cnn(
+            cnn_model_object, predictor_matrix, verbose=False,
+            output_layer_name=layer_name)
+
+        return self.query(
+            embedding_matrix, num_neighbours=num_neighbours,
+            metric_name=metric_name)
+
+    def write(self, output_file_name):
+        """Writes index to compact .npz file.
+        :param output_file_name: Path to output file.
+        """
+
+        numpy.savez(
+            output_file_name,
+            embedding_matrix=self.embedding_matrix,
+            observation_matrix=self.observation_matrix.astype(numpy.float16),
+            times_unix_sec=self.times_unix_sec,
+            layer_name=numpy.array(
+                '' if self.layer_name is None else self.layer_name)
+        )
+
+
+def read_embedding_index(input_file_name):
+    """Reads index from file.
+    :param input_file_name: Path to input file (written by
+        `EmbeddingIndex.write`).
+    :return: embedding_index: Instance of `EmbeddingIndex`.
+    """
+
+    with numpy.load(input_file_name) as this_file:
+        layer_name = str(this_file[LAYER_NAME_KEY])
+
+        return EmbeddingIndex(
+            embedding_matrix=this_file[EMBEDDING_MATRIX_KEY],
+            observation_matrix=this_file[OBSERVATION_MATRIX_KEY],
+            times_unix_sec=this_file[TIMES_KEY],
+            layer_name=layer_name if layer_name else None)
+
+
+def build_embedding_index(cnn_model_object, netcdf_file_names,
+                          normalization_dict, day_zero_time_string,
+                          layer_name=None, output_file_name=None):
+    """Embeds the whole archive once and builds the index.
+    :param cnn_model_object: Trained instance of `keras.models.Model`.
+    :param netcdf_file_names: 1-D list of paths to archive files (readable by
+        `utils.read_image_file`).
+    :param normalization_dict: See doc for `utils.normalize_images`.
+    :param day_zero_time_string: Date of day 0 for the "Days" variable (format
+        "%Y-%m-%d"), which has no reference date in the archive.  See doc for
+        `utils.read_file_times`.
+    :param layer_name: Name of embedding layer.  If None, will use the last
+        Dense layer before the output (the Dense(100) layer in the notebook
+        CNN).
+    :param output_file_name: Path to output file.  If None, the index will not
+        be written.
+    :return: embedding_index: Instance of `EmbeddingIndex`.
+    """
+
+    import utils
+
+    if layer_name is None:
+        layer_name = _get_embedding_layer_name(cnn_model_object)
+
+    embedding_matrices = []
+    observation_matrices = []
+    times_unix_sec = []
+
+    for this_file_name in netcdf_file_names:
+        print('Embedding days in "{0:s}"...'.format(this_file_name))
+
+        this_image_dict = utils.read_image_file(this_file_name)
+        this_predictor_matrix, _ = utils.normalize_images(
+            predictor_matrix=this_image_dict[utils.PREDICTOR_MATRIX_KEY],
+            predictor_names=this_image_dict[utils.PREDICTOR_NAMES_KEY],
+            normalization_dict=normalization_dict)
+
+        embedding_matrices.append(utils.apply_cnn(
+            cnn_model_object, this_predictor_matrix.astype('float32'),
+            verbose=False, output_layer_name=layer_name
+        ).astype(numpy.float16))
+        observation_matrices.append(numpy.reshape(
+            this_image_dict[utils.TARGET_MATRIX_KEY],
+            this_predictor_matrix.shape[:3]
+        ))
+        times_unix_sec.append(utils.read_file_times(
+            this_file_name, day_zero_time_string))
+
+    embedding_index = EmbeddingIndex(
+        embedding_matrix=numpy.concatenate(embedding_matrices, axis=0),
+        observation_matrix=numpy.concatenate(observation_matrices, axis=0),
+        times_unix_sec=numpy.concatenate(times_unix_sec),
+        layer_name=layer_name)
+
+    if output_file_name is not None:
+        embedding_index.write(output_file_name)
+
+    return embedding_index
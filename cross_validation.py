@@ -0,0 +1,491 @@
+"""Leave-one-season-out (or leave-one-year-out) cross-validation of the CNN.
+
+The archive is read once and packed into float32 memory-mapped shards (see
+`utils.pack_training_shards`), which every fold worker opens read-only, so all
+workers share one copy of the data through the page cache.  Each fold
+normalizes with statistics from its own training rows, trains a fresh CNN and
+verifies it (and raw WRF) on the held-out season or year.
+
+The "Days" variable in the NetCDF files is a bare day count, with no reference
+date in its units.  Seasons and years therefore depend on the date of day 0,
+which must be given explicitly (`day_zero_time_string`, format "%Y-%m-%d") to
+`run_cross_validation`; there is deliberately no default, since a wrong origin
+silently yields fictitious seasons.
+
+TensorFlow is imported only inside the workers (after their thread limits are
+set), so this module can be imported cheaply.
+"""
+import json
+import multiprocessing
+import os.path
+import time
+import numpy
+import hyperparameter_search
+import verification
+
+SEASON_FOLD_TYPE = 'season'
+YEAR_FOLD_TYPE = 'year'
+VALID_FOLD_TYPES = [SEASON_FOLD_TYPE, YEAR_FOLD_TYPE]
+
+# Season of each month (1 = January).
+SEASON_NAME_BY_MONTH = [
+    'DJF', 'DJF', 'MAM', 'MAM', 'MAM', 'JJA', 'JJA', 'JJA', 'SON', 'SON',
+    'SON', 'DJF'
+]
+
+# Architecture and optimizer of the notebook CNN.
+DEFAULT_HYPERPARAMETER_DICT = {
+    hyperparameter_search.NUM_CONV_FILTERS_KEY: 6,
+    hyperparameter_search.FILTER_WIDTH_KEY: 5,
+    hyperparameter_search.CONV_DROPOUT_KEY: 0.2,
+    hyperparameter_search.SECOND_CONV_DROPOUT_KEY: 0.4,
+    hyperparameter_search.LEARNING_RATE_KEY: 0.001,
+    hyperparameter_search.LOSS_FUNCTION_KEY: 'mse'
+}
+
+NUM_EPOCHS = 20
+NUM_EXAMPLES_PER_BATCH = 30
+NUM_WORKERS = 4
+NUM_THREADS_PER_WORKER = 2
+NUM_EXAMPLES_PER_STATS_BLOCK = 1000
+
+RESULTS_FILE_NAME = 'cross_validation_results.json'
+FILE_INDEX_FILE_NAME = 'file_index.json'
+ARCHIVE_METAFILE_NAME = 'archive_metadata.json'
+RAW_FORECASTS_FILE_NAME = 'raw_forecasts.npy'
+SOURCE_FILE_STAMPS_KEY = 'source_file_stamps'
+DAY_ZERO_KEY = 'day_zero_time_string'
+
+FOLD_LABEL_KEY = 'fold_label'
+NUM_TRAINING_EXAMPLES_KEY = 'num_training_examples'
+NUM_TESTING_EXAMPLES_KEY = 'num_testing_examples'
+CNN_SCORES_KEY = 'cnn_scores'
+RAW_SCORES_KEY = 'raw_scores'
+RMSE_SKILL_SCORE_KEY = 'rmse_skill_score'
+WALL_TIME_KEY = 'wall_time_sec'
+SCORE_NAMES = [
+    verification.RMSE_KEY, verification.MAE_KEY, verification.BIAS_KEY,
+    verification.CORRELATION_KEY
+]
+
+
+def get_fold_labels(times_unix_sec, fold_type=SEASON_FOLD_TYPE):
+    """Returns fold (season or year) of each example.
+    :param times_unix_sec: 1-D numpy array of valid times (from
+        `cache_archive`, with the true date of day 0).
+    :param fold_type: Either "season" or "year".
+    :return: fold_labels: 1-D numpy array of fold labels (strings).
+    :raises: ValueError: if `fold_type` is not recognized.
+    """
+
+    if fold_type not in VALID_FOLD_TYPES:
+        error_string = (
+            'Fold type ("{0:s}") is not in the following list:\n{1:s}'
+        ).format(fold_type, str(VALID_FOLD_TYPES))
+        raise ValueError(error_string)
+
+    times_datetime64 = numpy.array(
+        times_unix_sec, dtype=numpy.int64).astype('datetime64[s]')
+
+    if fold_type == YEAR_FOLD_TYPE:
+        return times_datetime64.astype('datetime64[Y]').astype(str)
+
+    month_indices = times_datetime64.astype('datetime64[M]').astype(int) % 12
+    return numpy.array(SEASON_NAME_BY_MONTH)[month_indices]
+
+
+def cache_archive(netcdf_file_names, cache_directory_name,
+                  day_zero_time_string):
+    """Reads archive once into memory-mapped shards (reused if up to date).
+    The shards are reused only if the list of files and the size and
+    modification time of every file (from `utils.build_file_index`) are the
+    same as when they were packed.  Raw WRF rainfall, with missing values kept
+    (see `utils.read_raw_forecasts`), is cached alongside for verification.
+    :param netcdf_file_names: 1-D list of paths to input files.
+    :param cache_directory_name: Name of cache directory.
+    :param day_zero_time_string: Date of day 0 for the "Days" variable (format
+        "%Y-%m-%d").
+    :return: times_unix_sec: 1-D numpy array of valid times (one per cached
+        example, in cache order).
+    """
+
+    import utils
+
+    shard_metafile_name = os.path.join(
+        cache_directory_name, utils.SHARD_METAFILE_NAME)
+    archive_metafile_name = os.path.join(
+        cache_directory_name, ARCHIVE_METAFILE_NAME)
+    index_file_name = os.path.join(cache_directory_name, FILE_INDEX_FILE_NAME)
+
+    archive_metadata_dict = {}
+    if os.path.isfile(archive_metafile_name):
+        with open(archive_metafile_name) as this_file:
+            archive_metadata_dict = json.load(this_file)
+
+    # Index entries hold times computed from day 0, so they are not reused if
+    # day 0 changed.
+    if (archive_metadata_dict.get(DAY_ZERO_KEY) != day_zero_time_string and
+            os.path.isfile(index_file_name)):
+        os.remove(index_file_name)
+
+    entry_dict_by_file = dict([
+        (d[utils.FILE_NAME_KEY], d) for d in
+        utils.build_file_index(
+            netcdf_file_names, index_file_name=index_file_name,
+            day_zero_time_string=day_zero_time_string
+        )[utils.FILE_ENTRIES_KEY]
+    ])
+    source_file_stamps = [
+        [f, entry_dict_by_file[f][utils.FILE_SIZE_KEY],
+         entry_dict_by_file[f][utils.FILE_MTIME_KEY]]
+        for f in netcdf_file_names
+    ]
+
+    raw_forecast_file_name = os.path.join(
+        cache_directory_name, RAW_FORECASTS_FILE_NAME)
+
+    if (os.path.isfile(shard_metafile_name) and
+            os.path.isfile(raw_forecast_file_name) and
+            archive_metadata_dict.get(SOURCE_FILE_STAMPS_KEY) ==
+            source_file_stamps):
+        print('Using cached archive in "{0:s}"...'.format(
+            cache_directory_name))
+    else:
+        utils.pack_training_shards(
+            netcdf_file_names=netcdf_file_names,
+            output_directory_name=cache_directory_name)
+        numpy.save(raw_forecast_file_name, numpy.concatenate([
+            utils.read_raw_forecasts(f) for f in netcdf_file_names
+        ]).astype(numpy.float32))
+
+    with open(archive_metafile_name, 'w') as this_file:
+        json.dump({
+            SOURCE_FILE_STAMPS_KEY: source_file_stamps,
+            DAY_ZERO_KEY: day_zero_time_string
+        }, this_file)
+
+    return numpy.concatenate([
+        numpy.array(entry_dict_by_file[f][utils.TIMES_KEY], dtype=numpy.int64)
+        for f in netcdf_file_names
+    ])
+
+
+def _read_rows(shard_dict, row_indices):
+    """Reads examples from memory-mapped shards.
+    :param shard_dict: Dictionary created by `utils.read_training_shards`.
+    :param row_indices: Sorted 1-D numpy array of example indices (over all
+        shards).
+    :return: predictor_matrix: E-by-M-by-N-by-C numpy array (float32).
+    :return: target_matrix: E-by-T numpy array (float32).
+    """
+
+    import utils
+
+    predictor_matrices = shard_dict[utils.SHARD_PREDICTOR_MATRICES_KEY]
+    target_matrices = shard_dict[utils.SHARD_TARGET_MATRICES_KEY]
+    shard_offsets = numpy.cumsum([0] + [m.shape[0] for m in target_matrices])
+    shard_indices = numpy.searchsorted(
+        shard_offsets, row_indices, side='right') - 1
+
+    predictor_matrix = numpy.empty(
+        (len(row_indices),) + predictor_matrices[0].shape[1:],
+        dtype=numpy.float32)
+    target_matrix = numpy.empty(
+        (len(row_indices),) + target_matrices[0].shape[1:],
+        dtype=numpy.float32)
+
+    for j in numpy.unique(shard_indices):
+        these_flags = shard_indices == j
+        these_rows = row_indices[these_flags] - shard_offsets[j]
+        predictor_matrix[these_flags, ...] = predictor_matrices[j][these_rows]
+        target_matrix[these_flags, ...] = target_matrices[j][these_rows]
+
+    return predictor_matrix, target_matrix
+
+
+def _get_fold_normalization_params(shard_dict, training_indices):
+    """Computes normalization params from the training rows of one fold.
+    :param shard_dict: See doc for `_read_rows`.
+    :param training_indices: Sorted 1-D numpy array of training-example
+        indices.
+    :return: predictor_means: length-C numpy array.
+    :return: predictor_stdevs: length-C numpy array.
+    :return: target_means: length-T numpy array (one mean per station).
+    :return: target_stdevs: length-T numpy array (one stdev per station, 1 for
+        stations with fewer than two values or zero spread).
+    """
+
+    import utils
+
+    predictor_sums = 0.
+    predictor_squared_sums = 0.
+    target_sum = 0.
+    target_squared_sum = 0.
+    num_target_values = 0
+
+    for i in range(0, len(training_indices), NUM_EXAMPLES_PER_STATS_BLOCK):
+        this_predictor_matrix, this_target_matrix = _read_rows(
+            shard_dict, training_indices[i:(i + NUM_EXAMPLES_PER_STATS_BLOCK)])
+        this_predictor_matrix = this_predictor_matrix.astype(float)
+        this_target_matrix = this_target_matrix.astype(float)
+
+        predictor_sums += numpy.sum(this_predictor_matrix, axis=(0, 1, 2))
+        predictor_squared_sums += numpy.sum(
+            this_predictor_matrix ** 2, axis=(0, 1, 2))
+        target_sum += numpy.nansum(this_target_matrix, axis=0)
+        target_squared_sum += numpy.nansum(this_target_matrix ** 2, axis=0)
+        num_target_values += numpy.sum(
+            numpy.isfinite(this_target_matrix), axis=0)
+
+    num_values = len(training_indices) * numpy.prod(
+        shard_dict[utils.SHARD_PREDICTOR_MATRICES_KEY][0].shape[1:3])
+
+    predictor_means = predictor_sums / num_values
+    predictor_stdevs = numpy.sqrt(
+        (predictor_squared_sums / num_values - predictor_means ** 2) *
+        num_values / (num_values - 1)
+    )
+    num_target_values = numpy.maximum(num_target_values, 1)
+    target_means = target_sum / num_target_values
+    target_stdevs = numpy.sqrt(numpy.maximum(
+        (target_squared_sum / num_target_values - target_means ** 2) *
+        num_target_values / numpy.maximum(num_target_values - 1, 1), 0.
+    ))
+    target_stdevs[numpy.invert(target_stdevs > 0)] = 1.
+
+    return predictor_means, predictor_stdevs, target_means, target_stdevs
+
+
+def _fold_generator(shard_dict, training_indices, num_examples_per_batch,
+                    normalization_params):
+    """Generates normalized training batches for one fold.
+    :param shard_dict: See doc for `_read_rows`.
+    :param training_indices: Sorted 1-D numpy array of training-example
+        indices.
+    :param num_examples_per_batch: Number of examples per batch.
+    :param normalization_params: Output of `_get_fold_normalization_params`.
+    :return: predictor_matrix: See doc for `utils.deep_learning_generator`.
+    :return: target_values: Same.
+    """
+
+    predictor_means, predictor_stdevs, target_means, target_stdevs = (
+        normalization_params)
+
+    while True:
+        these_indices = numpy.random.permutation(training_indices)
+
+        for i in range(0, len(these_indices) - num_examples_per_batch + 1,
+                       num_examples_per_batch):
+            predictor_matrix, target_values = _read_rows(
+                shard_dict,
+                numpy.sort(these_indices[i:(i + num_examples_per_batch)]))
+
+            predictor_matrix -= predictor_means.astype(numpy.float32)
+            predictor_matrix /= predictor_stdevs.astype(numpy.float32)
+            target_values -= target_means.astype(numpy.float32)
+            target_values /= target_stdevs.astype(numpy.float32)
+
+            yield (predictor_matrix, target_values)
+
+
+def _run_fold(argument_dict):
+    """Trains and verifies one fold (in a worker process).
+    :param argument_dict: Dictionary with fold label, example indices and the
+        shared arguments of `run_cross_validation`.
+    :return: fold_result_dict: Dictionary with keys "fold_label",
+        "num_training_examples", "num_testing_examples", "cnn_scores",
+        "raw_scores", "rmse_skill_score" and "wall_time_sec".
+    """
+
+    import keras
+    import tensorflow
+    import utils
+
+    start_time_unix_sec = time.time()
+    num_threads = argument_dict['num_threads_per_worker']
+    keras.backend.set_session(tensorflow.Session(config=tensorflow.ConfigProto(
+        intra_op_parallelism_threads=num_threads,
+        inter_op_parallelism_threads=num_threads)))
+
+    fold_label = argument_dict[FOLD_LABEL_KEY]
+    training_indices = argument_dict['training_indices']
+    testing_indices = argument_dict['testing_indices']
+    num_examples_per_batch = argument_dict['num_examples_per_batch']
+
+    shard_dict = utils.read_training_shards(
+        argument_dict['cache_directory_name'])
+    normalization_params = _get_fold_normalization_params(
+        shard_dict, training_indices)
+    predictor_means, predictor_stdevs, target_means, target_stdevs = (
+        normalization_params)
+
+    predictor_matrix, target_matrix = _read_rows(shard_dict, testing_indices)
+    cnn_model_object = hyperparameter_search.build_cnn(
+        hyperparameter_dict=argument_dict['hyperparameter_dict'],
+        predictor_shape=predictor_matrix.shape[1:],
+        num_targets=target_matrix.shape[1])
+
+    print('Training fold "{0:s}" on {1:d} examples...'.format(
+        fold_label, len(training_indices)))
+    cnn_model_object.fit_generator(
+        generator=_fold_generator(
+            shard_dict, training_indices, num_examples_per_batch,
+            normalization_params),
+        steps_per_epoch=max([len(training_indices) // num_examples_per_batch,
+                             1]),
+        epochs=argument_dict['num_epochs'], verbose=0, workers=0)
+
+    if argument_dict['output_dir_name'] is not None:
+        cnn_model_object.save(os.path.join(
+            argument_dict['output_dir_name'],
+            'fold_{0:s}.h5'.format(fold_label)))
+
+    # Raw WRF rainfall with missing values kept (in the predictors they are
+    # filled with 0).
+    raw_prediction_matrix = numpy.reshape(
+        numpy.load(os.path.join(
+            argument_dict['cache_directory_name'], RAW_FORECASTS_FILE_NAME
+        ), mmap_mode='r')[testing_indices].astype(float),
+        predictor_matrix.shape[:-1])
+    predictor_matrix -= predictor_means.astype(numpy.float32)
+    predictor_matrix /= predictor_stdevs.astype(numpy.float32)
+
+    cnn_prediction_matrix = target_means + target_stdevs * utils.apply_cnn(
+        cnn_model_object, predictor_matrix, verbose=False)
+    cnn_prediction_matrix = numpy.reshape(
+        cnn_prediction_matrix, raw_prediction_matrix.shape)
+    observation_matrix = numpy.reshape(
+        target_matrix, raw_prediction_matrix.shape).astype(float)
+
+    # Both forecasts are scored on the same points (NaN observations are
+    # skipped by the accumulator).
+    observation_matrix[numpy.invert(
+        numpy.isfinite(cnn_prediction_matrix) &
+        numpy.isfinite(raw_prediction_matrix)
+    )] = numpy.nan
+
+    score_dicts = []
+    for this_prediction_matrix in [
+            cnn_prediction_matrix, raw_prediction_matrix]:
+        this_score_dict = verification.VerificationAccumulator().update(
+            this_prediction_matrix, observation_matrix
+        ).get_scores(aggregate_axes=(0, 1))
+        score_dicts.append(dict([
+            (n, float(this_score_dict[n])) for n in SCORE_NAMES
+        ]))
+
+    return {
+        FOLD_LABEL_KEY: fold_label,
+        NUM_TRAINING_EXAMPLES_KEY: len(training_indices),
+        NUM_TESTING_EXAMPLES_KEY: len(testing_indices),
+        CNN_SCORES_KEY: score_dicts[0],
+        RAW_SCORES_KEY: score_dicts[1],
+        RMSE_SKILL_SCORE_KEY: 1. - (
+            score_dicts[0][verification.RMSE_KEY] /
+            score_dicts[1][verification.RMSE_KEY]
+        ),
+        WALL_TIME_KEY: time.time() - start_time_unix_sec
+    }
+
+
+def run_cross_validation(
+        netcdf_file_names, cache_directory_name, day_zero_time_string,
+        fold_type=SEASON_FOLD_TYPE,
+        hyperparameter_dict=None, num_epochs=NUM_EPOCHS,
+        num_examples_per_batch=NUM_EXAMPLES_PER_BATCH, num_workers=NUM_WORKERS,
+        num_threads_per_worker=NUM_THREADS_PER_WORKER, output_dir_name=None):
+    """Runs leave-one-season-out (or leave-one-year-out) cross-validation.
+    :param netcdf_file_names: 1-D list of paths to archive files.
+    :param cache_directory_name: Name of directory for the shared cache (see
+        `cache_archive`).
+    :param day_zero_time_string: Date of day 0 for the "Days" variable (format
+        "%Y-%m-%d").  Required, since the files do not record it and seasons
+        and years depend on it.
+    :param fold_type: See doc for `get_fold_labels`.
+    :param hyperparameter_dict: See doc for `hyperparameter_search.build_cnn`.
+        If None, will use `DEFAULT_HYPERPARAMETER_DICT`.
+    :param num_epochs: Number of epochs per fold.
+    :param num_examples_per_batch: Number of examples per batch.
+    :param num_workers: Number of folds run at once (processes).
+    :param num_threads_per_worker: Max number of threads per fold.
+    :param output_dir_name: Name of directory for fold models and results.  If
+        None, nothing is written.
+    :return: fold_result_dicts: 1-D list of fold results (see doc for
+        `_run_fold`), sorted by fold label.
+    :raises: ValueError: if `day_zero_time_string` is not a date in format
+        "%Y-%m-%d".
+    """
+
+    try:
+        time.strptime(str(day_zero_time_string), '%Y-%m-%d')
+    except ValueError:
+        error_string = (
+            'day_zero_time_string ("{0:s}") must be the date of day 0 in '
+            'format "%Y-%m-%d".'
+        ).format(str(day_zero_time_string))
+        raise ValueError(error_string)
+
+    start_time_unix_sec = time.time()
+    if hyperparameter_dict is None:
+        hyperparameter_dict = DEFAULT_HYPERPARAMETER_DICT
+
+    times_unix_sec = cache_archive(
+        netcdf_file_names, cache_directory_name, day_zero_time_string)
+    fold_labels = get_fold_labels(times_unix_sec, fold_type)
+
+    if output_dir_name is not None and not os.path.isdir(output_dir_name):
+        os.makedirs(output_dir_name)
+
+    argument_dicts = []
+    for this_label in numpy.unique(fold_labels):
+        argument_dicts.append({
+            FOLD_LABEL_KEY: str(this_label),
+            'training_indices': numpy.where(fold_labels != this_label)[0],
+            'testing_indices': numpy.where(fold_labels == this_label)[0],
+            'cache_directory_name': cache_directory_name,
+            'hyperparameter_dict': hyperparameter_dict,
+            'num_epochs': num_epochs,
+            'num_examples_per_batch': num_examples_per_batch,
+            'num_threads_per_worker': num_threads_per_worker,
+            'output_dir_name': output_dir_name
+        })
+
+    print('Running {0:d} folds ({1:s}) with {2:d} workers...'.format(
+        len(argument_dicts), fold_type, num_workers))
+
+    # Workers are spawned (not forked), so TensorFlow starts fresh in each one
+    # with its thread limits already set.
+    pool_object = multiprocessing.get_context('spawn').Pool(
+        processes=num_workers,
+        initializer=hyperparameter_search.set_thread_limits,
+        initargs=(num_threads_per_worker,), maxtasksperchild=1)
+
+    fold_result_dicts = []
+    try:
+        for this_result_dict in pool_object.imap_unordered(
+                _run_fold, argument_dicts):
+            print((
+                'Fold "{0:s}": CNN RMSE = {1:.3f}, raw RMSE = {2:.3f}, skill '
+                '= {3:.3f} ({4:.1f} s)'
+            ).format(
+                this_result_dict[FOLD_LABEL_KEY],
+                this_result_dict[CNN_SCORES_KEY][verification.RMSE_KEY],
+                this_result_dict[RAW_SCORES_KEY][verification.RMSE_KEY],
+                this_result_dict[RMSE_SKILL_SCORE_KEY],
+                this_result_dict[WALL_TIME_KEY]
+            ))
+            fold_result_dicts.append(this_result_dict)
+    finally:
+        pool_object.close()
+        pool_object.join()
+
+    fold_result_dicts.sort(key=lambda d: d[FOLD_LABEL_KEY])
+    print('Cross-validation took {0:.1f} seconds.'.format(
+        time.time() - start_time_unix_sec))
+
+    if output_dir_name is not None:
+        with open(os.path.join(output_dir_name, RESULTS_FILE_NAME),
+                  'w') as this_file:
+            json.dump(fold_result_dicts, this_file, indent=1)
+
+    return fold_result_dicts
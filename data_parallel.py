@@ -0,0 +1,527 @@
+"""Multi-process data-parallel training of the CNN on CPU nodes.
+
+N worker processes (on one or more nodes) each read a disjoint subset of the
+training files, compute gradients on their share of every batch and average
+them with an all-reduce over TCP, then all apply the same optimizer step, so
+the model stays identical on every worker.  The global batch
+(`num_examples_per_batch`) is split evenly over workers; since gradients are
+averaged, each step matches single-process training with the global batch and
+the learning rate needs no rescaling.
+
+Local run (loopback): `run_local(num_workers=4, ...)`.
+Multi-node run: start `python data_parallel.py --rank r ...` on each node, with
+the same --num_workers, --master_host and --port, and with --num_local_workers
+set to the number of workers on that node.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import struct
+import time
+import numpy
+
+MASTER_HOST_NAME = '127.0.0.1'
+PORT = 29500
+CONNECT_TIMEOUT_SEC = 300
+HEADER_FORMAT = '!Q'
+HEADER_SIZE_BYTES = struct.calcsize(HEADER_FORMAT)
+
+NUM_EPOCHS = 100
+NUM_EXAMPLES_PER_BATCH = 256
+
+
+def _send_array(socket_object, data_vector):
+    """Sends one float64 vector over a socket.
+    :param socket_object: Connected socket.
+    :param data_vector: 1-D numpy array.
+    """
+
+    data_bytes = numpy.ascontiguousarray(
+        data_vector, dtype=numpy.float64).tobytes()
+    socket_object.sendall(
+        struct.pack(HEADER_FORMAT, len(data_bytes)) + data_bytes)
+
+
+def _receive_exactly(socket_object, num_bytes):
+    """Receives exactly the given number of bytes.
+    :param socket_object: Connected socket.
+    :param num_bytes: Number of bytes.
+    :return: data_bytes: Received bytes.
+    :raises: ConnectionError: if the peer closes the connection.
+    """
+
+    data_buffer = bytearray(num_bytes)
+    data_view = memoryview(data_buffer)
+    num_received = 0
+
+    while num_received < num_bytes:
+        this_num_bytes = socket_object.recv_into(data_view[num_received:])
+        if this_num_bytes == 0:
+            raise ConnectionError('Peer closed connection.')
+
+        num_received += this_num_bytes
+
+    return data_buffer
+
+
+def _receive_array(socket_object):
+    """Receives one float64 vector sent by `_send_array`.
+    :param socket_object: Connected socket.
+    :return: data_vector: 1-D numpy array.
+    """
+
+    num_bytes = struct.unpack(
+        HEADER_FORMAT, _receive_exactly(socket_object, HEADER_SIZE_BYTES))[0]
+    return numpy.frombuffer(
+        _receive_exactly(socket_object, num_bytes), dtype=numpy.float64)
+
+
+class AllReducer(object):
+    """Averages vectors over all workers (TCP, reduce at rank 0).
+    Worker 0 listens; every other worker connects to it.  Vectors are summed in
+    float64 at worker 0 and the mean is sent back, so every worker gets
+    bit-identical results.
+    """
+
+    def __init__(self, rank, num_workers, master_host_name=MASTER_HOST_NAME,
+                 port=PORT):
+        """Connects workers.
+        :param rank: Rank of this worker (0...N - 1).
+        :param num_workers: Number of workers (N).
+        :param master_host_name: Host of worker 0.
+        :param port: Port on which worker 0 listens.
+        :raises: ValueError: if `rank` is not in 0...N - 1.
+        """
+
+        if not 0 <= rank < num_workers:
+            error_string = 'Rank ({0:d}) must be in 0...{1:d}.'.format(
+                rank, num_workers - 1)
+            raise ValueError(error_string)
+
+        self.rank = rank
+        self.num_workers = num_workers
+        self.socket_objects = []
+
+        if num_workers == 1:
+            return
+
+        if rank == 0:
+            server_socket_object = socket.socket(
+                socket.AF_INET, socket.SOCK_STREAM)
+            server_socket_object.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_socket_object.bind(('', port))
+            server_socket_object.listen(num_workers)
+            server_socket_object.settimeout(CONNECT_TIMEOUT_SEC)
+
+            socket_object_by_rank = {}
+            while len(socket_object_by_rank) < num_workers - 1:
+                this_socket_object = server_socket_object.accept()[0]
+                this_socket_object.settimeout(None)
+                this_rank = int(_receive_array(this_socket_object)[0])
+                socket_object_by_rank[this_rank] = this_socket_object
+
+            server_socket_object.close()
+            self.socket_objects = [
+                socket_object_by_rank[r] for r in sorted(socket_object_by_rank)
+            ]
+        else:
+            start_time_unix_sec = time.time()
+
+            while True:
+                try:
+                    this_socket_object = socket.create_connection(
+                        (master_host_name, port))
+                    break
+                except OSError:
+                    if time.time() - start_time_unix_sec > CONNECT_TIMEOUT_SEC:
+                        raise
+
+                    time.sleep(0.1)
+
+            _send_array(this_socket_object, numpy.array([rank]))
+            self.socket_objects = [this_socket_object]
+
+        for this_socket_object in self.socket_objects:
+            this_socket_object.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def all_reduce_mean(self, data_vector):
+        """Averages one vector over all workers.
+        :param data_vector: 1-D numpy array (same length on every worker).
+        :return: mean_vector: 1-D numpy array (float64) with the mean.
+        """
+
+        if self.num_workers == 1:
+            return numpy.asarray(data_vector, dtype=numpy.float64)
+
+        if self.rank != 0:
+            _send_array(self.socket_objects[0], data_vector)
+            return _receive_array(self.socket_objects[0])
+
+        sum_vector = numpy.array(data_vector, dtype=numpy.float64)
+        for this_socket_object in self.socket_objects:
+            sum_vector += _receive_array(this_socket_object)
+
+        mean_vector = sum_vector / self.num_workers
+        for this_socket_object in self.socket_objects:
+            _send_array(this_socket_object, mean_vector)
+
+        return mean_vector
+
+    def broadcast(self, data_vector):
+        """Sends vector from worker 0 to all workers.
+        :param data_vector: 1-D numpy array (used only at worker 0).
+        :return: data_vector: Vector from worker 0.
+        """
+
+        if self.num_workers == 1:
+            return numpy.asarray(data_vector, dtype=numpy.float64)
+
+        if self.rank != 0:
+            return _receive_array(self.socket_objects[0])
+
+        for this_socket_object in self.socket_objects:
+            _send_array(this_socket_object, data_vector)
+
+        return numpy.asarray(data_vector, dtype=numpy.float64)
+
+    def close(self):
+        """Closes all connections."""
+
+        for this_socket_object in self.socket_objects:
+            this_socket_object.close()
+
+        self.socket_objects = []
+
+
+def _flatten(matrices):
+    """Concatenates arrays into one float64 vector.
+    :param matrices: 1-D list of numpy arrays.
+    :return: data_vector: 1-D numpy array.
+    """
+
+    return numpy.concatenate(
+        [numpy.ravel(m).astype(numpy.float64) for m in matrices])
+
+
+def _unflatten(data_vector, shapes):
+    """Splits vector back into arrays (inverse of `_flatten`).
+    :param data_vector: 1-D numpy array.
+    :param shapes: 1-D list of array shapes.
+    :return: matrices: 1-D list of numpy arrays (float32).
+    """
+
+    matrices = []
+    this_first_index = 0
+
+    for this_shape in shapes:
+        this_size = int(numpy.prod(this_shape))
+        matrices.append(numpy.reshape(
+            data_vector[this_first_index:(this_first_index + this_size)],
+            this_shape
+        ).astype(numpy.float32))
+        this_first_index += this_size
+
+    return matrices
+
+
+def _get_training_functions(cnn_model_object):
+    """Creates functions for the gradient step and the optimizer update.
+    :param cnn_model_object: Compiled instance of `keras.models.Model`.
+    :return: gradient_function: Function that takes [predictors, targets,
+        sample weights (, learning phase)] and returns [loss] + gradients.  It
+        also runs the model's state updates (batch-norm moving statistics).
+    :return: apply_function: Function that takes averaged gradients and
+        applies one optimizer step.
+    """
+
+    from keras import backend as K
+
+    trainable_weights = cnn_model_object.trainable_weights
+    input_tensors = (
+        cnn_model_object.inputs + cnn_model_object.targets +
+        cnn_model_object.sample_weights
+    )
+    if not isinstance(K.learning_phase(), int):
+        input_tensors.append(K.learning_phase())
+
+    gradient_function = K.function(
+        input_tensors,
+        [cnn_model_object.total_loss] +
+        K.gradients(cnn_model_object.total_loss, trainable_weights),
+        updates=cnn_model_object.updates)
+
+    # The optimizer builds its update ops from gradients, which are replaced
+    # here by placeholders holding the averaged gradients.
+    gradient_placeholders = [
+        K.placeholder(shape=K.int_shape(w)) for w in trainable_weights
+    ]
+    optimizer_object = cnn_model_object.optimizer
+    optimizer_object.get_gradients = lambda loss, params: gradient_placeholders
+
+    apply_function = K.function(
+        gradient_placeholders, [],
+        updates=optimizer_object.get_updates(
+            loss=cnn_model_object.total_loss, params=trainable_weights))
+
+    return gradient_function, apply_function
+
+
+def train_worker(
+        rank, num_workers, training_file_names, normalization_dict,
+        normalization_dict_targ, output_model_file_name,
+        initial_model_file_name=None,
+        num_examples_per_batch=NUM_EXAMPLES_PER_BATCH, num_epochs=NUM_EPOCHS,
+        num_training_batches_per_epoch=None, validation_file_names=None,
+        num_threads=None, num_local_workers=None,
+        master_host_name=MASTER_HOST_NAME, port=PORT):
+    """Runs one data-parallel worker.
+    :param rank: Rank of this worker (0...N - 1).
+    :param num_workers: Number of workers (N).
+    :param training_file_names: 1-D list of paths to all training files.  This
+        worker reads files rank, rank + N, rank + 2N, ...
+    :param normalization_dict: See doc for `utils.train_cnn`.
+    :param normalization_dict_targ: Same.
+    :param output_model_file_name: Path to output model (written by worker 0
+        after each epoch, or only when validation loss improves if validation
+        files are given).
+    :param initial_model_file_name: Path to compiled, untrained model.  If
+        None, will use `utils.setup_cnn`.
+    :param num_examples_per_batch: Global batch size (split over workers).
+    :param num_epochs: Number of epochs.
+    :param num_training_batches_per_epoch: Number of global batches per epoch.
+        If None, one epoch is one pass over the training examples.
+    :param validation_file_names: 1-D list of paths to validation files (used
+        by worker 0 only).  If None, no validation is done.
+    :param num_threads: Max number of TensorFlow threads.  If None, cores are
+        split evenly over local workers.
+    :param num_local_workers: Number of workers on this node (used only to
+        split cores when `num_threads` is None).  If None, all N workers are
+        assumed to be on this node.
+    :param master_host_name: See doc for `AllReducer`.
+    :param port: Same.
+    :raises: ValueError: if there are fewer training files than workers, or if
+        the global batch does not split evenly over workers.
+    """
+
+    if len(training_file_names) < num_workers:
+        error_string = (
+            'Need at least one training file per worker ({0:d} files, {1:d} '
+            'workers).'
+        ).format(len(training_file_names), num_workers)
+        raise ValueError(error_string)
+
+    if num_examples_per_batch % num_workers != 0:
+        error_string = (
+            'Global batch ({0:d}) must be divisible by number of workers '
+            '({1:d}).'
+        ).format(num_examples_per_batch, num_workers)
+        raise ValueError(error_string)
+
+    if num_local_workers is None:
+        num_local_workers = num_workers
+
+    if num_threads is None:
+        num_threads = max(
+            [multiprocessing.cpu_count() // num_local_workers, 1])
+
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+
+    import tensorflow
+    from keras import backend as K
+    import utils
+
+    K.set_session(tensorflow.Session(config=tensorflow.ConfigProto(
+        intra_op_parallelism_threads=num_threads,
+        inter_op_parallelism_threads=num_threads)))
+
+    if initial_model_file_name is None:
+        cnn_model_object = utils.setup_cnn(print_report=False)
+    else:
+        cnn_model_object = utils.read_keras_model(initial_model_file_name)
+
+    gradient_function, apply_function = _get_training_functions(
+        cnn_model_object)
+
+    all_reducer = AllReducer(
+        rank=rank, num_workers=num_workers, master_host_name=master_host_name,
+        port=port)
+
+    # Start every worker from the weights of worker 0.
+    these_weights = cnn_model_object.get_weights()
+    cnn_model_object.set_weights(_unflatten(
+        all_reducer.broadcast(_flatten(these_weights)),
+        [w.shape for w in these_weights]
+    ))
+
+    if num_training_batches_per_epoch is None:
+        num_training_batches_per_epoch = max([
+            utils.count_samps(training_file_names) // num_examples_per_batch, 1
+        ])
+
+    num_examples_per_worker_batch = num_examples_per_batch // num_workers
+    training_generator = utils.deep_learning_generator(
+        netcdf_file_names=list(training_file_names[rank::num_workers]),
+        num_examples_per_batch=num_examples_per_worker_batch,
+        normalization_dict=normalization_dict,
+        normalization_dict_targ=normalization_dict_targ)
+
+    validation_predictor_matrix = None
+    if rank == 0 and validation_file_names is not None:
+        validation_predictor_matrix, validation_target_matrix = (
+            utils.read_validation_data(
+                validation_file_names=validation_file_names,
+                normalization_dict=normalization_dict,
+                normalization_dict_targ=normalization_dict_targ)
+        )
+
+    gradient_shapes = [
+        tuple(K.int_shape(w)) for w in cnn_model_object.trainable_weights
+    ]
+    state_weights = cnn_model_object.non_trainable_weights
+    sample_weights = numpy.ones(num_examples_per_worker_batch)
+    best_validation_loss = numpy.inf
+
+    try:
+        for this_epoch in range(num_epochs):
+            this_start_time_unix_sec = time.time()
+            this_loss_sum = 0.
+
+            for _ in range(num_training_batches_per_epoch):
+                this_predictor_matrix, this_target_matrix = next(
+                    training_generator)
+
+                these_inputs = [
+                    this_predictor_matrix, this_target_matrix, sample_weights
+                ]
+                if not isinstance(K.learning_phase(), int):
+                    these_inputs.append(1)
+
+                these_outputs = gradient_function(these_inputs)
+                this_mean_vector = all_reducer.all_reduce_mean(
+                    _flatten(these_outputs[1:] + [these_outputs[0]]))
+
+                apply_function(
+                    _unflatten(this_mean_vector[:-1], gradient_shapes))
+                this_loss_sum += this_mean_vector[-1]
+
+            # Batch-norm statistics are updated locally, so they are averaged
+            # once per epoch to keep the workers identical.
+            if state_weights:
+                these_values = K.batch_get_value(state_weights)
+                K.batch_set_value(list(zip(state_weights, _unflatten(
+                    all_reducer.all_reduce_mean(_flatten(these_values)),
+                    [v.shape for v in these_values]
+                ))))
+
+            if rank != 0:
+                continue
+
+            this_elapsed_sec = time.time() - this_start_time_unix_sec
+            print((
+                'Epoch {0:d}: loss = {1:.6f}, {2:.1f} examples/s over {3:d} '
+                'workers'
+            ).format(
+                this_epoch + 1, this_loss_sum / num_training_batches_per_epoch,
+                num_training_batches_per_epoch * num_examples_per_batch /
+                this_elapsed_sec,
+                num_workers
+            ))
+
+            if validation_predictor_matrix is None:
+                cnn_model_object.save(output_model_file_name)
+                continue
+
+            this_validation_loss = numpy.atleast_1d(cnn_model_object.evaluate(
+                validation_predictor_matrix, validation_target_matrix,
+                batch_size=utils.NUM_EXAMPLES_PER_VALIDATION_BATCH, verbose=0
+            ))[0]
+            print('Validation loss = {0:.6f}'.format(this_validation_loss))
+
+            if this_validation_loss < best_validation_loss:
+                best_validation_loss = this_validation_loss
+                cnn_model_object.save(output_model_file_name)
+    finally:
+        all_reducer.close()
+
+
+def _get_free_port():
+    """Returns a free TCP port on this host.
+    :return: port: Port number.
+    """
+
+    socket_object = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    socket_object.bind(('', 0))
+    port = socket_object.getsockname()[1]
+    socket_object.close()
+
+    return port
+
+
+def _run_local_worker(argument_dict):
+    """Runs one worker in a local process (wrapper for `train_worker`).
+    :param argument_dict: Keyword arguments for `train_worker`.
+    """
+
+    train_worker(**argument_dict)
+
+
+def run_local(num_workers, **kwargs):
+    """Runs data-parallel training with N local processes over loopback.
+    :param num_workers: Number of worker processes (N).
+    :param kwargs: Keyword arguments for `train_worker` (except rank,
+        num_workers, num_local_workers, master_host_name and port).
+    :raises: RuntimeError: if any worker fails.
+    """
+
+    port = _get_free_port()
+    context_object = multiprocessing.get_context('spawn')
+
+    process_objects = []
+    for this_rank in range(num_workers):
+        this_argument_dict = dict(
+            kwargs, rank=this_rank, num_workers=num_workers,
+            num_local_workers=num_workers, master_host_name=MASTER_HOST_NAME,
+            port=port)
+        process_objects.append(context_object.Process(
+            target=_run_local_worker, args=(this_argument_dict,)))
+        process_objects[-1].start()
+
+    for this_process_object in process_objects:
+        this_process_object.join()
+
+    these_exit_codes = [p.exitcode for p in process_objects]
+    if any([c != 0 for c in these_exit_codes]):
+        error_string = 'Workers exited with codes {0:s}.'.format(
+            str(these_exit_codes))
+        raise RuntimeError(error_string)
+
+
+if __name__ == '__main__':
+    ARGUMENT_PARSER = argparse.ArgumentParser(
+        description='Runs one data-parallel training worker.')
+    ARGUMENT_PARSER.add_argument('--rank', type=int, required=True)
+    ARGUMENT_PARSER.add_argument('--num_workers', type=int, required=True)
+    ARGUMENT_PARSER.add_argument(
+        '--num_local_workers', type=int, default=None,
+        help='Number of workers on this node (default: --num_workers).')
+    ARGUMENT_PARSER.add_argument(
+        '--master_host', default=MASTER_HOST_NAME)
+    ARGUMENT_PARSER.add_argument('--port', type=int, default=PORT)
+    ARGUMENT_PARSER.add_argument(
+        'config_file_name',
+        help='JSON file with keyword arguments for `train_worker` (file '
+             'lists, normalization dicts, output file, batch size, etc.).')
+    ARGUMENTS = ARGUMENT_PARSER.parse_args()
+
+    with open(ARGUMENTS.config_file_name) as CONFIG_FILE:
+        CONFIG_DICT = json.load(CONFIG_FILE)
+
+    train_worker(
+        rank=ARGUMENTS.rank, num_workers=ARGUMENTS.num_workers,
+        num_local_workers=ARGUMENTS.num_local_workers,
+        master_host_name=ARGUMENTS.master_host, port=ARGUMENTS.port,
+        **CONFIG_DICT)
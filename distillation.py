@@ -0,0 +1,433 @@
+"""Knowledge distillation of a trained CNN into a compact student.
+
+The teacher (e.g., one of models/*.h5) is applied once to the packed training
+archive (see `utils.pack_training_shards`) and its outputs ("soft targets") are
+cached next to the shards.  The student is trained on a blend of soft and
+observed ("hard") targets, which for MSE is the same as minimizing the blended
+loss.  `compare_models` reports student skill against the teacher, along with
+the gains in latency and throughput.
+"""
+import hashlib
+import json
+import os.path
+import time
+import numpy
+import keras
+import utils
+import verification
+
+SOFT_TARGETS_FILE_NAME = 'soft_targets.npy'
+SOFT_TARGETS_METAFILE_NAME = 'soft_targets_metadata.json'
+CACHE_KEY_KEY = 'cache_key'
+
+HARD_TARGET_WEIGHT = 0.3
+NUM_EPOCHS = 50
+NUM_EXAMPLES_PER_BATCH = 64
+NUM_STUDENT_FILTERS = 4
+NUM_STUDENT_HIDDEN_UNITS = 32
+NUM_LATENCY_REPEATS = 20
+NUM_EXAMPLES_FOR_THROUGHPUT = 1000
+
+CNN_SCORES_KEY = 'cnn_scores'
+FIDELITY_RMSE_KEY = 'student_teacher_rmse'
+NUM_PARAMS_KEY = 'num_params'
+LATENCY_KEY = 'latency_sec'
+THROUGHPUT_KEY = 'examples_per_second'
+TEACHER_KEY = 'teacher'
+STUDENT_KEY = 'student'
+
+
+def build_student_cnn(predictor_shape, num_targets,
+                      num_filters=NUM_STUDENT_FILTERS,
+                      num_hidden_units=NUM_STUDENT_HIDDEN_UNITS,
+                      learning_rate=utils.LEARNING_RATE,
+                      output_activation_name=None, minmax=None):
+    """Creates compact student CNN.
+    Two small conv layers with aggressive pooling along stations keep the
+    flattened feature vector short, so the Flatten -> Dense block (most of the
+    teacher's weights) shrinks by more than an order of magnitude.
+    :param predictor_shape: Shape of one example (M x N x C).
+    :param num_targets: Number of target values per example (T).
+    :param num_filters: Number of filters in first conv layer (doubled in the
+        second).
+    :param num_hidden_units: Number of units in the hidden dense layer.
+    :param learning_rate: Learning rate for Adam.
+    :param output_activation_name: See doc for `utils.setup_cnn`.  Default is
+        linear, which suits the z-scored (teacher) targets.
+    :param minmax: Same.
+    :return: cnn_model_object: Untrained (but compiled) instance of
+        `keras.models.Model`.
+    :raises: ValueError: if `utils.check_output_activation` fails.
+    """
+
+    utils.check_output_activation(output_activation_name, minmax)
+
+    input_layer_object = keras.layers.Input(shape=tuple(predictor_shape))
+
+    current_layer_object = keras.layers.Conv2D(
+        num_filters, (3, 3), padding='same')(input_layer_object)
+    current_layer_object = keras.layers.LeakyReLU(
+        alpha=utils.SLOPE_FOR_RELU)(current_layer_object)
+    current_layer_object = keras.layers.MaxPooling2D(
+        pool_size=(min([2, predictor_shape[0]]), 2))(current_layer_object)
+
+    current_layer_object = keras.layers.Conv2D(
+        num_filters * 2, (3, 3), padding='same')(current_layer_object)
+    current_layer_object = keras.layers.LeakyReLU(
+        alpha=utils.SLOPE_FOR_RELU)(current_layer_object)
+    current_layer_object = keras.layers.MaxPooling2D(
+        pool_size=(1, 4))(current_layer_object)
+
+    current_layer_object = keras.layers.Flatten()(current_layer_object)
+    current_layer_object = keras.layers.Dense(num_hidden_units)(
+        current_layer_object)
+    current_layer_object = keras.layers.LeakyReLU(
+        alpha=utils.SLOPE_FOR_RELU)(current_layer_object)
+    current_layer_object = keras.layers.Dense(num_targets)(
+        current_layer_object)
+
+    if output_activation_name not in [None, 'linear']:
+        current_layer_object = keras.layers.Activation(
+            output_activation_name)(current_layer_object)
+
+    cnn_model_object = keras.models.Model(
+        inputs=input_layer_object, outputs=current_layer_object)
+    cnn_model_object.compile(
+        loss='mse', optimizer=keras.optimizers.Adam(lr=learning_rate))
+
+    return cnn_model_object
+
+
+def _get_soft_target_cache_key(teacher_model_file_name, shard_directory_name,
+                               shard_dict, normalization_dict,
+                               normalization_dict_targ):
+    """Returns cache key for soft targets.
+    The key changes if the teacher, the shards (metafile contents or any
+    shard file being rewritten) or the normalization params change.
+    :param teacher_model_file_name: See doc for `cache_soft_targets`.
+    :param shard_directory_name: Same.
+    :param shard_dict: Dictionary created by `utils.read_training_shards`.
+    :param normalization_dict: See doc for `cache_soft_targets`.
+    :param normalization_dict_targ: Same.
+    :return: cache_key: Hexadecimal hash.
+    """
+
+    shard_file_entries = []
+    for this_file_name in sum(
+            [list(f) for f in shard_dict[utils.SHARD_FILE_NAMES_KEY]], []):
+        this_stat_object = os.stat(
+            os.path.join(shard_directory_name, this_file_name))
+        shard_file_entries.append(
+            [this_file_name, this_stat_object.st_size,
+             this_stat_object.st_mtime])
+
+    json_string = json.dumps([
+        utils.get_file_hash(teacher_model_file_name),
+        utils.get_file_hash(
+            os.path.join(shard_directory_name, utils.SHARD_METAFILE_NAME)),
+        shard_file_entries,
+        [dict([(k, numpy.asarray(v).tolist()) for k, v in d.items()])
+         for d in [normalization_dict, normalization_dict_targ]]
+    ], sort_keys=True)
+
+    return hashlib.sha256(json_string.encode('utf-8')).hexdigest()
+
+
+def cache_soft_targets(teacher_model_file_name, shard_directory_name,
+                       normalization_dict, normalization_dict_targ,
+                       num_examples_per_batch=None):
+    """Applies teacher once to the packed archive and caches its outputs.
+    The cache is reused as long as the teacher, the shards and the
+    normalization params are unchanged.
+    :param teacher_model_file_name: Path to teacher model (HDF5).
+    :param shard_directory_name: Name of directory created by
+        `utils.pack_training_shards` with pre-normalized predictors and
+        targets.
+    :param normalization_dict: Normalization params the teacher was trained
+        with (see doc for `utils.normalize_images`).  The shards must have been
+        packed with the same params.
+    :param normalization_dict_targ: Same, for targets (see doc for
+        `utils.normalize_images_targ`).
+    :param num_examples_per_batch: See doc for `utils.apply_cnn`.
+    :return: soft_target_matrix: E-by-T numpy array (float32, memory-mapped)
+        of normalized teacher outputs, in shard order.
+    :raises: ValueError: if the shards were not packed with the given
+        normalization params (see `utils.check_shard_normalization`).
+    """
+
+    shard_dict = utils.read_training_shards(shard_directory_name)
+    utils.check_shard_normalization(
+        shard_dict, normalization_dict, normalization_dict_targ,
+        require_pre_normalized=True)
+
+    soft_target_file_name = os.path.join(
+        shard_directory_name, SOFT_TARGETS_FILE_NAME)
+    metafile_name = os.path.join(
+        shard_directory_name, SOFT_TARGETS_METAFILE_NAME)
+    cache_key = _get_soft_target_cache_key(
+        teacher_model_file_name, shard_directory_name, shard_dict,
+        normalization_dict, normalization_dict_targ)
+
+    if os.path.isfile(soft_target_file_name) and os.path.isfile(metafile_name):
+        with open(metafile_name) as this_file:
+            if json.load(this_file).get(CACHE_KEY_KEY) == cache_key:
+                print('Using cached soft targets in "{0:s}"...'.format(
+                    soft_target_file_name))
+                return numpy.load(soft_target_file_name, mmap_mode='r')
+
+    teacher_model_object = utils.read_keras_model(teacher_model_file_name)
+    predictor_matrices = shard_dict[utils.SHARD_PREDICTOR_MATRICES_KEY]
+
+    soft_target_matrix = None
+    this_first_row = 0
+
+    for j in range(len(predictor_matrices)):
+        print('Applying teacher to shard {0:d} of {1:d}...'.format(
+            j + 1, len(predictor_matrices)))
+
+        this_prediction_matrix = utils.apply_cnn(
+            teacher_model_object, predictor_matrices[j], verbose=False,
+            num_examples_per_batch=num_examples_per_batch)
+
+        if soft_target_matrix is None:
+            num_examples = sum([m.shape[0] for m in predictor_matrices])
+            soft_target_matrix = numpy.lib.format.open_memmap(
+                soft_target_file_name, mode='w+', dtype=numpy.float32,
+                shape=(num_examples,) + this_prediction_matrix.shape[1:])
+
+        this_last_row = this_first_row + this_prediction_matrix.shape[0]
+        soft_target_matrix[this_first_row:this_last_row, ...] = (
+            this_prediction_matrix)
+        this_first_row = this_last_row
+
+    soft_target_matrix.flush()
+    del soft_target_matrix
+
+    with open(metafile_name, 'w') as this_file:
+        json.dump({CACHE_KEY_KEY: cache_key}, this_file)
+
+    return numpy.load(soft_target_file_name, mmap_mode='r')
+
+
+def _distillation_generator(shard_dict, soft_target_matrix,
+                            num_examples_per_batch, hard_target_weight):
+    """Generates training batches with blended targets.
+    Each batch is a random sample of the training set, as in
+    `utils.shard_generator`.  Where the observation is missing, the soft
+    target is used alone.
+    :param shard_dict: Dictionary created by `utils.read_training_shards`.
+    :param soft_target_matrix: Output of `cache_soft_targets`.
+    :param num_examples_per_batch: Number of examples per batch.
+    :param hard_target_weight: Weight of observed targets (0...1).  The soft
+        targets get the remaining weight.
+    :return: predictor_matrix: See doc for `utils.deep_learning_generator`.
+    :return: target_values: Same.
+    """
+
+    predictor_matrices = shard_dict[utils.SHARD_PREDICTOR_MATRICES_KEY]
+    target_matrices = shard_dict[utils.SHARD_TARGET_MATRICES_KEY]
+    num_examples = soft_target_matrix.shape[0]
+
+    while True:
+        for these_indices in utils.get_random_batch_indices(
+                num_examples, num_examples_per_batch):
+            predictor_matrix = utils.read_shard_rows(
+                predictor_matrices, these_indices)
+            soft_target_values = soft_target_matrix[these_indices, ...]
+            hard_target_values = utils.read_shard_rows(
+                target_matrices, these_indices)
+
+            target_values = numpy.where(
+                numpy.isfinite(hard_target_values),
+                hard_target_weight * hard_target_values +
+                (1. - hard_target_weight) * soft_target_values,
+                soft_target_values
+            ).astype('float32')
+
+            yield (predictor_matrix, target_values)
+
+
+def distill(teacher_model_file_name, training_file_names, shard_directory_name,
+            output_model_file_name, normalization_dict,
+            normalization_dict_targ, hard_target_weight=HARD_TARGET_WEIGHT,
+            num_epochs=NUM_EPOCHS,
+            num_examples_per_batch=NUM_EXAMPLES_PER_BATCH,
+            student_model_object=None):
+    """Trains compact student to mimic the teacher.
+    :param teacher_model_file_name: Path to teacher model (HDF5).
+    :param training_file_names: 1-D list of paths to training files.
+    :param shard_directory_name: Name of directory for the packed, normalized
+        training archive.  Files are packed only if the directory does not
+        already hold shards.  Existing shards must have been packed with
+        `normalization_dict` and `normalization_dict_targ`.
+    :param output_model_file_name: Path to output (student) model.
+    :param normalization_dict: Normalization params the teacher was trained
+        with (see doc for `utils.normalize_images`).
+    :param normalization_dict_targ: Same, for targets (see doc for
+        `utils.normalize_images_targ`).
+    :param hard_target_weight: See doc for `_distillation_generator`.
+    :param num_epochs: Number of epochs.
+    :param num_examples_per_batch: Number of examples per batch.
+    :param student_model_object: Untrained (but compiled) instance of
+        `keras.models.Model`.  If None, will use `build_student_cnn`.
+    :return: student_model_object: Trained student.
+    :raises: ValueError: if existing shards were packed with other
+        normalization params (or none).
+    """
+
+    if not os.path.isfile(os.path.join(
+            shard_directory_name, utils.SHARD_METAFILE_NAME)):
+        utils.pack_training_shards(
+            netcdf_file_names=training_file_names,
+            output_directory_name=shard_directory_name,
+            normalization_dict=normalization_dict,
+            normalization_dict_targ=normalization_dict_targ)
+
+    soft_target_matrix = cache_soft_targets(
+        teacher_model_file_name, shard_directory_name, normalization_dict,
+        normalization_dict_targ)
+    shard_dict = utils.read_training_shards(shard_directory_name)
+
+    if student_model_object is None:
+        student_model_object = build_student_cnn(
+            predictor_shape=shard_dict[
+                utils.SHARD_PREDICTOR_MATRICES_KEY][0].shape[1:],
+            num_targets=soft_target_matrix.shape[1])
+
+    utils._create_directory(file_name=output_model_file_name)
+    checkpoint_object = keras.callbacks.ModelCheckpoint(
+        filepath=output_model_file_name, monitor='loss', verbose=1,
+        save_best_only=True, save_weights_only=False, mode='min', period=1)
+
+    student_model_object.fit_generator(
+        generator=_distillation_generator(
+            shard_dict, soft_target_matrix, num_examples_per_batch,
+            hard_target_weight),
+        steps_per_epoch=max(
+            [soft_target_matrix.shape[0] // num_examples_per_batch, 1]),
+        epochs=num_epochs, verbose=1, callbacks=[checkpoint_object],
+        workers=0)
+
+    return student_model_object
+
+
+def _time_model(cnn_model_object, predictor_matrix):
+    """Measures latency and throughput of one model on the CPU.
+    :param cnn_model_object: Instance of `keras.models.Model`.
+    :param predictor_matrix: E-by-M-by-N-by-C numpy array of normalized
+        predictors.
+    :return: latency_sec: Median time to predict one example.
+    :return: examples_per_second: Throughput with large batches.
+    """
+
+    this_example_matrix = predictor_matrix[:1, ...]
+    cnn_model_object.predict_on_batch(this_example_matrix)
+
+    these_latencies_sec = []
+    for _ in range(NUM_LATENCY_REPEATS):
+        this_start_time_unix_sec = time.time()
+        cnn_model_object.predict_on_batch(this_example_matrix)
+        these_latencies_sec.append(time.time() - this_start_time_unix_sec)
+
+    these_indices = numpy.arange(NUM_EXAMPLES_FOR_THROUGHPUT) % (
+        predictor_matrix.shape[0])
+    this_batch_matrix = predictor_matrix[these_indices, ...]
+
+    this_start_time_unix_sec = time.time()
+    cnn_model_object.predict(this_batch_matrix, batch_size=len(these_indices))
+    this_elapsed_sec = time.time() - this_start_time_unix_sec
+
+    return (float(numpy.median(these_latencies_sec)),
+            len(these_indices) / this_elapsed_sec)
+
+
+def compare_models(teacher_model_object, student_model_object,
+                   netcdf_file_names, normalization_dict,
+                   normalization_dict_targ):
+    """Compares student with teacher on held-out files.
+    :param teacher_model_object: Trained teacher (`keras.models.Model`).
+    :param student_model_object: Trained student.
+    :param netcdf_file_names: 1-D list of paths to evaluation files.
+    :param normalization_dict: See doc for `distill`.
+    :param normalization_dict_targ: Same.
+    :return: comparison_dict: Dictionary with keys "teacher" and "student",
+        each holding a dictionary with keys "cnn_scores" (domain-wide scores
+        against observations, see
+        `verification.VerificationAccumulator.get_scores`), "num_params",
+        "latency_sec" and "examples_per_second".  The student dictionary also
+        has "student_teacher_rmse" (RMSE between the two models, in mm).
+    """
+
+    predictor_matrices = []
+    observation_matrices = []
+
+    for this_file_name in netcdf_file_names:
+        this_image_dict = utils.read_image_file(this_file_name)
+        this_predictor_matrix, _ = utils.normalize_images(
+            predictor_matrix=this_image_dict[utils.PREDICTOR_MATRIX_KEY],
+            predictor_names=this_image_dict[utils.PREDICTOR_NAMES_KEY],
+            normalization_dict=normalization_dict)
+
+        predictor_matrices.append(this_predictor_matrix.astype('float32'))
+        observation_matrices.append(this_image_dict[utils.TARGET_MATRIX_KEY])
+
+    predictor_matrix = numpy.concatenate(predictor_matrices, axis=0)
+    observation_matrix = numpy.reshape(
+        numpy.concatenate(observation_matrices, axis=0),
+        predictor_matrix.shape[:3])
+
+    comparison_dict = {}
+    prediction_matrix_by_model = {}
+
+    for this_key, this_model_object in [
+            (TEACHER_KEY, teacher_model_object),
+            (STUDENT_KEY, student_model_object)
+    ]:
+        this_prediction_matrix = utils.denormalize_images_targ(
+            utils.apply_cnn(this_model_object, predictor_matrix, verbose=False),
+            utils.TARGET_NAME, normalization_dict_targ)
+        prediction_matrix_by_model[this_key] = numpy.reshape(
+            this_prediction_matrix, observation_matrix.shape)
+
+        this_latency_sec, this_throughput = _time_model(
+            this_model_object, predictor_matrix)
+
+        comparison_dict[this_key] = {
+            CNN_SCORES_KEY: verification.VerificationAccumulator().update(
+                prediction_matrix_by_model[this_key], observation_matrix
+            ).get_scores(aggregate_axes=(0, 1)),
+            NUM_PARAMS_KEY: this_model_object.count_params(),
+            LATENCY_KEY: this_latency_sec,
+            THROUGHPUT_KEY: this_throughput
+        }
+
+    comparison_dict[STUDENT_KEY][FIDELITY_RMSE_KEY] = float(numpy.sqrt(
+        numpy.mean((prediction_matrix_by_model[STUDENT_KEY] -
+                    prediction_matrix_by_model[TEACHER_KEY]) ** 2)
+    ))
+
+    for this_key in [TEACHER_KEY, STUDENT_KEY]:
+        print((
+            '{0:s}: RMSE = {1:.3f} mm, params = {2:d}, latency = {3:.2f} ms, '
+            'throughput = {4:.0f} examples/s'
+        ).format(
+            this_key.capitalize(),
+            float(comparison_dict[this_key][CNN_SCORES_KEY][
+                verification.RMSE_KEY]),
+            comparison_dict[this_key][NUM_PARAMS_KEY],
+            1000 * comparison_dict[this_key][LATENCY_KEY],
+            comparison_dict[this_key][THROUGHPUT_KEY]
+        ))
+
+    print((
+        'Student is {0:.1f}x faster per example and {1:.1f}x higher throughput '
+        '(RMSE vs teacher = {2:.3f} mm).'
+    ).format(
+        comparison_dict[TEACHER_KEY][LATENCY_KEY] /
+        comparison_dict[STUDENT_KEY][LATENCY_KEY],
+        comparison_dict[STUDENT_KEY][THROUGHPUT_KEY] /
+        comparison_dict[TEACHER_KEY][THROUGHPUT_KEY],
+        comparison_dict[STUDENT_KEY][FIDELITY_RMSE_KEY]
+    ))
+
+    return comparison_dict
@@ -0,0 +1,450 @@
+"""Parallel hyperparameter search for the CNN with ASHA early pruning.
+
+Trials (one `utils.train_cnn` run each) are spread over worker processes, each
+limited to a few threads so that many fit on one CPU node.  Pruning follows
+asynchronous successive halving (ASHA): at each rung (epochs
+min_epochs * reduction_factor^k), a trial continues only if its validation score
+is among the best 1 / reduction_factor of all trials that reached the rung so
+far.
+
+The loss function is a hyperparameter, so losses of different trials are in
+different units.  Every trial is therefore also compiled with the metrics in
+`METRIC_NAMES`, and pruning and ranking use one of them (the selection metric)
+on the validation set.
+
+TensorFlow is imported only inside the workers (after their thread limits are
+set), so this module can be imported cheaply.
+"""
+import json
+import multiprocessing
+import os.path
+import random
+import time
+import numpy
+
+NUM_CONV_FILTERS_KEY = 'num_conv_filters'
+FILTER_WIDTH_KEY = 'filter_width'
+CONV_DROPOUT_KEY = 'conv_dropout_fraction'
+SECOND_CONV_DROPOUT_KEY = 'second_conv_dropout_fraction'
+LEARNING_RATE_KEY = 'learning_rate'
+LOSS_FUNCTION_KEY = 'loss_function'
+
+# Values tuned by hand in the notebook (TEST_GPU_mae / TEST_GPU_mse variants).
+DEFAULT_SEARCH_SPACE_DICT = {
+    NUM_CONV_FILTERS_KEY: [4, 6, 8, 12],
+    FILTER_WIDTH_KEY: [3, 5, 7],
+    CONV_DROPOUT_KEY: [0., 0.1, 0.2, 0.3],
+    SECOND_CONV_DROPOUT_KEY: [0.2, 0.3, 0.4, 0.5],
+    LEARNING_RATE_KEY: [0.0003, 0.001, 0.003],
+    LOSS_FUNCTION_KEY: ['mse', 'mae']
+}
+
+NUM_TRIALS = 20
+NUM_PARALLEL_TRIALS = 4
+NUM_THREADS_PER_TRIAL = 2
+MIN_EPOCHS = 2
+MAX_EPOCHS = 50
+REDUCTION_FACTOR = 3
+LEADERBOARD_FILE_NAME = 'leaderboard.json'
+
+# Full Keras names, so that log keys are "val_<name>" in all Keras versions.
+METRIC_NAMES = ['mean_squared_error', 'mean_absolute_error']
+SELECTION_METRIC_NAME = 'mean_squared_error'
+
+TRIAL_ID_KEY = 'trial_id'
+HYPERPARAMETERS_KEY = 'hyperparameters'
+SELECTION_METRIC_KEY = 'selection_metric_name'
+BEST_VAL_SCORE_KEY = 'best_val_score'
+VAL_SCORES_KEY = 'val_scores'
+NUM_EPOCHS_KEY = 'num_epochs'
+PRUNED_KEY = 'pruned'
+WALL_TIME_KEY = 'wall_time_sec'
+MODEL_FILE_KEY = 'model_file_name'
+ERROR_KEY = 'error'
+
+THREAD_ENV_VARIABLE_NAMES = [
+    'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+    'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS'
+]
+
+
+def get_rung_epochs(min_epochs=MIN_EPOCHS, max_epochs=MAX_EPOCHS,
+                    reduction_factor=REDUCTION_FACTOR):
+    """Returns epochs at which trials may be pruned.
+    :param min_epochs: Epochs before the first rung.
+    :param max_epochs: Max epochs per trial.
+    :param reduction_factor: Factor by which epochs grow (and trials shrink)
+        from one rung to the next.
+    :return: rung_epochs: 1-D list of epoch counts (rungs), all < max_epochs.
+    """
+
+    rung_epochs = []
+    this_num_epochs = min_epochs
+
+    while this_num_epochs < max_epochs:
+        rung_epochs.append(int(this_num_epochs))
+        this_num_epochs *= reduction_factor
+
+    return rung_epochs
+
+
+def should_prune(rung_scores, this_score, reduction_factor=REDUCTION_FACTOR):
+    """Decides whether trial stops at a rung (ASHA promotion rule).
+    :param rung_scores: 1-D list of validation scores (selection metric, lower
+        is better) of all trials that reached the rung (including this one).
+    :param this_score: Score of this trial.
+    :param reduction_factor: See doc for `get_rung_epochs`.
+    :return: prune_flag: Boolean flag.
+    """
+
+    if not numpy.isfinite(this_score):
+        return True
+
+    num_promoted = max([len(rung_scores) // reduction_factor, 1])
+    return this_score > numpy.sort(rung_scores)[num_promoted - 1]
+
+
+def build_cnn(hyperparameter_dict, predictor_shape, num_targets):
+    """Builds and compiles the notebook CNN with the given hyperparameters.
+    :param hyperparameter_dict: Dictionary with keys listed in
+        `DEFAULT_SEARCH_SPACE_DICT`.
+    :param predictor_shape: Shape of one example (M x N x C).
+    :param num_targets: Number of target values per example (T).
+    :return: cnn_model_object: Compiled instance of `keras.models.Model`, with
+        the metrics in `METRIC_NAMES`.
+    """
+
+    import keras
+
+    num_filters = hyperparameter_dict[NUM_CONV_FILTERS_KEY]
+    filter_size = (
+        hyperparameter_dict[FILTER_WIDTH_KEY],
+        hyperparameter_dict[FILTER_WIDTH_KEY]
+    )
+
+    input_layer_object = keras.layers.Input(shape=tuple(predictor_shape))
+    layer_object = keras.layers.Conv2D(
+        num_filters, filter_size, padding='same')(input_layer_object)
+    layer_object = keras.layers.LeakyReLU(alpha=0.2)(layer_object)
+    layer_object = keras.layers.Dropout(
+        hyperparameter_dict[CONV_DROPOUT_KEY])(layer_object)
+    layer_object = keras.layers.MaxPooling2D()(layer_object)
+    layer_object = keras.layers.BatchNormalization()(layer_object)
+
+    layer_object = keras.layers.Conv2D(
+        num_filters * 2, filter_size, padding='same')(layer_object)
+    layer_object = keras.layers.LeakyReLU(alpha=0.2)(layer_object)
+    layer_object = keras.layers.BatchNormalization()(layer_object)
+    layer_object = keras.layers.Dropout(
+        hyperparameter_dict[SECOND_CONV_DROPOUT_KEY])(layer_object)
+
+    layer_object = keras.layers.Flatten()(layer_object)
+    layer_object = keras.layers.Dense(100)(layer_object)
+    layer_object = keras.layers.LeakyReLU(alpha=0.2)(layer_object)
+    layer_object = keras.layers.BatchNormalization()(layer_object)
+    # Linear output, since targets are z-scores (see
+    # `utils.check_output_activation`).
+    layer_object = keras.layers.Dense(num_targets)(layer_object)
+
+    cnn_model_object = keras.models.Model(input_layer_object, layer_object)
+    cnn_model_object.compile(
+        keras.optimizers.Adam(lr=hyperparameter_dict[LEARNING_RATE_KEY]),
+        hyperparameter_dict[LOSS_FUNCTION_KEY], metrics=METRIC_NAMES)
+
+    return cnn_model_object
+
+
+def _get_pruning_callback(trial_id, rung_epochs, rung_score_dict, lock_object,
+                          val_scores, reduction_factor, selection_metric_name):
+    """Creates Keras callback that reports scores and prunes the trial.
+    :param trial_id: Trial ID.
+    :param rung_epochs: See doc for `get_rung_epochs`.
+    :param rung_score_dict: Shared dictionary (from `multiprocessing.Manager`)
+        with one list of validation scores per rung.
+    :param lock_object: Shared lock guarding `rung_score_dict`.
+    :param val_scores: List to which the validation score of each epoch is
+        appended.
+    :param reduction_factor: See doc for `get_rung_epochs`.
+    :param selection_metric_name: Name of metric (in `METRIC_NAMES`) used for
+        pruning.
+    :return: callback_object: Instance of `keras.callbacks.Callback`.
+    """
+
+    import keras
+
+    class PruningCallback(keras.callbacks.Callback):
+        """Stops training when the trial is pruned at a rung."""
+
+        pruned = False
+
+        def on_epoch_end(self, epoch, logs=None):
+            this_score = float((logs or {}).get(
+                'val_' + selection_metric_name, numpy.nan))
+            val_scores.append(this_score)
+
+            if epoch + 1 not in rung_epochs:
+                return
+
+            # Best score so far, so that one noisy epoch does not prune a trial.
+            this_score = float(numpy.nanmin(val_scores))
+
+            with lock_object:
+                these_scores = (
+                    rung_score_dict.get(epoch + 1, []) + [this_score]
+                )
+                rung_score_dict[epoch + 1] = these_scores
+
+            if should_prune(these_scores, this_score, reduction_factor):
+                print('Pruning trial {0:d} after {1:d} epochs...'.format(
+                    trial_id, epoch + 1))
+                self.pruned = True
+                self.model.stop_training = True
+
+    return PruningCallback()
+
+
+def set_thread_limits(num_threads):
+    """Limits threads used by numerical libraries in this worker process.
+    :param num_threads: Max number of threads.
+    """
+
+    for this_name in THREAD_ENV_VARIABLE_NAMES:
+        os.environ[this_name] = str(num_threads)
+
+
+def _run_trial(argument_dict):
+    """Runs one trial (in a worker process).
+    :param argument_dict: Dictionary with trial ID, hyperparameters and the
+        shared arguments of `run_search`.
+    :return: trial_result_dict: Dictionary with keys "trial_id",
+        "hyperparameters", "selection_metric_name", "best_val_score",
+        "val_scores", "num_epochs", "pruned", "wall_time_sec",
+        "model_file_name" and "error".
+    """
+
+    import utils
+
+    start_time_unix_sec = time.time()
+    trial_id = argument_dict[TRIAL_ID_KEY]
+    val_scores = []
+    selection_metric_name = argument_dict['selection_metric_name']
+    model_file_name = os.path.join(
+        argument_dict['output_dir_name'], 'trial{0:04d}.h5'.format(trial_id))
+
+    pruning_callback_object = _get_pruning_callback(
+        trial_id=trial_id, rung_epochs=argument_dict['rung_epochs'],
+        rung_score_dict=argument_dict['rung_score_dict'],
+        lock_object=argument_dict['lock_object'], val_scores=val_scores,
+        reduction_factor=argument_dict['reduction_factor'],
+        selection_metric_name=selection_metric_name)
+    error_string = None
+
+    try:
+        cnn_model_object = build_cnn(
+            hyperparameter_dict=argument_dict[HYPERPARAMETERS_KEY],
+            predictor_shape=argument_dict['predictor_shape'],
+            num_targets=argument_dict['num_targets'])
+
+        utils.train_cnn(
+            cnn_model_object=cnn_model_object,
+            training_file_names=argument_dict['training_file_names'],
+            normalization_dict=argument_dict['normalization_dict'],
+            normalization_dict_targ=argument_dict['normalization_dict_targ'],
+            num_examples_per_batch=argument_dict['num_examples_per_batch'],
+            num_epochs=argument_dict['max_epochs'],
+            num_training_batches_per_epoch=
+            argument_dict['num_training_batches_per_epoch'],
+            output_model_file_name=model_file_name,
+            validation_file_names=argument_dict['validation_file_names'],
+            num_validation_batches_per_epoch=None,
+            resident_validation=True,
+            callback_objects=[pruning_callback_object],
+            num_threads=argument_dict['num_threads_per_trial'])
+    except Exception as this_error:
+        error_string = '{0:s}: {1:s}'.format(
+            type(this_error).__name__, str(this_error))
+        print('Trial {0:d} failed ({1:s}).'.format(trial_id, error_string))
+
+    return {
+        TRIAL_ID_KEY: trial_id,
+        HYPERPARAMETERS_KEY: argument_dict[HYPERPARAMETERS_KEY],
+        SELECTION_METRIC_KEY: selection_metric_name,
+        BEST_VAL_SCORE_KEY:
+            float(numpy.nanmin(val_scores))
+            if numpy.any(numpy.isfinite(val_scores)) else None,
+        VAL_SCORES_KEY: val_scores,
+        NUM_EPOCHS_KEY: len(val_scores),
+        PRUNED_KEY: pruning_callback_object.pruned,
+        WALL_TIME_KEY: time.time() - start_time_unix_sec,
+        MODEL_FILE_KEY: model_file_name,
+        ERROR_KEY: error_string
+    }
+
+
+def sample_hyperparameters(search_space_dict, num_trials, random_seed=None):
+    """Samples distinct hyperparameter combinations.
+    :param search_space_dict: Dictionary with list of candidate values for each
+        hyperparameter.
+    :param num_trials: Number of combinations.  If this exceeds the size of the
+        grid, the whole grid is returned.
+    :param random_seed: Seed for random-number generator.
+    :return: hyperparameter_dicts: 1-D list of dictionaries.
+    """
+
+    random_object = random.Random(random_seed)
+    hyperparameter_names = sorted(search_space_dict.keys())
+    num_combinations = int(numpy.prod(
+        [len(search_space_dict[n]) for n in hyperparameter_names]
+    ))
+
+    hyperparameter_dicts = []
+    for this_index in random_object.sample(
+            range(num_combinations), min([num_trials, num_combinations])):
+        this_dict = {}
+
+        for this_name in hyperparameter_names:
+            these_values = search_space_dict[this_name]
+            this_dict[this_name] = these_values[this_index % len(these_values)]
+            this_index //= len(these_values)
+
+        hyperparameter_dicts.append(this_dict)
+
+    return hyperparameter_dicts
+
+
+def run_search(
+        training_file_names, validation_file_names, output_dir_name,
+        search_space_dict=None, num_trials=NUM_TRIALS,
+        num_parallel_trials=NUM_PARALLEL_TRIALS,
+        num_threads_per_trial=NUM_THREADS_PER_TRIAL, min_epochs=MIN_EPOCHS,
+        max_epochs=MAX_EPOCHS, reduction_factor=REDUCTION_FACTOR,
+        num_examples_per_batch=30, num_training_batches_per_epoch=None,
+        random_seed=None, selection_metric_name=SELECTION_METRIC_NAME):
+    """Runs parallel hyperparameter search with ASHA pruning.
+    Normalization params are computed once, here, and shared by all trials.
+    Each trial keeps the validation set in memory and scores all of it every
+    epoch (see `utils.ResidentValidationCallback`), so that pruning decisions
+    compare trials on the same data.
+    :param training_file_names: 1-D list of paths to training files.
+    :param validation_file_names: 1-D list of paths to validation files.
+    :param output_dir_name: Name of output directory (for trial models and the
+        leaderboard).
+    :param search_space_dict: See doc for `sample_hyperparameters`.  If None,
+        will use `DEFAULT_SEARCH_SPACE_DICT`.
+    :param num_trials: Number of trials.
+    :param num_parallel_trials: Number of trials run at once (processes).
+    :param num_threads_per_trial: Max number of threads per trial.
+    :param min_epochs: See doc for `get_rung_epochs`.
+    :param max_epochs: Same.
+    :param reduction_factor: Same.
+    :param num_examples_per_batch: See doc for `utils.train_cnn`.
+    :param num_training_batches_per_epoch: Same.  If None, one epoch is one
+        pass over the training examples.
+    :param random_seed: See doc for `sample_hyperparameters`.
+    :param selection_metric_name: Name of validation metric (in
+        `METRIC_NAMES`) used to prune and rank trials.  This is independent of
+        each trial's loss function.
+    :return: leaderboard: 1-D list of trial results (see doc for `_run_trial`),
+        best first.  This is also written to "leaderboard.json" in the output
+        directory.
+    :raises: ValueError: if `selection_metric_name` is not in `METRIC_NAMES`.
+    """
+
+    if selection_metric_name not in METRIC_NAMES:
+        error_string = (
+            'Selection metric ("{0:s}") must be in the following list:\n{1:s}'
+        ).format(selection_metric_name, str(METRIC_NAMES))
+        raise ValueError(error_string)
+
+    import utils
+
+    start_time_unix_sec = time.time()
+    if search_space_dict is None:
+        search_space_dict = DEFAULT_SEARCH_SPACE_DICT
+
+    normalization_dict, normalization_dict_targ = (
+        utils.get_image_normalization_params_chunked(
+            training_file_names, num_workers=num_parallel_trials)
+    )
+
+    if num_training_batches_per_epoch is None:
+        num_training_batches_per_epoch = max([
+            utils.count_samps(training_file_names) // num_examples_per_batch, 1
+        ])
+
+    image_dataset = utils.ImageDataset(validation_file_names[:1])
+    this_image_dict = image_dataset[0:1]
+    image_dataset.close()
+    predictor_shape = this_image_dict[utils.PREDICTOR_MATRIX_KEY].shape[1:]
+    num_targets = this_image_dict[utils.TARGET_MATRIX_KEY].shape[1]
+
+    utils._create_directory(directory_name=output_dir_name)
+    rung_epochs = get_rung_epochs(min_epochs, max_epochs, reduction_factor)
+    print('Trials may be pruned after epochs: {0:s}'.format(str(rung_epochs)))
+
+    # Workers are spawned (not forked), so TensorFlow starts fresh in each one
+    # with its thread limits already set.
+    context_object = multiprocessing.get_context('spawn')
+    manager_object = context_object.Manager()
+    rung_score_dict = manager_object.dict()
+    lock_object = manager_object.Lock()
+
+    argument_dicts = []
+    for i, this_hyperparameter_dict in enumerate(sample_hyperparameters(
+            search_space_dict, num_trials, random_seed)):
+        argument_dicts.append({
+            TRIAL_ID_KEY: i,
+            HYPERPARAMETERS_KEY: this_hyperparameter_dict,
+            'output_dir_name': output_dir_name,
+            'rung_epochs': rung_epochs,
+            'rung_score_dict': rung_score_dict,
+            'selection_metric_name': selection_metric_name,
+            'lock_object': lock_object,
+            'reduction_factor': reduction_factor,
+            'predictor_shape': predictor_shape,
+            'num_targets': num_targets,
+            'training_file_names': training_file_names,
+            'validation_file_names': validation_file_names,
+            'normalization_dict': normalization_dict,
+            'normalization_dict_targ': normalization_dict_targ,
+            'num_examples_per_batch': num_examples_per_batch,
+            'max_epochs': max_epochs,
+            'num_training_batches_per_epoch': num_training_batches_per_epoch,
+            'num_threads_per_trial': num_threads_per_trial
+        })
+
+    pool_object = context_object.Pool(
+        processes=num_parallel_trials, initializer=set_thread_limits,
+        initargs=(num_threads_per_trial,), maxtasksperchild=1)
+
+    leaderboard = []
+    try:
+        for this_result_dict in pool_object.imap_unordered(
+                _run_trial, argument_dicts):
+            print((
+                'Trial {0:d} done: best val {1:s} = {2:s}, epochs = {3:d}, '
+                'pruned = {4:s}, wall time = {5:.1f} s'
+            ).format(
+                this_result_dict[TRIAL_ID_KEY], selection_metric_name,
+                str(this_result_dict[BEST_VAL_SCORE_KEY]),
+                this_result_dict[NUM_EPOCHS_KEY],
+                str(this_result_dict[PRUNED_KEY]),
+                this_result_dict[WALL_TIME_KEY]
+            ))
+            leaderboard.append(this_result_dict)
+    finally:
+        pool_object.close()
+        pool_object.join()
+        manager_object.shutdown()
+
+    leaderboard.sort(key=lambda d: (
+        d[BEST_VAL_SCORE_KEY] is None, d[BEST_VAL_SCORE_KEY] or 0.
+    ))
+
+    leaderboard_file_name = os.path.join(output_dir_name, LEADERBOARD_FILE_NAME)
+    with open(leaderboard_file_name, 'w') as this_file:
+        json.dump(leaderboard, this_file, indent=1)
+
+    print('Search took {0:.1f} seconds.  Leaderboard written to "{1:s}".'.format(
+        time.time() - start_time_unix_sec, leaderboard_file_name))
+    return leaderboard
@@ -0,0 +1,681 @@
+"""NumPy-only forward pass for the CNNs trained with `utils.train_cnn`.
+
+This module does not import TensorFlow or Keras, so post-processing hosts can
+apply a trained model (saved as ".h5" by `keras.callbacks.ModelCheckpoint`)
+with only numpy and h5py installed.
+"""
+import json
+import subprocess
+import sys
+import time
+import h5py
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+INPUT_LAYER_TYPE = 'InputLayer'
+CONV_LAYER_TYPE = 'Conv2D'
+LEAKY_RELU_LAYER_TYPE = 'LeakyReLU'
+DROPOUT_LAYER_TYPE = 'Dropout'
+SPATIAL_DROPOUT_LAYER_TYPE = 'SpatialDropout2D'
+MAX_POOLING_LAYER_TYPE = 'MaxPooling2D'
+AVERAGE_POOLING_LAYER_TYPE = 'AveragePooling2D'
+BATCH_NORM_LAYER_TYPE = 'BatchNormalization'
+FLATTEN_LAYER_TYPE = 'Flatten'
+DENSE_LAYER_TYPE = 'Dense'
+ACTIVATION_LAYER_TYPE = 'Activation'
+
+# Layers that do nothing at inference time.
+IDENTITY_LAYER_TYPES = [
+    INPUT_LAYER_TYPE, DROPOUT_LAYER_TYPE, SPATIAL_DROPOUT_LAYER_TYPE
+]
+
+# Operation type for layers skipped at inference time (including batch
+# normalization that has been folded into the next Dense layer).
+NO_OP_TYPE = 'no_op'
+
+LINEAR_ACTIVATION_NAME = 'linear'
+RELU_ACTIVATION_NAME = 'relu'
+SIGMOID_ACTIVATION_NAME = 'sigmoid'
+TANH_ACTIVATION_NAME = 'tanh'
+
+LAYER_NAME_KEY = 'name'
+LAYER_TYPE_KEY = 'class_name'
+LAYER_CONFIG_KEY = 'config'
+WEIGHTS_KEY = 'weights'
+
+NUM_EXAMPLES_PER_BATCH = 1000
+
+KERAS_BACKEND_NAME = 'keras'
+NUMPY_BACKEND_NAME = 'numpy'
+COLD_START_TIME_KEY = 'cold_start_time_sec'
+THROUGHPUT_KEY = 'examples_per_second'
+MAX_DIFFERENCE_KEY = 'max_abs_difference'
+
+COLD_START_SCRIPT_BY_BACKEND = {
+    NUMPY_BACKEND_NAME: (
+        'import time; start_time = time.time(); import numpy, numpy_cnn; '
+        'model_object = numpy_cnn.read_model({0!r}); '
+        'model_object.predict(numpy.zeros((1,) + model_object.input_shape, '
+        'dtype=numpy.float32)); print(time.time() - start_time)'
+    ),
+    KERAS_BACKEND_NAME: (
+        'import time; start_time = time.time(); import numpy, keras; '
+        'model_object = keras.models.load_model({0!r}); '
+        'model_object.predict(numpy.zeros((1,) + '
+        'tuple(model_object.input_shape[1:]), dtype=numpy.float32)); '
+        'print(time.time() - start_time)'
+    )
+}
+
+
+def _apply_activation(input_matrix, activation_name):
+    """Applies activation function in place.
+    :param input_matrix: numpy array.
+    :param activation_name: Name of activation function (Keras convention).
+    :return: output_matrix: numpy array with the same shape.
+    :raises: ValueError: if activation function is not supported.
+    """
+
+    if activation_name == LINEAR_ACTIVATION_NAME:
+        return input_matrix
+    if activation_name == RELU_ACTIVATION_NAME:
+        return numpy.maximum(input_matrix, 0., out=input_matrix)
+    if activation_name == SIGMOID_ACTIVATION_NAME:
+        return 1. / (1. + numpy.exp(-input_matrix))
+    if activation_name == TANH_ACTIVATION_NAME:
+        return numpy.tanh(input_matrix, out=input_matrix)
+
+    error_string = 'Activation function "{0:s}" is not supported.'.format(
+        activation_name)
+    raise ValueError(error_string)
+
+
+def _get_same_padding(num_input_pixels, kernel_size, stride):
+    """Returns Keras/TensorFlow "same" padding along one axis.
+    :param num_input_pixels: Length of input along the axis.
+    :param kernel_size: Kernel size along the axis.
+    :param stride: Stride along the axis.
+    :return: padding_before: Number of zeros to add before.
+    :return: padding_after: Number of zeros to add after.
+    """
+
+    num_output_pixels = int(numpy.ceil(float(num_input_pixels) / stride))
+    total_padding = max([
+        (num_output_pixels - 1) * stride + kernel_size - num_input_pixels, 0
+    ])
+
+    return total_padding // 2, total_padding - total_padding // 2
+
+
+def _extract_patches(input_matrix, kernel_rows, kernel_columns, row_stride,
+                     column_stride):
+    """Extracts sliding-window patches without copying (stride tricks).
+    E = number of examples
+    M = number of output rows
+    N = number of output columns
+    C = number of channels
+    :param input_matrix: E-by-M_in-by-N_in-by-C numpy array (already padded).
+    :param kernel_rows: Number of rows in window.
+    :param kernel_columns: Number of columns in window.
+    :param row_stride: Stride between windows along rows.
+    :param column_stride: Stride between windows along columns.
+    :return: patch_matrix: Read-only view with shape
+        E x M x N x kernel_rows x kernel_columns x C.
+    """
+
+    num_examples, num_rows, num_columns, num_channels = input_matrix.shape
+    num_output_rows = (num_rows - kernel_rows) // row_stride + 1
+    num_output_columns = (num_columns - kernel_columns) // column_stride + 1
+    strides = input_matrix.strides
+
+    return as_strided(
+        input_matrix,
+        shape=(num_examples, num_output_rows, num_output_columns,
+               kernel_rows, kernel_columns, num_channels),
+        strides=(strides[0], strides[1] * row_stride,
+                 strides[2] * column_stride, strides[1], strides[2],
+                 strides[3]),
+        writeable=False
+    )
+
+
+def _read_layer_list(hdf5_file_name):
+    """Reads layer configs and weights from a Keras HDF5 file.
+    :param hdf5_file_name: Path to model file (saved by Keras).
+    :return: layer_dicts: 1-D list of dictionaries (one per layer, in order),
+        each with keys "name", "class_name", "config" and "weights" (1-D list
+        of numpy arrays, in Keras order).
+    :raises: ValueError: if the model is not a simple chain of layers.
+    """
+
+    with h5py.File(hdf5_file_name, 'r') as hdf5_file_object:
+        model_config = hdf5_file_object.attrs['model_config']
+        if isinstance(model_config, bytes):
+            model_config = model_config.decode('utf-8')
+        model_config = json.loads(model_config)[LAYER_CONFIG_KEY]
+
+        if isinstance(model_config, dict):
+            layer_configs = model_config['layers']
+        else:
+            layer_configs = model_config
+
+        if 'model_weights' in hdf5_file_object:
+            weight_group_object = hdf5_file_object['model_weights']
+        else:
+            weight_group_object = hdf5_file_object
+
+        layer_dicts = []
+
+        for i in range(len(layer_configs)):
+            this_name = layer_configs[i][LAYER_CONFIG_KEY][LAYER_NAME_KEY]
+            these_inbound_nodes = layer_configs[i].get('inbound_nodes', [])
+
+            if i > 0 and len(these_inbound_nodes) > 0:
+                these_inbound_names = [
+                    n[0] for n in these_inbound_nodes[0]
+                ]
+
+                if these_inbound_names != [layer_dicts[-1][LAYER_NAME_KEY]]:
+                    error_string = (
+                        'Layer "{0:s}" does not take its input from the '
+                        'previous layer.  Only simple chains are supported.'
+                    ).format(this_name)
+                    raise ValueError(error_string)
+
+            these_weights = []
+            if this_name in weight_group_object:
+                this_layer_object = weight_group_object[this_name]
+
+                for this_weight_name in this_layer_object.attrs['weight_names']:
+                    if isinstance(this_weight_name, bytes):
+                        this_weight_name = this_weight_name.decode('utf-8')
+
+                    these_weights.append(numpy.array(
+                        this_layer_object[this_weight_name], dtype=numpy.float32
+                    ))
+
+            layer_dicts.append({
+                LAYER_NAME_KEY: this_name,
+                LAYER_TYPE_KEY: layer_configs[i][LAYER_TYPE_KEY],
+                LAYER_CONFIG_KEY: layer_configs[i][LAYER_CONFIG_KEY],
+                WEIGHTS_KEY: these_weights
+            })
+
+    return layer_dicts
+
+
+def _get_batch_norm_affine(layer_dict):
+    """Converts inference-time batch normalization to scale and shift.
+    :param layer_dict: Dictionary for one BatchNormalization layer (see
+        `_read_layer_list`).
+    :return: scale_vector: 1-D numpy array of multipliers (one per channel).
+    :return: shift_vector: 1-D numpy array of offsets (one per channel).
+    """
+
+    config_dict = layer_dict[LAYER_CONFIG_KEY]
+    weights = list(layer_dict[WEIGHTS_KEY])
+    num_channels = weights[-1].size
+
+    gamma_vector = (
+        weights.pop(0) if config_dict.get('scale', True)
+        else numpy.ones(num_channels, dtype=numpy.float32)
+    )
+    beta_vector = (
+        weights.pop(0) if config_dict.get('center', True)
+        else numpy.zeros(num_channels, dtype=numpy.float32)
+    )
+    moving_mean_vector, moving_variance_vector = weights
+
+    scale_vector = gamma_vector / numpy.sqrt(
+        moving_variance_vector + config_dict['epsilon'])
+    shift_vector = beta_vector - moving_mean_vector * scale_vector
+
+    return scale_vector, shift_vector
+
+
+class NumpyCNN(object):
+    """Inference-only CNN, evaluated with vectorized numpy.
+    Supported layers: Conv2D, Dense, LeakyReLU, Activation, MaxPooling2D,
+    AveragePooling2D, BatchNormalization, Flatten and (as no-ops) Dropout and
+    InputLayer.  A BatchNormalization layer followed (possibly through Dropout
+    or Flatten) by a Dense layer is folded into that layer's weights; other
+    BatchNormalization layers become one multiply-add per channel.
+    """
+
+    def __init__(self, layer_dicts, input_shape):
+        """Creates model.
+        :param layer_dicts: 1-D list of dictionaries created by
+            `_read_layer_list`.
+        :param input_shape: Shape of one example (M x N x C).
+        """
+
+        self.input_shape = tuple(input_shape)
+        self.layer_names = [d[LAYER_NAME_KEY] for d in layer_dicts]
+        self.operations = self._compile(layer_dicts)
+
+    def _compile(self, layer_dicts):
+        """Converts layer configs to a list of forward-pass operations.
+        :param layer_dicts: See doc for `__init__`.
+        :return: operations: 1-D list of tuples (layer_name, operation_type,
+            parameter_dict).
+        :raises: ValueError: if a layer type is not supported.
+        """
+
+        operations = []
+        pending_affine = None
+
+        for i in range(len(layer_dicts)):
+            this_name = layer_dicts[i][LAYER_NAME_KEY]
+            this_type = layer_dicts[i][LAYER_TYPE_KEY]
+            this_config = layer_dicts[i][LAYER_CONFIG_KEY]
+            these_weights = layer_dicts[i][WEIGHTS_KEY]
+
+            if this_type in IDENTITY_LAYER_TYPES:
+                operations.append((this_name, NO_OP_TYPE, {}))
+                continue
+
+            if this_type == FLATTEN_LAYER_TYPE:
+                operations.append((this_name, this_type, {}))
+                continue
+
+            if this_type == BATCH_NORM_LAYER_TYPE:
+                this_scale_vector, this_shift_vector = _get_batch_norm_affine(
+                    layer_dicts[i])
+
+                # Look ahead: fold into the next Dense layer if only no-op or
+                # Flatten layers are in between.
+                j = i + 1
+                while (j < len(layer_dicts) and layer_dicts[j][LAYER_TYPE_KEY]
+                       in IDENTITY_LAYER_TYPES + [FLATTEN_LAYER_TYPE]):
+                    j += 1
+
+                if (j < len(layer_dicts) and
+                        layer_dicts[j][LAYER_TYPE_KEY] == DENSE_LAYER_TYPE):
+                    pending_affine = (this_scale_vector, this_shift_vector)
+                    operations.append((this_name, NO_OP_TYPE, {}))
+                else:
+                    operations.append((this_name, BATCH_NORM_LAYER_TYPE, {
+                        'scale': this_scale_vector, 'shift': this_shift_vector
+                    }))
+
+                continue
+
+            if this_type == DENSE_LAYER_TYPE:
+                this_kernel_matrix = these_weights[0]
+                this_bias_vector = (
+                    these_weights[1] if this_config.get('use_bias', True)
+                    else numpy.zeros(this_kernel_matrix.shape[1],
+                                     dtype=numpy.float32)
+                )
+
+                if pending_affine is not None:
+                    # Channels are the last axis of the flattened input, so
+                    # tile the per-channel scale/shift over the input length.
+                    this_num_repeats = (
+                        this_kernel_matrix.shape[0] // pending_affine[0].size
+                    )
+                    this_scale_vector = numpy.tile(
+                        pending_affine[0], this_num_repeats)
+                    this_shift_vector = numpy.tile(
+                        pending_affine[1], this_num_repeats)
+
+                    this_bias_vector = (
+                        this_bias_vector +
+                        numpy.dot(this_shift_vector, this_kernel_matrix)
+                    )
+                    this_kernel_matrix = (
+                        this_kernel_matrix * this_scale_vector[:, numpy.newaxis]
+                    )
+                    pending_affine = None
+
+                operations.append((this_name, this_type, {
+                    'kernel': this_kernel_matrix.astype(numpy.float32),
+                    'bias': this_bias_vector.astype(numpy.float32),
+                    'activation': this_config.get(
+                        'activation', LINEAR_ACTIVATION_NAME)
+                }))
+                continue
+
+            if this_type == CONV_LAYER_TYPE:
+                if this_config.get('data_format') == 'channels_first':
+                    error_string = (
+                        'Layer "{0:s}" uses channels_first, which is not '
+                        'supported.'
+                    ).format(this_name)
+                    raise ValueError(error_string)
+
+                if tuple(this_config.get('dilation_rate', (1, 1))) != (1, 1):
+                    error_string = (
+                        'Layer "{0:s}" uses dilation, which is not supported.'
+                    ).format(this_name)
+                    raise ValueError(error_string)
+
+                this_kernel_matrix = these_weights[0]
+                operations.append((this_name, this_type, {
+                    'kernel': this_kernel_matrix,
+                    'bias': (
+                        these_weights[1] if this_config.get('use_bias', True)
+                        else numpy.zeros(this_kernel_matrix.shape[-1],
+                                         dtype=numpy.float32)
+                    ),
+                    'strides': tuple(this_config['strides']),
+                    'padding': this_config['padding'],
+                    'activation': this_config.get(
+                        'activation', LINEAR_ACTIVATION_NAME)
+                }))
+                continue
+
+            if this_type in [MAX_POOLING_LAYER_TYPE,
+                             AVERAGE_POOLING_LAYER_TYPE]:
+                operations.append((this_name, this_type, {
+                    'pool_size': tuple(this_config['pool_size']),
+                    'strides': tuple(this_config['strides']),
+                    'padding': this_config['padding']
+                }))
+                continue
+
+            if this_type == LEAKY_RELU_LAYER_TYPE:
+                operations.append((this_name, this_type, {
+                    'alpha': numpy.float32(this_config['alpha'])
+                }))
+                continue
+
+            if this_type == ACTIVATION_LAYER_TYPE:
+                operations.append((this_name, this_type, {
+                    'activation': this_config['activation']
+                }))
+                continue
+
+            error_string = 'Layer type "{0:s}" is not supported.'.format(
+                this_type)
+            raise ValueError(error_string)
+
+        return operations
+
+    @staticmethod
+    def _apply_conv(input_matrix, parameter_dict):
+        """Applies Conv2D layer (im2col via stride tricks, then one GEMM).
+        :param input_matrix: E-by-M-by-N-by-C numpy array.
+        :param parameter_dict: Parameters created by `_compile`.
+        :return: output_matrix: E-by-M'-by-N'-by-F numpy array.
+        """
+
+        kernel_matrix = parameter_dict['kernel']
+        kernel_rows, kernel_columns = kernel_matrix.shape[:2]
+        row_stride, column_stride = parameter_dict['strides']
+
+        if parameter_dict['padding'] == 'same':
+            these_row_pads = _get_same_padding(
+                input_matrix.shape[1], kernel_rows, row_stride)
+            these_column_pads = _get_same_padding(
+                input_matrix.shape[2], kernel_columns, column_stride)
+            input_matrix = numpy.pad(
+                input_matrix,
+                ((0, 0), these_row_pads, these_column_pads, (0, 0)),
+                mode='constant')
+
+        patch_matrix = _extract_patches(
+            input_matrix, kernel_rows, kernel_columns, row_stride,
+            column_stride)
+        output_matrix = numpy.tensordot(
+            patch_matrix, kernel_matrix, axes=([3, 4, 5], [0, 1, 2]))
+        output_matrix += parameter_dict['bias']
+
+        return _apply_activation(output_matrix, parameter_dict['activation'])
+
+    @staticmethod
+    def _apply_pooling(input_matrix, parameter_dict, use_max):
+        """Applies MaxPooling2D or AveragePooling2D layer.
+        :param input_matrix: E-by-M-by-N-by-C numpy array.
+        :param parameter_dict: Parameters created by `_compile`.
+        :param use_max: Boolean flag.  If True, max pooling; if False, average.
+        :return: output_matrix: Pooled numpy array.
+        :raises: ValueError: if padding is not "valid".
+        """
+
+        if parameter_dict['padding'] != 'valid':
+            raise ValueError('Only "valid" padding is supported for pooling.')
+
+        pool_rows, pool_columns = parameter_dict['pool_size']
+        row_stride, column_stride = parameter_dict['strides']
+
+        if (pool_rows, pool_columns) == (row_stride, column_stride):
+            # Non-overlapping windows: crop and reshape, no patch copy.
+            num_output_rows = input_matrix.shape[1] // pool_rows
+            num_output_columns = input_matrix.shape[2] // pool_columns
+            window_matrix = input_matrix[
+                :, :num_output_rows * pool_rows,
+                :num_output_columns * pool_columns, :
+            ].reshape(
+                input_matrix.shape[0], num_output_rows, pool_rows,
+                num_output_columns, pool_columns, input_matrix.shape[3]
+            )
+            reduction_axes = (2, 4)
+        else:
+            window_matrix = _extract_patches(
+                input_matrix, pool_rows, pool_columns, row_stride,
+                column_stride)
+            reduction_axes = (3, 4)
+
+        if use_max:
+            return window_matrix.max(axis=reduction_axes)
+
+        return window_matrix.mean(axis=reduction_axes)
+
+    def _forward(self, predictor_matrix, output_layer_names):
+        """Runs forward pass on one batch.
+        :param predictor_matrix: E-by-M-by-N-by-C numpy array.
+        :param output_layer_names: 1-D list of layers whose outputs are
+            returned.
+        :return: output_matrices: 1-D list of numpy arrays (one per layer in
+            `output_layer_names`).
+        """
+
+        output_matrix_by_layer = {}
+        layer_matrix = predictor_matrix.astype(numpy.float32)
+
+        for this_name, this_type, this_parameter_dict in self.operations:
+            if this_type == CONV_LAYER_TYPE:
+                layer_matrix = self._apply_conv(
+                    layer_matrix, this_parameter_dict)
+            elif this_type == DENSE_LAYER_TYPE:
+                layer_matrix = numpy.dot(
+                    layer_matrix, this_parameter_dict['kernel'])
+                layer_matrix += this_parameter_dict['bias']
+                layer_matrix = _apply_activation(
+                    layer_matrix, this_parameter_dict['activation'])
+            elif this_type == FLATTEN_LAYER_TYPE:
+                layer_matrix = numpy.reshape(
+                    layer_matrix, (layer_matrix.shape[0], -1))
+            elif this_type == BATCH_NORM_LAYER_TYPE:
+                layer_matrix = (
+                    layer_matrix * this_parameter_dict['scale'] +
+                    this_parameter_dict['shift']
+                )
+            elif this_type == LEAKY_RELU_LAYER_TYPE:
+                layer_matrix = numpy.where(
+                    layer_matrix > 0, layer_matrix,
+                    this_parameter_dict['alpha'] * layer_matrix)
+            elif this_type == ACTIVATION_LAYER_TYPE:
+                layer_matrix = _apply_activation(
+                    layer_matrix, this_parameter_dict['activation'])
+            elif this_type in [MAX_POOLING_LAYER_TYPE,
+                               AVERAGE_POOLING_LAYER_TYPE]:
+                layer_matrix = self._apply_pooling(
+                    layer_matrix, this_parameter_dict,
+                    use_max=this_type == MAX_POOLING_LAYER_TYPE)
+
+            if this_name in output_layer_names:
+                output_matrix_by_layer[this_name] = layer_matrix
+
+            if len(output_matrix_by_layer) == len(output_layer_names):
+                break
+
+        return [output_matrix_by_layer[n] for n in output_layer_names]
+
+    def predict(self, predictor_matrix, batch_size=NUM_EXAMPLES_PER_BATCH,
+                output_layer_name=None):
+        """Applies model to new data.
+        E = number of examples
+        :param predictor_matrix: E-by-M-by-N-by-C numpy array of normalized
+            predictor values (see `utils.normalize_images`).
+        :param batch_size: Number of examples per batch.
+        :param output_layer_name: Name of layer whose output is returned.  If
+            None, will use the last layer (so return predictions).  Layers
+            whose batch normalization was folded into the next Dense layer
+            return their pre-normalization output.
+        :return: output_matrix: numpy array (float32) whose first axis has
+            length E.
+        """
+
+        if output_layer_name is None:
+            output_layer_name = self.layer_names[-1]
+
+        if output_layer_name not in self.layer_names:
+            error_string = 'Cannot find layer "{0:s}".'.format(
+                output_layer_name)
+            raise ValueError(error_string)
+
+        num_examples = predictor_matrix.shape[0]
+        output_matrix = None
+
+        for i in range(0, num_examples, batch_size):
+            this_output_matrix = self._forward(
+                predictor_matrix[i:(i + batch_size), ...],
+                [output_layer_name]
+            )[0]
+
+            if output_matrix is None:
+                output_matrix = numpy.empty(
+                    (num_examples,) + this_output_matrix.shape[1:],
+                    dtype=numpy.float32)
+
+            output_matrix[i:(i + this_output_matrix.shape[0]), ...] = (
+                this_output_matrix)
+
+        return output_matrix
+
+
+def read_model(hdf5_file_name):
+    """Reads model from Keras HDF5 file into a `NumpyCNN`.
+    :param hdf5_file_name: Path to input file (e.g., "models/TEST_GPU.h5").
+    :return: model_object: Instance of `NumpyCNN`.
+    """
+
+    layer_dicts = _read_layer_list(hdf5_file_name)
+    first_config = layer_dicts[0][LAYER_CONFIG_KEY]
+    input_shape = tuple(first_config['batch_input_shape'][1:])
+
+    return NumpyCNN(layer_dicts, input_shape)
+
+
+def _get_cold_start_time(hdf5_file_name, backend_name):
+    """Measures import + load + first prediction in a fresh interpreter.
+    :param hdf5_file_name: Path to model file.
+    :param backend_name: Either "numpy" or "keras".
+    :return: cold_start_time_sec: Wall time in seconds.
+    """
+
+    script_string = COLD_START_SCRIPT_BY_BACKEND[backend_name].format(
+        hdf5_file_name)
+    output_string = subprocess.check_output(
+        [sys.executable, '-c', script_string]
+    ).decode('utf-8')
+
+    return float(output_string.strip().split('\n')[-1])
+
+
+def _get_throughput(predict_function, predictor_matrix, num_repeats):
+    """Measures forward-pass throughput.
+    :param predict_function: Function that takes a predictor matrix.
+    :param predictor_matrix: E-by-M-by-N-by-C numpy array.
+    :param num_repeats: Number of timed repeats (after one warm-up call).
+    :return: examples_per_second: Best throughput over all repeats.
+    """
+
+    predict_function(predictor_matrix)
+    best_time_sec = numpy.inf
+
+    for _ in range(num_repeats):
+        this_start_time = time.time()
+        predict_function(predictor_matrix)
+        best_time_sec = min([best_time_sec, time.time() - this_start_time])
+
+    return predictor_matrix.shape[0] / best_time_sec
+
+
+def benchmark_backends(hdf5_file_name, predictor_matrix=None, num_examples=1000,
+                       num_repeats=5, batch_size=NUM_EXAMPLES_PER_BATCH,
+                       include_keras=True):
+    """Compares NumPy and Keras inference: accuracy, cold start, throughput.
+    Cold-start times are measured in fresh interpreters, so they include
+    importing the backend.
+    :param hdf5_file_name: Path to model file.
+    :param predictor_matrix: E-by-M-by-N-by-C numpy array of normalized
+        predictors.  If None, will use random z-scores.
+    :param num_examples: [used only if `predictor_matrix is None`]
+        Number of random examples.
+    :param num_repeats: Number of timed repeats for throughput.
+    :param batch_size: Number of examples per batch.
+    :param include_keras: Boolean flag.  If False, only the NumPy backend is
+        timed.
+    :return: result_dict: Dictionary with keys "numpy" and (if
+        `include_keras = True`) "keras", each a dictionary with keys
+        "cold_start_time_sec" and "examples_per_second".  If Keras is
+        included, also has key "max_abs_difference" (max absolute difference
+        between NumPy and Keras predictions).
+    """
+
+    numpy_model_object = read_model(hdf5_file_name)
+
+    if predictor_matrix is None:
+        predictor_matrix = numpy.random.normal(
+            size=(num_examples,) + numpy_model_object.input_shape
+        ).astype(numpy.float32)
+
+    result_dict = {
+        NUMPY_BACKEND_NAME: {
+            COLD_START_TIME_KEY: _get_cold_start_time(
+                hdf5_file_name, NUMPY_BACKEND_NAME),
+            THROUGHPUT_KEY: _get_throughput(
+                lambda x: numpy_model_object.predict(x, batch_size=batch_size),
+                predictor_matrix, num_repeats)
+        }
+    }
+
+    if include_keras:
+        import keras
+
+        keras_model_object = keras.models.load_model(hdf5_file_name)
+        result_dict[KERAS_BACKEND_NAME] = {
+            COLD_START_TIME_KEY: _get_cold_start_time(
+                hdf5_file_name, KERAS_BACKEND_NAME),
+            THROUGHPUT_KEY: _get_throughput(
+                lambda x: keras_model_object.predict(x, batch_size=batch_size),
+                predictor_matrix, num_repeats)
+        }
+
+        result_dict[MAX_DIFFERENCE_KEY] = numpy.max(numpy.absolute(
+            numpy_model_object.predict(predictor_matrix, batch_size=batch_size)
+            - keras_model_object.predict(predictor_matrix,
+                                         batch_size=batch_size)
+        ))
+
+    for this_backend_name in [NUMPY_BACKEND_NAME, KERAS_BACKEND_NAME]:
+        if this_backend_name not in result_dict:
+            continue
+
+        print((
+            '{0:s}: cold start = {1:.2f} s, throughput = {2:.1f} examples/s'
+        ).format(
+            this_backend_name,
+            result_dict[this_backend_name][COLD_START_TIME_KEY],
+            result_dict[this_backend_name][THROUGHPUT_KEY]
+        ))
+
+    if MAX_DIFFERENCE_KEY in result_dict:
+        print('Max absolute difference between backends = {0:.4e}'.format(
+            result_dict[MAX_DIFFERENCE_KEY]
+        ))
+
+    return result_dict
@@ -0,0 +1,686 @@
+"""Stage-memoized pipeline for the end-to-end workflow.
+
+The workflow (file discovery, normalization params, sample counting, training,
+inference, denormalization, NetCDF output and verification) is a DAG of
+stages.  Each stage's key is a hash of its name, parameters and the content
+hashes of its inputs, and its output is stored under that key, so a rebuild
+only reruns stages whose inputs or parameters changed.  Stages whose inputs are
+ready run concurrently.
+
+Usage: python pipeline.py config.json
+"""
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os.path
+import pickle
+import time
+import netCDF4
+import numpy
+import utils
+import verification
+
+ARTIFACT_DIR_NAME = 'pipeline_artifacts'
+ARTIFACT_FILE_EXTENSION = '.p'
+FILE_HASH_CACHE_NAME = 'file_hashes.json'
+MANAGED_OUTPUTS_FILE_NAME = 'managed_outputs.json'
+NUM_WORKERS = 4
+
+OUTPUT_KEY = 'output'
+OUTPUT_HASH_KEY = 'output_hash'
+STAGE_KEY_KEY = 'stage_key'
+
+DISCOVER_TRAINING_STAGE = 'discover_training'
+DISCOVER_VALIDATION_STAGE = 'discover_validation'
+DISCOVER_TEST_STAGE = 'discover_test'
+NORMALIZATION_STAGE = 'normalization'
+COUNT_SAMPLES_STAGE = 'count_samples'
+TRAINING_STAGE = 'training'
+INFERENCE_STAGE = 'inference'
+DENORMALIZATION_STAGE = 'denormalization'
+OUTPUT_STAGE = 'netcdf_output'
+VERIFICATION_STAGE = 'verification'
+
+# Configuration keys (see `build_default_pipeline`).
+TRAINING_DIR_KEY = 'training_dir_name'
+VALIDATION_DIR_KEY = 'validation_dir_name'
+TEST_DIR_KEY = 'test_dir_name'
+FILE_PATTERN_KEY = 'file_pattern'
+INITIAL_MODEL_FILE_KEY = 'initial_model_file_name'
+OUTPUT_MODEL_FILE_KEY = 'output_model_file_name'
+NUM_EXAMPLES_PER_BATCH_KEY = 'num_examples_per_batch'
+NUM_EPOCHS_KEY = 'num_epochs'
+NUM_TRAINING_BATCHES_KEY = 'num_training_batches_per_epoch'
+NUM_VALIDATION_BATCHES_KEY = 'num_validation_batches_per_epoch'
+POST_PROCESSED_FILE_KEY = 'post_processed_file_name'
+OVERWRITE_OUTPUT_KEY = 'overwrite_output'
+
+DEFAULT_CONFIG_DICT = {
+    TRAINING_DIR_KEY: 'train',
+    VALIDATION_DIR_KEY: 'validation',
+    TEST_DIR_KEY: 'test',
+    FILE_PATTERN_KEY: 'input*.nc',
+    INITIAL_MODEL_FILE_KEY: None,
+    OUTPUT_MODEL_FILE_KEY: 'models/pipeline_cnn.h5',
+    NUM_EXAMPLES_PER_BATCH_KEY: 256,
+    NUM_EPOCHS_KEY: 100,
+    NUM_TRAINING_BATCHES_KEY: None,
+    NUM_VALIDATION_BATCHES_KEY: None,
+    POST_PROCESSED_FILE_KEY:
+        'PostProcessOutput/Italy_PostProcessed_pipeline.nc',
+    OVERWRITE_OUTPUT_KEY: False
+}
+
+
+class Stage(object):
+    """One stage (node) of the pipeline."""
+
+    def __init__(self, name, function, dependency_names=None, param_dict=None,
+                 output_param_names=None, always_run=False):
+        """Creates stage.
+        :param name: Stage name (unique within the pipeline).
+        :param function: Function that runs the stage.  It is called with the
+            parameters in `param_dict` plus one keyword argument per dependency
+            (named after the dependency, holding its output).  It must return
+            a picklable object.
+        :param dependency_names: 1-D list of stages whose outputs are needed.
+        :param param_dict: Dictionary of JSON-serializable parameters.  Paths
+            to existing files are hashed by content (see `_update_hash`), so
+            the stage reruns when an input file changes.
+        :param output_param_names: 1-D list of keys in `param_dict` that name
+            files written by the stage.  These are hashed as plain strings, so
+            the key does not change once the files exist.
+        :param always_run: Boolean flag.  If True, the stage is never skipped
+            (use for stages, like file discovery, whose inputs are not known in
+            advance).  Downstream stages are still skipped if its output did
+            not change.
+        """
+
+        self.name = name
+        self.function = function
+        self.dependency_names = (
+            [] if dependency_names is None else list(dependency_names)
+        )
+        self.param_dict = {} if param_dict is None else param_dict
+        self.output_param_names = (
+            [] if output_param_names is None else list(output_param_names)
+        )
+        self.always_run = always_run
+
+
+class _FileHasher(object):
+    """Computes file-content hashes, reusing them while files are unchanged.
+    Hashes are remembered by (path, size, modification time) in a JSON file, so
+    large files are only read again after they change.
+    """
+
+    def __init__(self, cache_file_name):
+        """Creates hasher.
+        :param cache_file_name: Path to JSON file with remembered hashes.
+        """
+
+        self.cache_file_name = cache_file_name
+        self.hash_dict = {}
+
+        if os.path.isfile(cache_file_name):
+            with open(cache_file_name) as this_file:
+                self.hash_dict = json.load(this_file)
+
+    def get_hash(self, file_name):
+        """Returns content hash of one file.
+        :param file_name: Path to file.
+        :return: hash_string: Hexadecimal hash.
+        """
+
+        file_name = os.path.abspath(file_name)
+        this_stat = os.stat(file_name)
+        this_signature = [this_stat.st_size, this_stat.st_mtime]
+
+        if file_name in self.hash_dict:
+            if self.hash_dict[file_name][0] == this_signature:
+                return self.hash_dict[file_name][1]
+
+        hash_string = utils.get_file_hash(file_name)
+        self.hash_dict[file_name] = [this_signature, hash_string]
+        return hash_string
+
+    def write(self):
+        """Writes remembered hashes to the JSON file."""
+
+        utils._create_directory(file_name=self.cache_file_name)
+        with open(self.cache_file_name, 'w') as this_file:
+            json.dump(self.hash_dict, this_file)
+
+
+def _update_hash(hash_object, value, file_hasher):
+    """Adds one value (recursively) to a hash.
+    Strings naming existing files are hashed by file contents, so a stage whose
+    output is a file path (e.g., the trained model) changes hash whenever the
+    file changes.
+    :param hash_object: Instance of `hashlib.sha256`.
+    :param value: Value to add (nested dicts, lists, tuples, numpy arrays,
+        strings and numbers are supported; anything else is pickled).
+    :param file_hasher: Instance of `_FileHasher`.
+    """
+
+    if isinstance(value, dict):
+        hash_object.update(b'dict')
+        for this_key in sorted(value.keys(), key=str):
+            _update_hash(hash_object, str(this_key), file_hasher)
+            _update_hash(hash_object, value[this_key], file_hasher)
+    elif isinstance(value, (list, tuple)):
+        hash_object.update(b'list')
+        for this_value in value:
+            _update_hash(hash_object, this_value, file_hasher)
+    elif isinstance(value, numpy.ndarray):
+        hash_object.update(
+            '{0:s}{1:s}'.format(str(value.dtype), str(value.shape)).encode(
+                'utf-8'))
+        hash_object.update(numpy.ascontiguousarray(value).tobytes())
+    elif isinstance(value, str):
+        hash_object.update(value.encode('utf-8'))
+        if os.path.isfile(value):
+            hash_object.update(file_hasher.get_hash(value).encode('utf-8'))
+    else:
+        hash_object.update(pickle.dumps(value))
+
+
+def _get_hash(value, file_hasher):
+    """Returns hash of one value.
+    :param value: See doc for `_update_hash`.
+    :param file_hasher: Same.
+    :return: hash_string: Hexadecimal hash.
+    """
+
+    hash_object = hashlib.sha256()
+    _update_hash(hash_object, value, file_hasher)
+    return hash_object.hexdigest()
+
+
+class Pipeline(object):
+    """DAG of stages with content-hashed, memoized artifacts."""
+
+    def __init__(self, artifact_dir_name=ARTIFACT_DIR_NAME):
+        """Creates empty pipeline.
+        :param artifact_dir_name: Name of directory where stage outputs are
+            stored.
+        """
+
+        self.artifact_dir_name = artifact_dir_name
+        self.stage_dict = {}
+
+    def add_stage(self, stage_object):
+        """Adds stage to pipeline.
+        :param stage_object: Instance of `Stage`.
+        :raises: ValueError: if a stage with the same name exists or a
+            dependency has not been added yet (which also rules out cycles).
+        """
+
+        if stage_object.name in self.stage_dict:
+            error_string = 'Stage "{0:s}" already exists.'.format(
+                stage_object.name)
+            raise ValueError(error_string)
+
+        for this_name in stage_object.dependency_names:
+            if this_name not in self.stage_dict:
+                error_string = (
+                    'Dependency "{0:s}" of stage "{1:s}" has not been added.'
+                ).format(this_name, stage_object.name)
+                raise ValueError(error_string)
+
+        self.stage_dict[stage_object.name] = stage_object
+
+    @staticmethod
+    def _get_stage_key(stage_object, dependency_hashes, file_hasher):
+        """Returns stage key.
+        :param stage_object: Instance of `Stage`.
+        :param dependency_hashes: 1-D list with output hash of each dependency.
+        :param file_hasher: Instance of `_FileHasher`.
+        :return: stage_key: Hexadecimal hash.
+        """
+
+        input_param_dict = dict([
+            (k, v) for k, v in stage_object.param_dict.items()
+            if k not in stage_object.output_param_names
+        ])
+        output_param_dict = dict([
+            (k, v) for k, v in stage_object.param_dict.items()
+            if k in stage_object.output_param_names
+        ])
+
+        hash_object = hashlib.sha256()
+        _update_hash(
+            hash_object,
+            [stage_object.name, input_param_dict] + list(dependency_hashes),
+            file_hasher)
+        hash_object.update(
+            json.dumps(output_param_dict, sort_keys=True).encode('utf-8'))
+        return hash_object.hexdigest()
+
+    def _get_artifact_file_name(self, stage_name, stage_key):
+        """Returns path to artifact file.
+        :param stage_name: Stage name.
+        :param stage_key: Stage key.
+        :return: artifact_file_name: Path to artifact file.
+        """
+
+        return os.path.join(self.artifact_dir_name, '{0:s}-{1:s}{2:s}'.format(
+            stage_name, stage_key, ARTIFACT_FILE_EXTENSION))
+
+    def _run_stage(self, stage_object, input_dict, stage_key, file_hasher):
+        """Runs one stage and stores its output.
+        :param stage_object: Instance of `Stage`.
+        :param input_dict: Dictionary with output of each dependency.
+        :param stage_key: Stage key.
+        :param file_hasher: Instance of `_FileHasher`.
+        :return: artifact_dict: Dictionary with keys "output", "output_hash"
+            and "stage_key".
+        """
+
+        print('Running stage "{0:s}"...'.format(stage_object.name))
+        start_time_unix_sec = time.time()
+
+        argument_dict = dict(stage_object.param_dict)
+        argument_dict.update(input_dict)
+        output_object = stage_object.function(**argument_dict)
+
+        artifact_dict = {
+            OUTPUT_KEY: output_object,
+            OUTPUT_HASH_KEY: _get_hash(output_object, file_hasher),
+            STAGE_KEY_KEY: stage_key
+        }
+
+        artifact_file_name = self._get_artifact_file_name(
+            stage_object.name, stage_key)
+        temp_file_name = '{0:s}.{1:d}.tmp'.format(
+            artifact_file_name, os.getpid())
+
+        with open(temp_file_name, 'wb') as this_file:
+            pickle.dump(artifact_dict, this_file)
+        os.replace(temp_file_name, artifact_file_name)
+
+        print('Stage "{0:s}" took {1:.1f} seconds.'.format(
+            stage_object.name, time.time() - start_time_unix_sec))
+        return artifact_dict
+
+    def run(self, num_workers=NUM_WORKERS, forced_stage_names=None):
+        """Runs the pipeline, skipping stages whose artifacts are up to date.
+        :param num_workers: Max number of stages run at once (in threads).
+        :param forced_stage_names: 1-D list of stages to rerun even if their
+            artifacts are up to date.
+        :return: output_dict: Dictionary with output of each stage.
+        """
+
+        if forced_stage_names is None:
+            forced_stage_names = []
+
+        utils._create_directory(directory_name=self.artifact_dir_name)
+        file_hasher = _FileHasher(
+            os.path.join(self.artifact_dir_name, FILE_HASH_CACHE_NAME))
+
+        artifact_dict_by_stage = {}
+        pending_stage_names = list(self.stage_dict.keys())
+        future_to_stage_name = {}
+        executor_object = concurrent.futures.ThreadPoolExecutor(
+            max_workers=num_workers)
+
+        try:
+            while pending_stage_names or future_to_stage_name:
+                for this_name in list(pending_stage_names):
+                    this_stage = self.stage_dict[this_name]
+                    if not all([n in artifact_dict_by_stage
+                                for n in this_stage.dependency_names]):
+                        continue
+
+                    pending_stage_names.remove(this_name)
+
+                    # Key depends on parameters (input files by content) and
+                    # the hash of each input.
+                    this_stage_key = self._get_stage_key(
+                        this_stage, [
+                            artifact_dict_by_stage[n][OUTPUT_HASH_KEY]
+                            for n in this_stage.dependency_names
+                        ], file_hasher)
+                    this_artifact_file_name = self._get_artifact_file_name(
+                        this_name, this_stage_key)
+
+                    if (not this_stage.always_run and
+                            this_name not in forced_stage_names and
+                            os.path.isfile(this_artifact_file_name)):
+                        with open(this_artifact_file_name, 'rb') as this_file:
+                            this_artifact_dict = pickle.load(this_file)
+
+                        # Output files (e.g., the trained model) may have been
+                        # changed or deleted since the stage ran.
+                        if _get_hash(this_artifact_dict[OUTPUT_KEY],
+                                     file_hasher) == (
+                                         this_artifact_dict[OUTPUT_HASH_KEY]):
+                            print('Stage "{0:s}" is up to date.'.format(
+                                this_name))
+                            artifact_dict_by_stage[this_name] = (
+                                this_artifact_dict)
+                            continue
+
+                    this_input_dict = dict([
+                        (n, artifact_dict_by_stage[n][OUTPUT_KEY])
+                        for n in this_stage.dependency_names
+                    ])
+                    this_future = executor_object.submit(
+                        self._run_stage, this_stage, this_input_dict,
+                        this_stage_key, file_hasher)
+                    future_to_stage_name[this_future] = this_name
+
+                if not future_to_stage_name:
+                    continue
+
+                these_done_futures, _ = concurrent.futures.wait(
+                    list(future_to_stage_name.keys()),
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for this_future in these_done_futures:
+                    this_name = future_to_stage_name.pop(this_future)
+                    artifact_dict_by_stage[this_name] = this_future.result()
+        finally:
+            executor_object.shutdown(wait=True)
+            file_hasher.write()
+
+        return dict([
+            (n, artifact_dict_by_stage[n][OUTPUT_KEY])
+            for n in self.stage_dict
+        ])
+
+
+def _discover_files(directory_name, file_pattern):
+    """Finds input files.
+    :param directory_name: Name of directory.
+    :param file_pattern: Glob pattern.
+    :return: file_names: Sorted 1-D list of paths.
+    """
+
+    return sorted(glob.glob(os.path.join(directory_name, file_pattern)))
+
+
+def _get_normalization_params(discover_training):
+    """Computes normalization params from training files.
+    :param discover_training: 1-D list of training files.
+    :return: normalization_dicts: Tuple (normalization_dict,
+        normalization_dict_targ).
+    """
+
+    return utils.get_image_normalization_params_chunked(discover_training)
+
+
+def _count_samples(discover_training, discover_validation):
+    """Counts training and validation examples.
+    :param discover_training: 1-D list of training files.
+    :param discover_validation: 1-D list of validation files.
+    :return: num_examples_dict: Dictionary with keys "training" and
+        "validation".
+    """
+
+    return {
+        'training': utils.count_samps(discover_training),
+        'validation': utils.count_samps(discover_validation)
+    }
+
+
+def _train(discover_training, discover_validation, normalization,
+           count_samples, initial_model_file_name, output_model_file_name,
+           num_examples_per_batch, num_epochs, num_training_batches_per_epoch,
+           num_validation_batches_per_epoch):
+    """Trains CNN.
+    :param discover_training: 1-D list of training files.
+    :param discover_validation: 1-D list of validation files.
+    :param normalization: Output of `_get_normalization_params`.
+    :param count_samples: Output of `_count_samples`.
+    :param initial_model_file_name: Path to compiled, untrained model.  If
+        None, will use `utils.setup_cnn`.
+    :param output_model_file_name: Path to output model.
+    :param num_examples_per_batch: See doc for `utils.train_cnn`.
+    :param num_epochs: Same.
+    :param num_training_batches_per_epoch: Same.  If None, one epoch is one
+        pass over the training examples.
+    :param num_validation_batches_per_epoch: Same.  If None, one pass over the
+        validation examples.
+    :return: output_model_file_name: Path to trained model.
+    """
+
+    if num_training_batches_per_epoch is None:
+        num_training_batches_per_epoch = max([
+            count_samples['training'] // num_examples_per_batch, 1
+        ])
+    if num_validation_batches_per_epoch is None:
+        num_validation_batches_per_epoch = max([
+            count_samples['validation'] // num_examples_per_batch, 1
+        ])
+
+    if initial_model_file_name is None:
+        cnn_model_object = utils.setup_cnn(print_report=False)
+    else:
+        cnn_model_object = utils.read_keras_model(initial_model_file_name)
+
+    utils.train_cnn(
+        cnn_model_object=cnn_model_object,
+        training_file_names=discover_training,
+        normalization_dict=normalization[0],
+        normalization_dict_targ=normalization[1],
+        num_examples_per_batch=num_examples_per_batch, num_epochs=num_epochs,
+        num_training_batches_per_epoch=num_training_batches_per_epoch,
+        output_model_file_name=output_model_file_name,
+        validation_file_names=discover_validation,
+        num_validation_batches_per_epoch=num_validation_batches_per_epoch)
+
+    return output_model_file_name
+
+
+def _apply_model(training, discover_test, normalization):
+    """Applies trained CNN to test files.
+    :param training: Path to trained model.
+    :param discover_test: 1-D list of test files.
+    :param normalization: Output of `_get_normalization_params`.
+    :return: prediction_matrix: E-by-T numpy array of normalized predictions.
+    """
+
+    cnn_model_object = utils.read_keras_model(training)
+    prediction_matrices = []
+
+    for this_file_name in discover_test:
+        this_image_dict = utils.read_image_file(this_file_name)
+        this_predictor_matrix, _ = utils.normalize_images(
+            predictor_matrix=this_image_dict[utils.PREDICTOR_MATRIX_KEY],
+            predictor_names=this_image_dict[utils.PREDICTOR_NAMES_KEY],
+            normalization_dict=normalization[0])
+
+        prediction_matrices.append(utils.apply_cnn(
+            cnn_model_object, this_predictor_matrix.astype('float32'),
+            verbose=False))
+
+    return numpy.concatenate(prediction_matrices, axis=0)
+
+
+def _denormalize(inference, normalization):
+    """Denormalizes predictions.
+    :param inference: Output of `_apply_model`.
+    :param normalization: Output of `_get_normalization_params`.
+    :return: prediction_matrix: E-by-T numpy array of predictions (mm).
+    """
+
+    return utils.denormalize_images_targ(
+        inference, utils.TARGET_NAME, normalization[1]
+    ).astype(numpy.float32)
+
+
+def _write_output(denormalization, discover_test, post_processed_file_name,
+                  artifact_dir_name, overwrite_output=False):
+    """Writes post-processed NetCDF file.
+    The file is written next to its final path and then moved into place, so
+    an interrupted run never leaves a partial file.  A file written by an
+    earlier run (with the same artifact directory) is always replaced; any
+    other existing file is left alone unless `overwrite_output = True`.
+    :param denormalization: Output of `_denormalize`.
+    :param discover_test: 1-D list of test files.
+    :param post_processed_file_name: Path to output file.
+    :param artifact_dir_name: See doc for `Pipeline`.  Files written by the
+        pipeline are recorded here.
+    :param overwrite_output: Boolean flag.  If True, will overwrite the output
+        file even if the pipeline did not create it.
+    :return: post_processed_file_name: Same.
+    :raises: ValueError: if the output file exists, was not created by the
+        pipeline (or was changed since) and `overwrite_output = False`.
+    """
+
+    managed_outputs_file_name = os.path.join(
+        artifact_dir_name, MANAGED_OUTPUTS_FILE_NAME)
+    managed_hash_dict = {}
+    if os.path.isfile(managed_outputs_file_name):
+        with open(managed_outputs_file_name) as this_file:
+            managed_hash_dict = json.load(this_file)
+
+    absolute_file_name = os.path.abspath(post_processed_file_name)
+    if os.path.isfile(absolute_file_name) and not overwrite_output:
+        if (managed_hash_dict.get(absolute_file_name) !=
+                utils.get_file_hash(absolute_file_name)):
+            error_string = (
+                'Output file "{0:s}" already exists and was not written by '
+                'the pipeline.  Set "{1:s}" to true in the configuration to '
+                'overwrite it.'
+            ).format(post_processed_file_name, OVERWRITE_OUTPUT_KEY)
+            raise ValueError(error_string)
+
+    raw_prediction_matrices = []
+    observation_matrices = []
+    days = []
+
+    for this_file_name in discover_test:
+        this_dataset_object = netCDF4.Dataset(this_file_name)
+        raw_prediction_matrices.append(numpy.array(
+            this_dataset_object.variables[utils.NETCDF_rr_NAME][:], dtype=float
+        ))
+        observation_matrices.append(numpy.array(
+            this_dataset_object.variables[utils.NETCDF_TARGET_NAME][:],
+            dtype=float
+        ))
+        days.append(numpy.array(
+            this_dataset_object.variables[utils.NETCDF_TIME_NAME][:]))
+        this_dataset_object.close()
+
+    temp_file_name = '{0:s}.{1:d}.tmp'.format(
+        absolute_file_name, os.getpid())
+    utils.write_post_processed_file(
+        output_file_name=temp_file_name,
+        cnn_prediction_matrix=denormalization,
+        raw_prediction_matrix=numpy.concatenate(
+            raw_prediction_matrices, axis=0),
+        observation_matrix=numpy.concatenate(observation_matrices, axis=0),
+        days=numpy.concatenate(days))
+
+    # If the run dies between these two steps, the old file no longer matches
+    # its entry and is treated as foreign (never silently overwritten).
+    managed_hash_dict[absolute_file_name] = utils.get_file_hash(temp_file_name)
+    with open(managed_outputs_file_name, 'w') as this_file:
+        json.dump(managed_hash_dict, this_file)
+    os.replace(temp_file_name, absolute_file_name)
+
+    return post_processed_file_name
+
+
+def _verify(netcdf_output):
+    """Verifies post-processed file.
+    :param netcdf_output: Path to post-processed file.
+    :return: score_dict: Dictionary with scores (see
+        `verification.VerificationAccumulator.get_scores`) for each forecast.
+    """
+
+    accumulator_dict = verification.verify_files([netcdf_output])
+    return dict([
+        (k, a.get_scores()) for k, a in accumulator_dict.items()
+    ])
+
+
+def build_default_pipeline(config_dict, artifact_dir_name=ARTIFACT_DIR_NAME):
+    """Builds pipeline for the standard workflow.
+    :param config_dict: Dictionary with keys listed in `DEFAULT_CONFIG_DICT`
+        (missing keys take default values).  "initial_model_file_name" may
+        name a compiled, untrained model; if None, the default architecture
+        from `utils.setup_cnn` is used.
+    :param artifact_dir_name: See doc for `Pipeline`.
+    :return: pipeline_object: Instance of `Pipeline`.
+    """
+
+    config_dict = dict(DEFAULT_CONFIG_DICT, **config_dict)
+    pipeline_object = Pipeline(artifact_dir_name=artifact_dir_name)
+
+    for this_name, this_dir_key in [
+            (DISCOVER_TRAINING_STAGE, TRAINING_DIR_KEY),
+            (DISCOVER_VALIDATION_STAGE, VALIDATION_DIR_KEY),
+            (DISCOVER_TEST_STAGE, TEST_DIR_KEY)
+    ]:
+        pipeline_object.add_stage(Stage(
+            this_name, _discover_files, always_run=True, param_dict={
+                'directory_name': config_dict[this_dir_key],
+                'file_pattern': config_dict[FILE_PATTERN_KEY]
+            }))
+
+    pipeline_object.add_stage(Stage(
+        NORMALIZATION_STAGE, _get_normalization_params,
+        [DISCOVER_TRAINING_STAGE]))
+    pipeline_object.add_stage(Stage(
+        COUNT_SAMPLES_STAGE, _count_samples,
+        [DISCOVER_TRAINING_STAGE, DISCOVER_VALIDATION_STAGE]))
+
+    pipeline_object.add_stage(Stage(
+        TRAINING_STAGE, _train,
+        [DISCOVER_TRAINING_STAGE, DISCOVER_VALIDATION_STAGE,
+         NORMALIZATION_STAGE, COUNT_SAMPLES_STAGE],
+        param_dict=dict([
+            (k, config_dict[k]) for k in [
+                INITIAL_MODEL_FILE_KEY, OUTPUT_MODEL_FILE_KEY,
+                NUM_EXAMPLES_PER_BATCH_KEY, NUM_EPOCHS_KEY,
+                NUM_TRAINING_BATCHES_KEY, NUM_VALIDATION_BATCHES_KEY
+            ]
+        ]), output_param_names=[OUTPUT_MODEL_FILE_KEY]))
+
+    pipeline_object.add_stage(Stage(
+        INFERENCE_STAGE, _apply_model,
+        [TRAINING_STAGE, DISCOVER_TEST_STAGE, NORMALIZATION_STAGE]))
+    pipeline_object.add_stage(Stage(
+        DENORMALIZATION_STAGE, _denormalize,
+        [INFERENCE_STAGE, NORMALIZATION_STAGE]))
+    pipeline_object.add_stage(Stage(
+        OUTPUT_STAGE, _write_output,
+        [DENORMALIZATION_STAGE, DISCOVER_TEST_STAGE], param_dict={
+            POST_PROCESSED_FILE_KEY: config_dict[POST_PROCESSED_FILE_KEY],
+            'artifact_dir_name': artifact_dir_name,
+            OVERWRITE_OUTPUT_KEY: config_dict[OVERWRITE_OUTPUT_KEY]
+        }, output_param_names=[POST_PROCESSED_FILE_KEY]))
+    pipeline_object.add_stage(Stage(
+        VERIFICATION_STAGE, _verify, [OUTPUT_STAGE]))
+
+    return pipeline_object
+
+
+if __name__ == '__main__':
+    ARGUMENT_PARSER = argparse.ArgumentParser(
+        description='Runs the end-to-end workflow, skipping unchanged stages.')
+    ARGUMENT_PARSER.add_argument(
+        'config_file_name', help='Path to JSON file with configuration.')
+    ARGUMENT_PARSER.add_argument(
+        '--artifact_dir_name', default=ARTIFACT_DIR_NAME)
+    ARGUMENT_PARSER.add_argument(
+        '--num_workers', type=int, default=NUM_WORKERS)
+    ARGUMENT_PARSER.add_argument(
+        '--force', nargs='*', default=[],
+        help='Stages to rerun even if up to date.')
+    ARGUMENTS = ARGUMENT_PARSER.parse_args()
+
+    with open(ARGUMENTS.config_file_name) as CONFIG_FILE:
+        CONFIG_DICT = json.load(CONFIG_FILE)
+
+    OUTPUT_DICT = build_default_pipeline(
+        CONFIG_DICT, artifact_dir_name=ARGUMENTS.artifact_dir_name
+    ).run(num_workers=ARGUMENTS.num_workers,
+          forced_stage_names=ARGUMENTS.force)
+
+    print(OUTPUT_DICT[VERIFICATION_STAGE])
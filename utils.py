@@ -1,6 +1,11 @@
 """Helper methods for ARcnnV2."""
 import copy
 import errno
+import hashlib
+import socket
+import weakref
+import concurrent.futures
+import multiprocessing
 import random
 import glob
 import os.path
@@ -8,6 +13,8 @@ import time
 import calendar
 import json
 import pickle
+import shutil
+import warnings
 import netCDF4
 import numpy
 import keras
@@ -37,6 +44,8 @@ NETCDF_v700_WIND_NAME = 'v700'
 NETCDF_rh700_WIND_NAME = 'rh700'
 NETCDF_T700_WIND_NAME = 'T700'
 NETCDF_W700_WIND_NAME = 'W700'
+NETCDF_TIME_NAME = 'Days'
+DAYS_TO_SECONDS = 86400
 
 #variable names: 
 rr = 'rr'
@@ -87,6 +96,129 @@ VALIDATION_FILES_KEY = 'validation_file_names'
 NUM_VALIDATION_BATCHES_KEY = 'num_validation_batches_per_epoch'
 CNN_FILE_KEY = 'cnn_file_name'
 CNN_FEATURE_LAYER_KEY = 'cnn_feature_layer_name'
+RESIDENT_VALIDATION_KEY = 'resident_validation'
+
+TRAINING_STATE_DIR_KEY = 'training_state_dir_name'
+TRAINING_STATE_FILE_NAME = 'training_state.p'
+NUM_EPOCHS_PER_STATE_CHECKPOINT = 1
+EPOCH_KEY = 'epoch'
+MODEL_WEIGHTS_KEY = 'model_weights'
+OPTIMIZER_WEIGHTS_KEY = 'optimizer_weights'
+CURRENT_LEARNING_RATE_KEY = 'learning_rate'
+CALLBACK_STATES_KEY = 'callback_states'
+PYTHON_RNG_STATE_KEY = 'python_rng_state'
+NUMPY_RNG_STATE_KEY = 'numpy_rng_state'
+GENERATOR_STATES_KEY = 'generator_states'
+
+# Keys in generator-state dictionaries (position of a training generator).
+TRAINING_GENERATOR_NAME = 'training'
+VALIDATION_GENERATOR_NAME = 'validation'
+GENERATOR_FILE_NAMES_KEY = 'file_names'
+GENERATOR_FILE_INDEX_KEY = 'file_index'
+GENERATOR_BATCH_INDICES_KEY = 'batch_indices'
+GENERATOR_NEXT_BATCH_KEY = 'next_batch_index'
+
+# Attributes holding the state of early-stopping, checkpoint and LR-scheduler
+# callbacks.
+CALLBACK_STATE_ATTRIBUTE_NAMES = [
+    'wait', 'best', 'stopped_epoch', 'cooldown_counter'
+]
+
+# Importance sampling by rain intensity (see `get_rain_sampling_dict`).  Rows
+# are binned by the given percentile of observed rain over stations.
+RAIN_STRATUM_EDGES_MM = [1., 10., 30.]
+RAIN_INTENSITY_PERCENTILE = 90.
+UNIFORM_SAMPLING_FRACTION = 0.5
+RAIN_STRATUM_EDGES_KEY = 'rain_stratum_edges_mm'
+RAIN_INTENSITY_PERCENTILE_KEY = 'rain_intensity_percentile'
+STRATUM_FRACTIONS_KEY = 'stratum_fractions'
+STRATUM_WEIGHTS_KEY = 'stratum_sampling_weights'
+STRATUM_INDICES_BY_FILE_KEY = 'stratum_indices_by_file'
+RAIN_SAMPLING_DICT_KEY = 'rain_sampling_dict'
+
+NUM_EXAMPLES_PER_VALIDATION_BATCH = 4096
+NUM_EXAMPLES_PER_INFERENCE_BATCH = 1000
+
+# Truncated models built by `_get_sub_model`, keyed by full model and then by
+# tuple of output-layer names.
+_SUB_MODEL_CACHE = weakref.WeakKeyDictionary()
+
+CANDIDATE_INFERENCE_BATCH_SIZES = [32, 64, 128, 256, 512, 1000, 2048, 4096]
+BATCH_SIZE_TUNING_FILE_NAME = os.path.join(
+    os.path.expanduser('~'), '.cache', 'italian_precip',
+    'batch_size_tuning.json')
+BATCH_SIZE_KEY = 'batch_size'
+THROUGHPUT_KEY = 'examples_per_second'
+PEAK_MEMORY_KEY = 'peak_memory_bytes'
+PROBE_RESULTS_KEY = 'probe_results'
+
+# Model file for each model read by `read_keras_model`, and tuned batch size
+# for each (model file, host) already looked up.
+_MODEL_FILE_NAMES = weakref.WeakKeyDictionary()
+_TUNED_BATCH_SIZES = {}
+
+INFERENCE_CACHE_DIR_NAME = os.path.join(
+    os.path.expanduser('~'), '.cache', 'italian_precip', 'inference')
+NUM_BYTES_PER_HASH_BLOCK = 2 ** 20
+PREDICTION_MATRIX_KEY = 'prediction_matrix'
+CACHE_KEY_KEY = 'cache_key'
+
+NUM_MC_DROPOUT_REPLICATES = 50
+MC_DROPOUT_QUANTILE_LEVELS = [0.1, 0.5, 0.9]
+MC_MEAN_MATRIX_KEY = 'mean_matrix'
+MC_STDEV_MATRIX_KEY = 'stdev_matrix'
+MC_QUANTILE_MATRIX_KEY = 'quantile_matrix'
+MC_QUANTILE_LEVELS_KEY = 'quantile_levels'
+MC_MEMBER_MATRIX_KEY = 'member_matrix'
+
+# Copies of models with dropout active at inference time, built by
+# `_get_mc_dropout_model`.
+_MC_DROPOUT_MODEL_CACHE = weakref.WeakKeyDictionary()
+
+CACHE_FLOAT16_FORMAT = 'float16'
+CACHE_INT16_FORMAT = 'int16'
+VALID_CACHE_FORMATS = [CACHE_FLOAT16_FORMAT, CACHE_INT16_FORMAT]
+CACHE_FILE_EXTENSION = '.npz'
+CACHE_INT16_MAX_VALUE = 32767
+CACHE_INT16_NAN_VALUE = -32768
+
+SHARD_METAFILE_NAME = 'shard_metadata.json'
+SHARD_FILE_NAMES_KEY = 'shard_file_names'
+SOURCE_FILES_KEY = 'source_file_names'
+SHARD_INDEX_BY_FILE_KEY = 'shard_index_by_file'
+FILE_ROW_OFFSETS_KEY = 'file_row_offsets'
+SHARD_PREDICTOR_MATRICES_KEY = 'shard_predictor_matrices'
+SHARD_TARGET_MATRICES_KEY = 'shard_target_matrices'
+TRAINING_SHARD_DIR_KEY = 'training_shard_dir_name'
+
+SHARED_MEMORY_DIR_NAME = '/dev/shm'
+SHARED_DATASET_PREFIX = 'italian_precip_'
+
+FILE_ENTRIES_KEY = 'file_entries'
+FILE_NAME_KEY = 'file_name'
+FILE_SIZE_KEY = 'file_size_bytes'
+FILE_MTIME_KEY = 'file_mtime'
+NUM_EXAMPLES_KEY = 'num_examples'
+VARIABLE_NAMES_KEY = 'variable_names'
+FIRST_TIME_KEY = 'first_time_unix_sec'
+LAST_TIME_KEY = 'last_time_unix_sec'
+TIMES_KEY = 'times_unix_sec'
+SUMMARY_STATS_KEY = 'summary_stats'
+DAY_ZERO_TIME_KEY = 'day_zero_time_string'
+NUM_NAN_VALUES_KEY = 'num_nan_values'
+MIN_VALUE_KEY = 'min_value'
+MAX_VALUE_KEY = 'max_value'
+
+NUM_EXAMPLES_PER_CHUNK = 1000
+ERROR_SUM_KEY = 'error_sum'
+ABSOLUTE_ERROR_SUM_KEY = 'absolute_error_sum'
+SQUARED_ERROR_SUM_KEY = 'squared_error_sum'
+RMSE_KEY = 'rmse'
+MAE_KEY = 'mae'
+BIAS_KEY = 'bias'
+OVERALL_RMSE_KEY = 'overall_rmse'
+CNN_FORECAST_KEY = 'cnn'
+RAW_FORECAST_KEY = 'raw'
 
 
 # Machine-learning constants.
@@ -105,6 +237,27 @@ NUM_POOLING_COLUMNS = 2
 NUM_DENSE_LAYERS = 3
 DENSE_LAYER_DROPOUT_FRACTION = 0.5
 
+NUM_UNITS_IN_LAST_HIDDEN_LAYER = 100
+
+# Output activations that bound predictions below (or on both sides).  These
+# fit only min-max scaled targets: z-scored targets are negative whenever the
+# value is below the (station) mean, e.g. on every dry day.
+BOUNDED_OUTPUT_ACTIVATION_NAMES = ['relu', 'sigmoid']
+VALID_OUTPUT_ACTIVATION_NAMES = (
+    [None, 'linear'] + BOUNDED_OUTPUT_ACTIVATION_NAMES
+)
+LEARNING_RATE = 0.001
+NUM_PROFILING_REPEATS = 20
+
+LAYER_NAME_KEY = 'layer_name'
+LAYER_TYPE_KEY = 'layer_type'
+OUTPUT_SHAPE_KEY = 'output_shape'
+NUM_PARAMS_KEY = 'num_params'
+NUM_FLOPS_KEY = 'num_flops'
+ACTIVATION_BYTES_KEY = 'activation_bytes'
+LATENCY_KEY = 'latency_sec'
+LAYER_REPORTS_KEY = 'layer_reports'
+
 NUM_SMOOTHING_FILTER_ROWS = 5
 NUM_SMOOTHING_FILTER_COLUMNS = 5
 
@@ -132,6 +285,32 @@ def time_unix_to_string(unix_time_sec, time_format):
     return time.strftime(time_format, time.gmtime(unix_time_sec))
 
 
+def time_strings_to_unix(time_strings):
+    """Converts many ISO-8601 time strings to Unix format at once.
+    This is the vectorized counterpart of `time_string_to_unix`, using
+    numpy.datetime64 instead of one `strptime` call per string.
+    :param time_strings: 1-D list or numpy array of time strings (examples:
+        "2012-10-01", "2012-10-01T06:00:00").
+    :return: unix_times_sec: 1-D numpy array of times in Unix format.
+    """
+
+    return numpy.array(time_strings, dtype='datetime64[s]').astype(numpy.int64)
+
+
+def time_unix_to_strings(unix_times_sec, time_unit='D'):
+    """Converts many Unix times to ISO-8601 strings at once.
+    This is the vectorized counterpart of `time_unix_to_string`.
+    :param unix_times_sec: 1-D numpy array of times in Unix format.
+    :param time_unit: Resolution of output strings (numpy.datetime64 unit, e.g.
+        "D" for "%Y-%m-%d" or "s" for "%Y-%m-%dT%H:%M:%S").
+    :return: time_strings: 1-D numpy array of time strings.
+    """
+
+    return numpy.datetime_as_string(
+        numpy.array(unix_times_sec, dtype=numpy.int64).astype('datetime64[s]'),
+        unit=time_unit)
+
+
 
 
 def read_image_file(netcdf_file_name,targ_LATinds=None,targ_LONinds=None):
@@ -196,6 +375,246 @@ def read_image_file(netcdf_file_name,targ_LATinds=None,targ_LONinds=None):
 
 
 
+def _encode_cache_matrix(data_matrix, cache_format):
+    """Encodes one matrix for the compact cache.
+    The last axis is treated as the channel axis.  Offsets and scales are
+    computed per channel.
+    :param data_matrix: numpy array of floats.
+    :param cache_format: Cache format (must be in `VALID_CACHE_FORMATS`).
+    :return: encoded_matrix: numpy array with the same shape as
+        `data_matrix`, stored as float16 or int16.
+    :return: offsets: numpy array with one offset per channel (zeros for
+        float16).
+    :return: scales: numpy array with one scale per channel (ones for float16).
+    :raises: ValueError: if the values are too large for float16.
+    """
+
+    num_channels = data_matrix.shape[-1]
+
+    if cache_format == CACHE_FLOAT16_FORMAT:
+        max_abs_value = numpy.nanmax(numpy.absolute(data_matrix))
+        if max_abs_value > numpy.finfo(numpy.float16).max:
+            error_string = (
+                'Max absolute value ({0:.4e}) is too large for float16.  Use '
+                'the "{1:s}" cache format instead.'
+            ).format(max_abs_value, CACHE_INT16_FORMAT)
+            raise ValueError(error_string)
+
+        return (data_matrix.astype(numpy.float16),
+                numpy.zeros(num_channels), numpy.ones(num_channels))
+
+    flat_matrix = numpy.reshape(data_matrix, (-1, num_channels))
+    min_values = numpy.nanmin(flat_matrix, axis=0)
+    max_values = numpy.nanmax(flat_matrix, axis=0)
+
+    offsets = (max_values + min_values) / 2
+    scales = (max_values - min_values) / (2 * CACHE_INT16_MAX_VALUE)
+    scales[scales == 0] = 1.
+
+    encoded_matrix = numpy.round((data_matrix - offsets) / scales)
+    encoded_matrix[numpy.isnan(data_matrix)] = CACHE_INT16_NAN_VALUE
+
+    return encoded_matrix.astype(numpy.int16), offsets, scales
+
+
+def _decode_cache_matrix(encoded_matrix, offsets, scales):
+    """Decodes one matrix from the compact cache into float32.
+    This method is the inverse of `_encode_cache_matrix`.
+    :param encoded_matrix: See output doc for `_encode_cache_matrix`.
+    :param offsets: Same.
+    :param scales: Same.
+    :return: data_matrix: float32 numpy array with the same shape as
+        `encoded_matrix`.
+    """
+
+    if encoded_matrix.dtype == numpy.float16:
+        return encoded_matrix.astype(numpy.float32)
+
+    data_matrix = encoded_matrix.astype(numpy.float32)
+    data_matrix *= scales.astype(numpy.float32)
+    data_matrix += offsets.astype(numpy.float32)
+    data_matrix[encoded_matrix == CACHE_INT16_NAN_VALUE] = numpy.nan
+
+    return data_matrix
+
+
+def write_cache_file(netcdf_file_name, cache_file_name,
+                     cache_format=CACHE_FLOAT16_FORMAT, targ_LATinds=None,
+                     targ_LONinds=None):
+    """Writes predictors and targets from one NetCDF file to the compact cache.
+    :param netcdf_file_name: Path to input file (must be readable by
+        `read_image_file`).
+    :param cache_file_name: Path to output file (extension should be ".npz").
+    :param cache_format: Either "float16" or "int16".  For "int16", each
+        channel is stored as a scaled integer with its own offset.
+    :param targ_LATinds: See doc for `read_image_file`.
+    :param targ_LONinds: Same.
+    :raises: ValueError: if `cache_format` is not recognized.
+    """
+
+    if cache_format not in VALID_CACHE_FORMATS:
+        error_string = (
+            'Cache format ("{0:s}") is not in the following list:\n{1:s}'
+        ).format(cache_format, str(VALID_CACHE_FORMATS))
+        raise ValueError(error_string)
+
+    if (targ_LATinds is None) & (targ_LONinds is None):
+        image_dict = read_image_file(netcdf_file_name)
+    else:
+        image_dict = read_image_file(
+            netcdf_file_name, targ_LATinds, targ_LONinds)
+
+    predictor_matrix, predictor_offsets, predictor_scales = (
+        _encode_cache_matrix(image_dict[PREDICTOR_MATRIX_KEY], cache_format)
+    )
+
+    # The target matrix is one channel (E-by-T), so it gets one offset/scale.
+    target_matrix, target_offsets, target_scales = _encode_cache_matrix(
+        numpy.expand_dims(image_dict[TARGET_MATRIX_KEY], axis=-1),
+        cache_format)
+
+    _create_directory(file_name=cache_file_name)
+    numpy.savez(
+        cache_file_name,
+        predictor_matrix=predictor_matrix,
+        predictor_offsets=predictor_offsets,
+        predictor_scales=predictor_scales,
+        target_matrix=target_matrix[..., 0],
+        target_offsets=target_offsets,
+        target_scales=target_scales,
+        predictor_names=numpy.array(image_dict[PREDICTOR_NAMES_KEY]),
+        target_name=numpy.array(image_dict[TARGET_NAME_KEY]),
+        source_file_name=numpy.array(netcdf_file_name)
+    )
+
+
+def read_cache_file(cache_file_name):
+    """Reads predictors and targets from the compact cache.
+    :param cache_file_name: Path to input file (written by
+        `write_cache_file`).
+    :return: image_dict: See doc for `read_image_file`.  Both matrices are
+        float32.
+    """
+
+    with numpy.load(cache_file_name) as this_file:
+        predictor_matrix = _decode_cache_matrix(
+            this_file['predictor_matrix'], this_file['predictor_offsets'],
+            this_file['predictor_scales'])
+        target_matrix = _decode_cache_matrix(
+            this_file['target_matrix'], this_file['target_offsets'][0],
+            this_file['target_scales'][0])
+
+        return {
+            PREDICTOR_NAMES_KEY: this_file['predictor_names'].tolist(),
+            PREDICTOR_MATRIX_KEY: predictor_matrix,
+            TARGET_NAME_KEY: str(this_file['target_name']),
+            TARGET_MATRIX_KEY: target_matrix
+        }
+
+
+def cache_image_files(netcdf_file_names, cache_directory_name,
+                      cache_format=CACHE_FLOAT16_FORMAT, targ_LATinds=None,
+                      targ_LONinds=None):
+    """Writes each NetCDF file to the compact cache.
+    :param netcdf_file_names: 1-D list of paths to input files.
+    :param cache_directory_name: Name of output directory.
+    :param cache_format: See doc for `write_cache_file`.
+    :param targ_LATinds: Same.
+    :param targ_LONinds: Same.
+    :return: cache_file_names: 1-D list of paths to output files, in the same
+        order as `netcdf_file_names`.
+    """
+
+    cache_file_names = []
+
+    for this_file_name in netcdf_file_names:
+        this_cache_file_name = '{0:s}/{1:s}{2:s}'.format(
+            cache_directory_name,
+            os.path.splitext(os.path.split(this_file_name)[1])[0],
+            CACHE_FILE_EXTENSION
+        )
+
+        print('Caching "{0:s}" to "{1:s}"...'.format(
+            this_file_name, this_cache_file_name))
+        write_cache_file(
+            netcdf_file_name=this_file_name,
+            cache_file_name=this_cache_file_name, cache_format=cache_format,
+            targ_LATinds=targ_LATinds, targ_LONinds=targ_LONinds)
+
+        cache_file_names.append(this_cache_file_name)
+
+    return cache_file_names
+
+
+def check_cache_file(cache_file_name, netcdf_file_name=None, targ_LATinds=None,
+                     targ_LONinds=None):
+    """Reports worst quantization error per channel against the NetCDF file.
+    :param cache_file_name: Path to cache file (written by `write_cache_file`).
+    :param netcdf_file_name: Path to original NetCDF file.  If None, will use
+        the source file recorded in the cache file.
+    :param targ_LATinds: See doc for `read_image_file`.  Must match the values
+        used to write the cache file.
+    :param targ_LONinds: Same.
+    :return: max_error_dict: Dictionary.  Each key is the name of a predictor
+        or the target, and the corresponding value is the max absolute
+        difference between the original and decoded values.
+    """
+
+    if netcdf_file_name is None:
+        with numpy.load(cache_file_name) as this_file:
+            netcdf_file_name = str(this_file['source_file_name'])
+
+    if (targ_LATinds is None) & (targ_LONinds is None):
+        original_image_dict = read_image_file(netcdf_file_name)
+    else:
+        original_image_dict = read_image_file(
+            netcdf_file_name, targ_LATinds, targ_LONinds)
+
+    cached_image_dict = read_cache_file(cache_file_name)
+    predictor_names = original_image_dict[PREDICTOR_NAMES_KEY]
+    max_error_dict = {}
+
+    for m in range(len(predictor_names)):
+        max_error_dict[predictor_names[m]] = numpy.nanmax(numpy.absolute(
+            cached_image_dict[PREDICTOR_MATRIX_KEY][..., m] -
+            original_image_dict[PREDICTOR_MATRIX_KEY][..., m]
+        ))
+
+    max_error_dict[original_image_dict[TARGET_NAME_KEY]] = numpy.nanmax(
+        numpy.absolute(
+            cached_image_dict[TARGET_MATRIX_KEY] -
+            original_image_dict[TARGET_MATRIX_KEY]
+        )
+    )
+
+    for this_name in max_error_dict:
+        print('Max quantization error for "{0:s}" = {1:.4e}'.format(
+            this_name, max_error_dict[this_name]
+        ))
+
+    return max_error_dict
+
+
+def _read_training_file(file_name, targ_LATinds=None, targ_LONinds=None):
+    """Reads one training file, which may be NetCDF or compact cache.
+    :param file_name: Path to input file.  If the extension is ".npz", the file
+        will be read by `read_cache_file` (and `targ_LATinds`/`targ_LONinds`
+        are ignored, since they were applied when the cache was written).
+        Otherwise, the file will be read by `read_image_file`.
+    :param targ_LATinds: See doc for `read_image_file`.
+    :param targ_LONinds: Same.
+    :return: image_dict: See doc for `read_image_file`.
+    """
+
+    if file_name.endswith(CACHE_FILE_EXTENSION):
+        return read_cache_file(file_name)
+
+    if (targ_LATinds is None) & (targ_LONinds is None):
+        return read_image_file(file_name)
+
+    return read_image_file(file_name, targ_LATinds, targ_LONinds)
+
+
 def _update_normalization_params(intermediate_normalization_dict, new_values):
     """Updates normalization params for one predictor.
     :param intermediate_normalization_dict: Dictionary with the following keys.
@@ -240,22 +659,96 @@ def _update_normalization_params(intermediate_normalization_dict, new_values):
 
 
 
+def _update_column_normalization_params(intermediate_normalization_dict,
+                                        new_matrix):
+    """Updates normalization params for each column (output) of the target.
+    Same as `_update_normalization_params`, except that statistics are kept
+    separately for each column (all axes but the first) and NaN values are
+    ignored.  Column minima and maxima are also kept.
+    :param intermediate_normalization_dict: See doc for
+        `_update_normalization_params`, except that values are numpy arrays
+        with one element per column.  There are also the keys "min_value" and
+        "max_value".
+    :param new_matrix: numpy array of new values (first axis is example).
+    :return: intermediate_normalization_dict: Same as input but with updated
+        values.
+    """
+
+    finite_flags = numpy.isfinite(new_matrix)
+    new_matrix = numpy.where(finite_flags, new_matrix, 0.)
+    these_counts = numpy.sum(finite_flags, axis=0)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        new_normalization_dict = {
+            NUM_VALUES_KEY: these_counts,
+            MEAN_VALUE_KEY:
+                numpy.sum(new_matrix, axis=0) / numpy.maximum(these_counts, 1),
+            MEAN_OF_SQUARES_KEY:
+                numpy.sum(new_matrix ** 2, axis=0) /
+                numpy.maximum(these_counts, 1),
+            MIN_VALUE_KEY: numpy.min(
+                numpy.where(finite_flags, new_matrix, numpy.inf), axis=0),
+            MAX_VALUE_KEY: numpy.max(
+                numpy.where(finite_flags, new_matrix, -numpy.inf), axis=0)
+        }
+
+    return _merge_normalization_params(
+        intermediate_normalization_dict, new_normalization_dict)
+
+
 def _get_standard_deviation(intermediate_normalization_dict):
     """Computes stdev from intermediate normalization params.
     :param intermediate_normalization_dict: See doc for
-        `_update_normalization_params`.
-    :return: standard_deviation: Standard deviation.
+        `_update_normalization_params` or
+        `_update_column_normalization_params`.
+    :return: standard_deviation: Standard deviation (numpy array if the input
+        has per-column params).
     """
 
-    num_values = float(intermediate_normalization_dict[NUM_VALUES_KEY])
-    multiplier = num_values / (num_values - 1)
+    num_values = numpy.asarray(
+        intermediate_normalization_dict[NUM_VALUES_KEY], dtype=float)
+    multiplier = num_values / numpy.maximum(num_values - 1, 1)
 
-    return numpy.sqrt(multiplier * (
+    return numpy.sqrt(multiplier * numpy.maximum(
         intermediate_normalization_dict[MEAN_OF_SQUARES_KEY] -
-        intermediate_normalization_dict[MEAN_VALUE_KEY] ** 2
+        intermediate_normalization_dict[MEAN_VALUE_KEY] ** 2, 0.
     ))
 
 
+def _get_target_normalization_params(intermediate_normalization_dict,
+                                     minmax=None):
+    """Converts per-column intermediate params to target normalization params.
+    T = number of target columns (stations)
+    Columns with no valid values, or with zero spread, get a scale of 1 (and
+    location of 0 if there are no values), so they pass through unchanged.
+    :param intermediate_normalization_dict: See doc for
+        `_update_column_normalization_params`.
+    :param minmax: See doc for `normalize_images_targ`.
+    :return: normalization_params: 2-by-T numpy array, with [means, stdevs] if
+        `minmax is None`, otherwise [maxima, minima].
+    """
+
+    empty_flags = intermediate_normalization_dict[NUM_VALUES_KEY] == 0
+
+    if minmax is None:
+        these_locations = intermediate_normalization_dict[MEAN_VALUE_KEY] + 0.
+        these_scales = _get_standard_deviation(intermediate_normalization_dict)
+    else:
+        these_locations = intermediate_normalization_dict[MIN_VALUE_KEY] + 0.
+        these_scales = (
+            intermediate_normalization_dict[MAX_VALUE_KEY] - these_locations
+        )
+
+    these_locations[empty_flags] = 0.
+    these_scales[numpy.invert(these_scales > 0)] = 1.
+
+    if minmax is None:
+        return numpy.array([these_locations, these_scales])
+
+    return numpy.array([these_locations + these_scales, these_locations])
+
+
 def get_image_normalization_params(netcdf_file_names,targ_LATinds=None,targ_LONinds=None):
     """Computes normalization params (mean and stdev) for each predictor.
     :param netcdf_file_names: 1-D list of paths to input files.
@@ -302,15 +795,17 @@ def get_image_normalization_params(netcdf_file_names,targ_LATinds=None,targ_LONi
 
 
 
-def get_image_normalization_params_targ(netcdf_file_names,targ_LATinds=None,targ_LONinds=None):
-    """Computes normalization params (mean and stdev) for each predictor.
+def get_image_normalization_params_targ(netcdf_file_names,targ_LATinds=None,targ_LONinds=None,
+                                        minmax=None):
+    """Computes normalization params for each target column (station).
     :param netcdf_file_names: 1-D list of paths to input files.
     :param targ*lons: desired target lat lon indices
-    :return: normalization_dict: See input doc for `normalize_images`.
+    :param minmax: See doc for `normalize_images_targ`.
+    :return: normalization_dict: See input doc for `normalize_images_targ`.
     """
 
     targ_names = None
-    norm_dict_by_targ = None
+    norm_dict_targ = {}
 
     for this_file_name in netcdf_file_names:
         print('Reading data from: "{0:s}"...'.format(this_file_name))
@@ -322,44 +817,38 @@ def get_image_normalization_params_targ(netcdf_file_names,targ_LATinds=None,targ
         
         if targ_names is None:
             targ_names = this_image_dict[TARGET_NAME_KEY]
-            norm_dict_by_targ = [{}] * len(targ_names[0])
-        
-        
-        for m in range(len(targ_names[0])):
-            norm_dict_by_targ[m] = _update_normalization_params(
-                intermediate_normalization_dict=norm_dict_by_targ[m],
-                new_values=this_image_dict[TARGET_MATRIX_KEY][..., m]
-            )
 
-    print('\n')
-    normalization_dict = {}
+        norm_dict_targ = _update_column_normalization_params(
+            intermediate_normalization_dict=norm_dict_targ,
+            new_matrix=this_image_dict[TARGET_MATRIX_KEY]
+        )
 
-    for m in range(len(targ_names[0])):
-        this_mean = norm_dict_by_targ[m][MEAN_VALUE_KEY]
-        this_stdev = _get_standard_deviation(norm_dict_by_targ[m])
+    print('\n')
+    normalization_dict = {
+        targ_names: _get_target_normalization_params(norm_dict_targ, minmax)
+    }
 
-        normalization_dict[targ_names] = numpy.array(
-            [this_mean, this_stdev]
-        )
-        message_string = (
-            'Mean and standard deviation for "{0:s}" = {1:.4f}, {2:.4f}'
-        ).format(targ_names, this_mean, this_stdev)
-        print(message_string)
+    message_string = (
+        'Normalization params for "{0:s}" computed for {1:d} columns '
+        '(median {2:.4f}, {3:.4f})'
+    ).format(
+        targ_names, normalization_dict[targ_names].shape[-1],
+        numpy.median(normalization_dict[targ_names][0]),
+        numpy.median(normalization_dict[targ_names][1])
+    )
+    print(message_string)
 
     return normalization_dict
 
 
 
 def count_samps(netcdf_file_names):
-    """determines number of samples in list
+    """determines number of samples in list (from dimension metadata only)
     """
-    targ_names = None
-    norm_dict_by_targ = None
     num_samps = 0
     for this_file_name in netcdf_file_names:
         print('Reading data from: "{0:s}"...'.format(this_file_name))
-        this_image_dict = read_image_file(this_file_name)
-        num_samps = num_samps+this_image_dict[TARGET_MATRIX_KEY].shape[0]
+        num_samps = num_samps+_get_num_examples_in_file(this_file_name)
 
     return num_samps
 
@@ -412,39 +901,32 @@ def normalize_images(
 
 def normalize_images_targ(
         targ_matrix, targ_names, normalization_dict,minmax=None):
-    """Normalizes images to z-scores.
+    """Normalizes targets to z-scores (or to [0, 1] with min-max scaling).
     E = number of examples in file
-    M = number of rows in each grid (lats)
-    N = number of columns in each grid (lons)
-    C = number of channels (predictor variables)
+    T = number of target columns (stations)
     
-    :param predictor_matrix: E-by-M-by-N-by-C numpy array of predictor values.
-    :param predictor_names: length-C list of predictor names.
-    :param normalization_dict: Dictionary.  Each key is the name of a predictor
-        value, and the corresponding value is a length-2 numpy array with
-        [mean, standard deviation].  If `normalization_dict is None`, mean and
-        standard deviation will be computed for each predictor.
-    :return: predictor_matrix: Normalized version of input.
-    :return: normalization_dict: See doc for input variable.  If input was None,
-        this will be a newly created dictionary.  Otherwise, this will be the
-        same dictionary passed as input.
+    :param targ_matrix: E-by-T numpy array of target values.
+    :param targ_names: Name of target variable.
+    :param normalization_dict: Dictionary.  The key is the target name, and the
+        corresponding value is a numpy array with [mean, standard deviation]
+        (or [max, min] if `minmax` is set).  Each of these may be a scalar
+        (one value for all columns) or a length-T array (one per column), as
+        created by `get_image_normalization_params_targ`.
+    :param minmax: If None, normalizes to z-scores.  Otherwise, uses min-max
+        scaling.
+    :return: targ_matrix: Normalized version of input.
+    :return: normalization_dict: Same as input.
     """
-    
+
+    normalization_params = numpy.asarray(
+        normalization_dict[targ_names.split()[0]], dtype=float)
+
     if minmax is None:
-        num_targs = len(targ_names.split())
-        for m in range(num_targs):
-            this_mean = normalization_dict[targ_names.split()[m]][0]
-            this_stdev = normalization_dict[targ_names.split()[m]][1]
-            targ_matrix = ((targ_matrix - this_mean) / float(this_stdev)
-                )
+        this_mean, this_stdev = normalization_params[0], normalization_params[1]
+        targ_matrix = (targ_matrix - this_mean) / this_stdev
     else: 
-        num_targs = len(targ_names.split())
-        for m in range(num_targs):
-            this_max = normalization_dict[targ_names.split()[m]][0]
-            this_min = normalization_dict[targ_names.split()[m]][1]
-       
-            targ_matrix = ((targ_matrix - this_min) / float(this_max - this_min)
-                )
+        this_max, this_min = normalization_params[0], normalization_params[1]
+        targ_matrix = (targ_matrix - this_min) / (this_max - this_min)
 
     return targ_matrix, normalization_dict
 
@@ -479,31 +961,24 @@ def denormalize_images(predictor_matrix, predictor_names, normalization_dict,min
 
 
 def denormalize_images_targ(targ_matrix, targ_names, normalization_dict,minmax=None):
-    """Denormalizes images from z-scores back to original scales.
-    :param predictor_matrix: See doc for `normalize_images`.
-    :param predictor_names: Same.
+    """Denormalizes targets back to original scales.
+    :param targ_matrix: See doc for `normalize_images_targ`.
+    :param targ_names: Same.
     :param normalization_dict: Same.
-    :return: predictor_matrix: Denormalized version of input.
+    :param minmax: Same.
+    :return: targ_matrix: Denormalized version of input.
     """   
     
-    num_targs = len(targ_names.split())
-    
+    normalization_params = numpy.asarray(
+        normalization_dict[targ_names.split()[0]], dtype=float)
+
     if minmax is None:
-        for m in range(num_targs):
-            this_mean = normalization_dict[targ_names.split()[0]][0]
-            this_stdev = normalization_dict[targ_names.split()[0]][1]
-    
-            targ_matrix = (
-                this_mean + (this_stdev * targ_matrix)
-                )
+        this_mean, this_stdev = normalization_params[0], normalization_params[1]
+        targ_matrix = this_mean + (this_stdev * targ_matrix)
     else: 
-        for m in range(num_targs):
-            this_mean = normalization_dict[targ_names.split()[0]][0]
-            this_stdev = normalization_dict[targ_names.split()[0]][1]
-    
-            targ_matrix = (
-                targ_matrix*(float(this_max - this_min)) + this_min
-                )
+        this_max, this_min = normalization_params[0], normalization_params[1]
+        targ_matrix = targ_matrix * (this_max - this_min) + this_min
+
     return targ_matrix
 
 
@@ -513,9 +988,13 @@ def read_keras_model(hdf5_file_name):
     :return: model_object: Instance of `keras.models.Model`.
     """
 
-    return keras.models.load_model(
+    model_object = keras.models.load_model(
         hdf5_file_name)
 
+    # Remembered so that inference can use the batch size tuned for this file.
+    _MODEL_FILE_NAMES[model_object] = hdf5_file_name
+    return model_object
+
 
 def find_model_metafile(model_file_name, raise_error_if_missing=False):
     """Finds metafile for machine-learning model.
@@ -555,12 +1034,21 @@ def _metadata_numpy_to_list(model_metadata_dict):
 
     new_metadata_dict = copy.deepcopy(model_metadata_dict)
 
-    if NORMALIZATION_DICT_KEY in new_metadata_dict.keys():
-        this_norm_dict = new_metadata_dict[NORMALIZATION_DICT_KEY]
+    for this_dict_key in [NORMALIZATION_DICT_KEY, NORMALIZATION_DICT_TARG_KEY,
+                          RAIN_SAMPLING_DICT_KEY]:
+        if new_metadata_dict.get(this_dict_key) is None:
+            continue
+
+        this_norm_dict = new_metadata_dict[this_dict_key]
 
         for this_key in this_norm_dict.keys():
             if isinstance(this_norm_dict[this_key], numpy.ndarray):
                 this_norm_dict[this_key] = this_norm_dict[this_key].tolist()
+            elif isinstance(this_norm_dict[this_key], dict):
+                this_norm_dict[this_key] = dict([
+                    (k, numpy.asarray(v).tolist())
+                    for k, v in this_norm_dict[this_key].items()
+                ])
 
     return new_metadata_dict
 
@@ -574,11 +1062,22 @@ def _metadata_list_to_numpy(model_metadata_dict):
     :return: model_metadata_dict: Same but numpy arrays instead of lists.
     """
 
-    if NORMALIZATION_DICT_KEY in model_metadata_dict.keys():
-        this_norm_dict = model_metadata_dict[NORMALIZATION_DICT_KEY]
+    for this_dict_key in [NORMALIZATION_DICT_KEY, NORMALIZATION_DICT_TARG_KEY,
+                          RAIN_SAMPLING_DICT_KEY]:
+        if model_metadata_dict.get(this_dict_key) is None:
+            continue
+
+        this_norm_dict = model_metadata_dict[this_dict_key]
 
         for this_key in this_norm_dict.keys():
-            this_norm_dict[this_key] = numpy.array(this_norm_dict[this_key])
+            if isinstance(this_norm_dict[this_key], dict):
+                this_norm_dict[this_key] = dict([
+                    (k, numpy.array(v))
+                    for k, v in this_norm_dict[this_key].items()
+                ])
+            else:
+                this_norm_dict[this_key] = numpy.array(
+                    this_norm_dict[this_key])
 
     return model_metadata_dict
 
@@ -609,91 +1108,154 @@ def read_model_metadata(json_file_name):
         return _metadata_list_to_numpy(model_metadata_dict)
 
     
-def apply_cnn(cnn_model_object, predictor_matrix, verbose=True,
-              output_layer_name=None):
-    """Applies trained CNN (convolutional neural net) to new data.
-    E = number of examples in file
-    M = number of rows in each grid (lats)
-    N = number of columns in each grid (lons)
-    C = number of channels (predictor variables)
-    :param cnn_model_object: Trained instance of `keras.models.Model`.
-    :param predictor_matrix: E-by-M-by-N-by-C numpy array of predictor values.
-    :param verbose: Boolean flag.  If True, progress messages will be printed.
-    :param output_layer_name: Name of output layer.  If
-        `output_layer_name is None`, this method will use the actual output
-        layer, so will return predictions.  If `output_layer_name is not None`,
-        will return "features" (outputs from the given layer).
-    If `output_layer_name is None`...
-    :return: forecast_probabilities: length-E numpy array with forecast
-        probabilities of positive class (label = 1).
-    If `output_layer_name is not None`...
-    :return: feature_matrix: numpy array of features (outputs from the given
-        layer).  There is no guarantee on the shape of this array, except that
-        the first axis has length E.
+def get_rain_strata(target_matrix, rain_sampling_dict):
+    """Assigns each example (row) to a rain-intensity stratum.
+    The intensity of a row is the given percentile of observed rain over
+    stations (NaN observations ignored, rows with no observations count as dry).
+    :param target_matrix: E-by-T numpy array of unnormalized targets.
+    :param rain_sampling_dict: Dictionary created by `get_rain_sampling_dict`
+        (only the stratum edges and percentile are used).
+    :return: stratum_indices: length-E numpy array of stratum indices (0 for
+        the driest stratum).
     """
 
-    num_examples = predictor_matrix.shape[0]
-    num_examples_per_batch = 1000
-
-    if output_layer_name is None:
-        model_object_to_use = cnn_model_object
-    else:
-        model_object_to_use = keras.models.Model(
-            inputs=cnn_model_object.input,
-            outputs=cnn_model_object.get_layer(name=output_layer_name).output
-        )
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        row_intensities = numpy.nanpercentile(
+            target_matrix, rain_sampling_dict[RAIN_INTENSITY_PERCENTILE_KEY],
+            axis=1)
+
+    row_intensities[numpy.isnan(row_intensities)] = 0.
+    return numpy.digitize(
+        row_intensities, rain_sampling_dict[RAIN_STRATUM_EDGES_KEY])
+
+
+def get_rain_sampling_dict(
+        netcdf_file_names, stratum_edges_mm=RAIN_STRATUM_EDGES_MM,
+        intensity_percentile=RAIN_INTENSITY_PERCENTILE,
+        uniform_fraction=UNIFORM_SAMPLING_FRACTION, targ_LATinds=None,
+        targ_LONinds=None):
+    """Computes rain-stratum sampling weights for `deep_learning_generator`.
+    Each stratum is drawn with probability
+    `uniform_fraction * f + (1 - uniform_fraction) / K`, where f is the fraction
+    of training examples in the stratum and K the number of non-empty strata.
+    So with `uniform_fraction = 0` all strata are drawn equally often, and with
+    `uniform_fraction = 1` sampling is uniform.
+    K = number of strata
+    :param netcdf_file_names: 1-D list of paths to training files.
+    :param stratum_edges_mm: length-(K - 1) list of increasing stratum edges
+        (mm of rain).
+    :param intensity_percentile: Percentile over stations used as the rain
+        intensity of each example.
+    :param uniform_fraction: See above.
+    :param targ_LATinds: See doc for `read_image_file`.
+    :param targ_LONinds: Same.
+    :return: rain_sampling_dict: Dictionary with the following keys.
+    rain_sampling_dict['rain_stratum_edges_mm']: numpy version of
+        `stratum_edges_mm`.
+    rain_sampling_dict['rain_intensity_percentile']: See input doc.
+    rain_sampling_dict['stratum_fractions']: length-K numpy array with
+        fraction of examples in each stratum.
+    rain_sampling_dict['stratum_sampling_weights']: length-K numpy array of
+        sampling weights per example (relative to uniform sampling).
+    rain_sampling_dict['stratum_indices_by_file']: Dictionary mapping each
+        file name to a numpy array with the stratum of each row (see
+        `get_rain_strata`), so the generator never recomputes strata.
+    :raises: ValueError: if `uniform_fraction` is not in [0, 1].
+    """
 
-    output_array = None
+    if not 0 <= uniform_fraction <= 1:
+        error_string = (
+            'uniform_fraction ({0:f}) must be in [0, 1].'
+        ).format(uniform_fraction)
+        raise ValueError(error_string)
 
-    for i in range(0, num_examples, num_examples_per_batch):
-        this_first_index = i
-        this_last_index = min(
-            [i + num_examples_per_batch - 1, num_examples - 1]
-        )
+    rain_sampling_dict = {
+        RAIN_STRATUM_EDGES_KEY: numpy.array(stratum_edges_mm, dtype=float),
+        RAIN_INTENSITY_PERCENTILE_KEY: intensity_percentile
+    }
 
-        if verbose:
-            print('Applying model to examples {0:d}-{1:d} of {2:d}...'.format(
-                this_first_index, this_last_index, num_examples
-            ))
+    num_strata = len(stratum_edges_mm) + 1
+    num_examples_by_stratum = numpy.zeros(num_strata, dtype=int)
+    stratum_indices_by_file = {}
 
-        these_indices = numpy.linspace(
-            this_first_index, this_last_index,
-            num=this_last_index - this_first_index + 1, dtype=int)
+    for this_file_name in netcdf_file_names:
+        print('Counting rain strata in: "{0:s}"...'.format(this_file_name))
+
+        this_image_dict = _read_training_file(
+            this_file_name, targ_LATinds, targ_LONinds)
+        stratum_indices_by_file[this_file_name] = get_rain_strata(
+            this_image_dict[TARGET_MATRIX_KEY], rain_sampling_dict
+        ).astype(numpy.int8)
+        num_examples_by_stratum += numpy.bincount(
+            stratum_indices_by_file[this_file_name], minlength=num_strata)
+
+    stratum_fractions = (
+        num_examples_by_stratum.astype(float) /
+        max([numpy.sum(num_examples_by_stratum), 1])
+    )
+    non_empty_flags = num_examples_by_stratum > 0
 
-        this_output_array = model_object_to_use.predict(
-            predictor_matrix[these_indices, ...],
-            batch_size=num_examples_per_batch)
+    stratum_probabilities = uniform_fraction * stratum_fractions
+    stratum_probabilities[non_empty_flags] += (
+        (1. - uniform_fraction) / numpy.sum(non_empty_flags)
+    )
 
-        if output_layer_name is None:
-            this_output_array = this_output_array[:, -1]
+    # Empty strata keep weight 1, so that rows falling into them later are
+    # still sampled (uniformly).
+    stratum_weights = numpy.ones(num_strata)
+    stratum_weights[non_empty_flags] = (
+        stratum_probabilities[non_empty_flags] /
+        stratum_fractions[non_empty_flags]
+    )
 
-        if output_array is None:
-            output_array = this_output_array + 0.
-        else:
-            output_array = numpy.concatenate(
-                (output_array, this_output_array), axis=0
-            )
+    for k in range(num_strata):
+        print((
+            'Rain stratum {0:d}: {1:.4f} of examples, sampling weight = '
+            '{2:.3f}'
+        ).format(k, stratum_fractions[k], stratum_weights[k]))
 
-    return output_array
+    rain_sampling_dict.update({
+        STRATUM_FRACTIONS_KEY: stratum_fractions,
+        STRATUM_WEIGHTS_KEY: stratum_weights,
+        STRATUM_INDICES_BY_FILE_KEY: stratum_indices_by_file
+    })
 
+    return rain_sampling_dict
 
 
 def deep_learning_generator(netcdf_file_names, num_examples_per_batch,
                             normalization_dict,normalization_dict_targ,targ_LATinds=None,
-                           targ_LONinds=None):
+                           targ_LONinds=None, rain_sampling_dict=None,
+                           generator_state_dict=None):
     """Generates training examples for deep-learning model on the fly.
     E = number of examples 
     M = number of rows in each grid (lats)
     N = number of columns in each grid (lons)
     C = number of channels (predictor variables)
-    :param netcdf_file_names: 1-D list of paths to input (NetCDF) files.
+    :param netcdf_file_names: 1-D list of paths to input files (NetCDF, or
+        compact cache files written by `cache_image_files`).
     :param num_examples_per_batch: Number of examples per training batch.
     :param normalization_dict: See doc for `normalize_images`.  You cannot leave
         this as None.
+    :param rain_sampling_dict: Dictionary created by `get_rain_sampling_dict`.
+        If None, examples are sampled uniformly.  Otherwise, examples are
+        drawn (with replacement) with probability proportional to the weight
+        of their rain stratum, and each batch also yields sample weights
+        1 / (n p) (p = probability of drawing the example, n = number of
+        examples read for the batch), so the weighted loss is an unbiased
+        estimate of the uniform one.
+    :param generator_state_dict: Dictionary holding the position of the
+        generator (shuffled file order and index of the next file), updated
+        before each batch is yielded so that it can be checkpointed (see
+        `TrainingStateCallback`).  If it already holds a position, the
+        generator continues from there.  If None, the position is not kept.
     
     :return: predictor_matrix: E-by-M-by-N-by-C numpy array of predictor values.
     :return: target_values: length-E numpy array of target values (integers in
         0...1).
+    :return: sample_weights: [only if `rain_sampling_dict is not None`]
+        length-E numpy array of sample weights.
     :raises: TypeError: if `normalization_dict is None`.
     """
 
@@ -705,33 +1267,59 @@ def deep_learning_generator(netcdf_file_names, num_examples_per_batch,
         error_string = 'normalization_dict_targ cannot be None.  Must be specified.'
         raise TypeError(error_string)
 
-    random.shuffle(netcdf_file_names)
+    if generator_state_dict is None:
+        generator_state_dict = {}
+
+    if GENERATOR_FILE_NAMES_KEY in generator_state_dict:
+        netcdf_file_names = list(
+            generator_state_dict[GENERATOR_FILE_NAMES_KEY])
+        file_index = generator_state_dict[GENERATOR_FILE_INDEX_KEY]
+    else:
+        random.shuffle(netcdf_file_names)
+        file_index = 0
+
+    generator_state_dict[GENERATOR_FILE_NAMES_KEY] = list(netcdf_file_names)
+    generator_state_dict[GENERATOR_FILE_INDEX_KEY] = file_index
     num_files = len(netcdf_file_names)
-    file_index = 0
 
     num_examples_in_memory = 0
     full_predictor_matrix = None
     full_target_matrix = None
     predictor_names = None
+    stratum_matrices = []
 
     while True:
         while num_examples_in_memory < num_examples_per_batch:
             print('Reading data from: "{0:s}"...'.format(
                 netcdf_file_names[file_index]
             ))
-            
-            if (targ_LATinds is None) & (targ_LONinds is None):
-                this_image_dict = read_image_file(netcdf_file_names[file_index])
-            else:
-                this_image_dict = read_image_file(netcdf_file_names[file_index],targ_LATinds,targ_LONinds)
+
+            this_image_dict = _read_training_file(
+                netcdf_file_names[file_index], targ_LATinds, targ_LONinds)
             
             predictor_names = this_image_dict[PREDICTOR_NAMES_KEY]
             targ_names = this_image_dict[TARGET_NAME_KEY]
 
+            # Strata are precomputed per file and row by
+            # `get_rain_sampling_dict` (and only computed here for files it did
+            # not see).
+            if rain_sampling_dict is not None:
+                these_stratum_indices = rain_sampling_dict.get(
+                    STRATUM_INDICES_BY_FILE_KEY, {}
+                ).get(netcdf_file_names[file_index])
+
+                if these_stratum_indices is None:
+                    these_stratum_indices = get_rain_strata(
+                        this_image_dict[TARGET_MATRIX_KEY], rain_sampling_dict)
+
+                stratum_matrices.append(numpy.asarray(these_stratum_indices))
+
             file_index += 1
             if file_index >= num_files:
                 file_index = 0
 
+            generator_state_dict[GENERATOR_FILE_INDEX_KEY] = file_index
+
             if full_target_matrix is None or full_target_matrix.size == 0:
                 full_predictor_matrix = (
                     this_image_dict[PREDICTOR_MATRIX_KEY] + 0.
@@ -752,11 +1340,25 @@ def deep_learning_generator(netcdf_file_names, num_examples_per_batch,
 
             num_examples_in_memory = full_target_matrix.shape[0]
 
-        batch_indices = numpy.linspace(
-            0, num_examples_in_memory - 1, num=num_examples_in_memory,
-            dtype=int)
-        batch_indices = numpy.random.choice(
-            batch_indices, size=num_examples_per_batch, replace=False)
+        if rain_sampling_dict is None:
+            batch_indices = numpy.linspace(
+                0, num_examples_in_memory - 1, num=num_examples_in_memory,
+                dtype=int)
+            batch_indices = numpy.random.choice(
+                batch_indices, size=num_examples_per_batch, replace=False)
+        else:
+            these_weights = numpy.asarray(
+                rain_sampling_dict[STRATUM_WEIGHTS_KEY]
+            )[numpy.concatenate(stratum_matrices)]
+            these_probabilities = these_weights / numpy.sum(these_weights)
+
+            batch_indices = numpy.random.choice(
+                num_examples_in_memory, size=num_examples_per_batch,
+                replace=True, p=these_probabilities)
+            sample_weights = (
+                1. / (num_examples_in_memory *
+                      these_probabilities[batch_indices])
+            ).astype('float32')
 
         
         predictor_matrix, _ = normalize_images(
@@ -774,70 +1376,2045 @@ def deep_learning_generator(netcdf_file_names, num_examples_per_batch,
         num_examples_in_memory = 0
         full_predictor_matrix = None
         full_target_matrix = None
+        stratum_matrices = []
+
+        if rain_sampling_dict is not None:
+            yield (predictor_matrix, target_values, sample_weights)
+            continue
         
         yield (predictor_matrix, target_values)
-        
 
-        
 
-def train_cnn(
-        cnn_model_object, training_file_names, normalization_dict,
-        normalization_dict_targ, num_examples_per_batch, num_epochs,
-        num_training_batches_per_epoch, output_model_file_name,
-        validation_file_names=None, num_validation_batches_per_epoch=None,
-    targ_LATinds=None, targ_LONinds=None):
-    
-    """Trains CNN (convolutional neural net).
-    :param cnn_model_object: Untrained instance of `keras.models.Model` (may be
-        created by `setup_cnn`).
-    :param training_file_names: 1-D list of paths to training files (must be
-        readable by `read_image_file`).
-    :param normalization_dict: See doc for `deep_learning_generator`.
-    param normalization_dict_targ: See doc for `deep_learning_generator`.
-    :param num_examples_per_batch: Same.
-    :param num_epochs: Number of epochs.
-    :param num_training_batches_per_epoch: Number of training batches furnished
-        to model in each epoch.
-    :param output_model_file_name: Path to output file.  The model will be saved
-        as an HDF5 file (extension should be ".h5", but this is not enforced).
-    :param validation_file_names: 1-D list of paths to training files (must be
-        readable by `read_image_file`).  If `validation_file_names is None`,
-        will omit on-the-fly validation.
-    :param num_validation_batches_per_epoch:
-        [used only if `validation_file_names is not None`]
-        Number of validation batches furnished to model in each epoch.
-    :return: cnn_metadata_dict: Dictionary with the following keys.
-    cnn_metadata_dict['training_file_names']: See input doc.
-    cnn_metadata_dict['normalization_dict']: Same.
-    cnn_metadata_dict['normalization_dict_targ']: Same.
-    cnn_metadata_dict['num_examples_per_batch']: Same.
-    cnn_metadata_dict['num_training_batches_per_epoch']: Same.
-    cnn_metadata_dict['validation_file_names']: Same.
-    cnn_metadata_dict['num_validation_batches_per_epoch']: Same.
+def _get_num_examples_in_file(netcdf_file_name):
+    """Returns number of examples in NetCDF file, using dimension metadata only.
+    :param netcdf_file_name: Path to input file.
+    :return: num_examples: Number of examples (length of first axis of target
+        variable).
     """
-    
-    #configure GPU: 
-    config = tensorflow.ConfigProto(allow_soft_placement=False, log_device_placement=False)
-    config.gpu_options.allow_growth = True
-    sess = tensorflow.Session(config=config)
-    K.set_session(sess)
 
+    dataset_object = netCDF4.Dataset(netcdf_file_name)
+    num_examples = dataset_object.variables[NETCDF_TARGET_NAME].shape[0]
+    dataset_object.close()
 
-    _create_directory(file_name=output_model_file_name)
+    return num_examples
 
-    if validation_file_names is None:
-        checkpoint_object = keras.callbacks.ModelCheckpoint(
-            filepath=output_model_file_name, monitor='loss', verbose=1,
-            save_best_only=False, save_weights_only=False, mode='min',
-            period=1)
-    else:
-        checkpoint_object = keras.callbacks.ModelCheckpoint(
-            filepath=output_model_file_name, monitor='val_loss', verbose=1,
-            save_best_only=True, save_weights_only=False, mode='min',
-            period=1)
 
-    list_of_callback_objects = [checkpoint_object]
+class ImageDataset(object):
+    """Lazy random-access view of examples spread over many NetCDF files.
+    Only dimension metadata are read when the dataset is created.  Indexing
+    (`ds[i]`, `ds[i:j]`, `ds[[i, j, k]]` or a boolean mask) decodes only the
+    requested rows of the requested channels, even across file boundaries.
+    """
+
+    def __init__(self, netcdf_file_names, predictor_names=None,
+                 targ_LATinds=None, targ_LONinds=None, dtype=float):
+        """Creates dataset.
+        :param netcdf_file_names: 1-D list of paths to input files (must be
+            readable by `read_image_file`).
+        :param predictor_names: 1-D list of predictors to decode.  If None,
+            will use all of `NETCDF_PREDICTOR_NAMES`.
+        :param targ_LATinds: See doc for `read_image_file`.
+        :param targ_LONinds: Same.
+        :param dtype: Data type of returned matrices.
+        """
+
+        if predictor_names is None:
+            predictor_names = NETCDF_PREDICTOR_NAMES
+
+        self.netcdf_file_names = list(netcdf_file_names)
+        self.predictor_names = list(predictor_names)
+        self.targ_LATinds = targ_LATinds
+        self.targ_LONinds = targ_LONinds
+        self.dtype = dtype
+
+        self.num_examples_by_file = numpy.array(
+            [_get_num_examples_in_file(f) for f in self.netcdf_file_names],
+            dtype=int)
+        self.row_offsets = numpy.concatenate((
+            numpy.array([0], dtype=int), numpy.cumsum(self.num_examples_by_file)
+        ))
+
+        self._dataset_objects = {}
+
+    def __len__(self):
+        return int(self.row_offsets[-1])
+
+    def __getitem__(self, key):
+        return self.read_rows(key)
+
+    def close(self):
+        """Closes all NetCDF files opened by this dataset."""
+
+        for this_dataset_object in self._dataset_objects.values():
+            this_dataset_object.close()
+
+        self._dataset_objects = {}
+
+    def _get_dataset_object(self, file_index):
+        """Returns open NetCDF dataset for one file, opening it if necessary.
+        :param file_index: Index into `netcdf_file_names`.
+        :return: dataset_object: Instance of `netCDF4.Dataset`.
+        """
+
+        if file_index not in self._dataset_objects:
+            self._dataset_objects[file_index] = netCDF4.Dataset(
+                self.netcdf_file_names[file_index])
+
+        return self._dataset_objects[file_index]
+
+    def _key_to_indices(self, key):
+        """Converts index key to 1-D array of global row indices.
+        :param key: Integer, slice, boolean mask or sequence of integers.
+        :return: row_indices: 1-D numpy array of non-negative row indices.
+        :raises: IndexError: if any index is out of range.
+        """
+
+        num_examples = len(self)
+
+        if isinstance(key, slice):
+            return numpy.arange(*key.indices(num_examples), dtype=int)
+
+        row_indices = numpy.atleast_1d(numpy.asarray(key))
+        if row_indices.dtype == bool:
+            return numpy.where(row_indices)[0]
+
+        row_indices = row_indices.astype(int)
+        row_indices[row_indices < 0] += num_examples
+
+        if numpy.any(row_indices < 0) or numpy.any(row_indices >= num_examples):
+            error_string = 'Row indices must be in range [{0:d}, {1:d}).'.format(
+                -num_examples, num_examples)
+            raise IndexError(error_string)
+
+        return row_indices
+
+    def read_rows(self, key, predictor_names=None, read_targets=True):
+        """Decodes the given rows.
+        E = number of rows requested
+        :param key: Integer, slice, boolean mask or sequence of integers (global
+            row indices over all files).
+        :param predictor_names: 1-D list of predictors to decode (subset of
+            `self.predictor_names`).  If None, will decode all.
+        :param read_targets: Boolean flag.  If False, targets will not be
+            decoded.
+        :return: image_dict: See doc for `read_image_file`, but containing only
+            the E requested rows (in the requested order).  If
+            `read_targets = False`, the target matrix will be None.
+        """
+
+        if predictor_names is None:
+            predictor_names = self.predictor_names
+
+        row_indices = self._key_to_indices(key)
+        num_rows = len(row_indices)
+        file_indices = numpy.searchsorted(
+            self.row_offsets, row_indices, side='right') - 1
+
+        predictor_matrix = None
+        target_matrix = None
+
+        for i in numpy.unique(file_indices):
+            these_output_rows = numpy.where(file_indices == i)[0]
+            these_local_rows = (
+                row_indices[these_output_rows] - self.row_offsets[i]
+            )
+
+            # NetCDF reads are fastest for sorted, unique indices, and a plain
+            # slice if the rows are contiguous.
+            these_unique_rows, these_inverse_indices = numpy.unique(
+                these_local_rows, return_inverse=True)
+
+            if (these_unique_rows[-1] - these_unique_rows[0] + 1 ==
+                    len(these_unique_rows)):
+                this_netcdf_key = slice(
+                    these_unique_rows[0], these_unique_rows[-1] + 1)
+            else:
+                this_netcdf_key = these_unique_rows
+
+            this_dataset_object = self._get_dataset_object(i)
+
+            for m in range(len(predictor_names)):
+                this_predictor_matrix = numpy.array(
+                    this_dataset_object.variables[predictor_names[m]][
+                        this_netcdf_key, ...],
+                    dtype=self.dtype
+                )[these_inverse_indices, ...]
+
+                if predictor_matrix is None:
+                    predictor_matrix = numpy.full(
+                        (num_rows,) + this_predictor_matrix.shape[1:] +
+                        (len(predictor_names),),
+                        numpy.nan, dtype=self.dtype)
+
+                predictor_matrix[these_output_rows, ..., m] = (
+                    this_predictor_matrix)
+
+            if not read_targets:
+                continue
+
+            this_target_matrix = numpy.array(
+                this_dataset_object.variables[NETCDF_TARGET_NAME][
+                    this_netcdf_key, ...],
+                dtype=self.dtype
+            )[these_inverse_indices, ...]
+
+            if self.targ_LATinds is not None:
+                this_target_matrix = this_target_matrix[
+                    :, self.targ_LATinds, self.targ_LONinds]
+
+            this_target_matrix = numpy.reshape(
+                this_target_matrix, (this_target_matrix.shape[0], -1))
+
+            if target_matrix is None:
+                target_matrix = numpy.full(
+                    (num_rows, this_target_matrix.shape[1]), numpy.nan,
+                    dtype=self.dtype)
+
+            target_matrix[these_output_rows, ...] = this_target_matrix
+
+        if predictor_matrix is not None:
+            predictor_matrix[numpy.isnan(predictor_matrix)] = 0
+
+        return {
+            PREDICTOR_NAMES_KEY: list(predictor_names),
+            PREDICTOR_MATRIX_KEY: predictor_matrix,
+            TARGET_NAME_KEY: TARGET_NAME,
+            TARGET_MATRIX_KEY: target_matrix
+        }
+
+
+def _get_chunk_tasks(netcdf_file_names, num_examples_per_chunk):
+    """Splits files into fixed-size row chunks (from dimension metadata only).
+    Chunks never cross file boundaries, so the last chunk of each file may be
+    smaller than `num_examples_per_chunk`.
+    :param netcdf_file_names: 1-D list of paths to input files.
+    :param num_examples_per_chunk: Max number of examples per chunk.
+    :return: chunk_tasks: 1-D list of tuples (file_name, first_row, last_row),
+        where `last_row` is exclusive.
+    """
+
+    chunk_tasks = []
+
+    for this_file_name in netcdf_file_names:
+        this_num_examples = _get_num_examples_in_file(this_file_name)
+
+        for this_first_row in range(
+                0, this_num_examples, num_examples_per_chunk):
+            chunk_tasks.append((
+                this_file_name, this_first_row,
+                min([this_first_row + num_examples_per_chunk,
+                     this_num_examples])
+            ))
+
+    return chunk_tasks
+
+
+def _read_chunk(chunk_task, targ_LATinds=None, targ_LONinds=None):
+    """Reads one chunk of rows.
+    :param chunk_task: One tuple created by `_get_chunk_tasks`.
+    :param targ_LATinds: See doc for `read_image_file`.
+    :param targ_LONinds: Same.
+    :return: image_dict: See doc for `read_image_file`.
+    """
+
+    image_dataset = ImageDataset(
+        [chunk_task[0]], targ_LATinds=targ_LATinds, targ_LONinds=targ_LONinds)
+    image_dict = image_dataset[chunk_task[1]:chunk_task[2]]
+    image_dataset.close()
+
+    return image_dict
+
+
+def _merge_normalization_params(first_normalization_dict,
+                                second_normalization_dict):
+    """Merges two sets of intermediate normalization params.
+    :param first_normalization_dict: See doc for
+        `_update_normalization_params`.  May be empty.
+    :param second_normalization_dict: Same.
+    :return: normalization_dict: Params for the union of both sets of values.
+    """
+
+    if MEAN_VALUE_KEY not in first_normalization_dict:
+        return copy.deepcopy(second_normalization_dict)
+    if MEAN_VALUE_KEY not in second_normalization_dict:
+        return copy.deepcopy(first_normalization_dict)
+
+    first_num_values = first_normalization_dict[NUM_VALUES_KEY]
+    second_num_values = second_normalization_dict[NUM_VALUES_KEY]
+    normalization_dict = {
+        NUM_VALUES_KEY: first_num_values + second_num_values
+    }
+
+    # Works for both scalar and per-column params (columns may be empty).
+    for this_key in [MEAN_VALUE_KEY, MEAN_OF_SQUARES_KEY]:
+        normalization_dict[this_key] = (
+            first_num_values * first_normalization_dict[this_key] +
+            second_num_values * second_normalization_dict[this_key]
+        ) / numpy.maximum(normalization_dict[NUM_VALUES_KEY], 1)
+
+    if MIN_VALUE_KEY in first_normalization_dict:
+        normalization_dict[MIN_VALUE_KEY] = numpy.minimum(
+            first_normalization_dict[MIN_VALUE_KEY],
+            second_normalization_dict[MIN_VALUE_KEY])
+        normalization_dict[MAX_VALUE_KEY] = numpy.maximum(
+            first_normalization_dict[MAX_VALUE_KEY],
+            second_normalization_dict[MAX_VALUE_KEY])
+
+    return normalization_dict
+
+
+def _get_chunk_normalization_params(chunk_task):
+    """Computes intermediate normalization params for one chunk.
+    :param chunk_task: One tuple created by `_get_chunk_tasks`, optionally with
+        `targ_LATinds` and `targ_LONinds` appended.
+    :return: norm_dict_by_predictor: 1-D list of dictionaries (one per
+        predictor), each formatted like the input to
+        `_update_normalization_params`.
+    :return: norm_dict_targ: Same but for the target, with params for each
+        column (see `_update_column_normalization_params`).
+    """
+
+    image_dict = _read_chunk(chunk_task[:3], *chunk_task[3:])
+    num_predictors = len(image_dict[PREDICTOR_NAMES_KEY])
+
+    norm_dict_by_predictor = [
+        _update_normalization_params(
+            {}, image_dict[PREDICTOR_MATRIX_KEY][..., m])
+        for m in range(num_predictors)
+    ]
+    norm_dict_targ = _update_column_normalization_params(
+        {}, image_dict[TARGET_MATRIX_KEY])
+
+    return norm_dict_by_predictor, norm_dict_targ
+
+
+def _map_chunks(worker_function, chunk_tasks, num_workers):
+    """Applies function to each chunk, optionally in parallel processes.
+    Results are yielded in the same order as `chunk_tasks`.
+    :param worker_function: Module-level function that takes one chunk task.
+    :param chunk_tasks: 1-D list of chunk tasks.
+    :param num_workers: Number of worker processes.  If 1, chunks are processed
+        in this process.
+    :return: result: Output of `worker_function` for one chunk.
+    """
+
+    if num_workers == 1:
+        for this_chunk_task in chunk_tasks:
+            yield worker_function(this_chunk_task)
+        return
+
+    with multiprocessing.Pool(processes=num_workers) as this_pool:
+        for this_result in this_pool.imap(worker_function, chunk_tasks):
+            yield this_result
+
+
+def get_image_normalization_params_chunked(
+        netcdf_file_names, num_examples_per_chunk=NUM_EXAMPLES_PER_CHUNK,
+        num_workers=1, targ_LATinds=None, targ_LONinds=None, minmax=None):
+    """Computes predictor and target normalization params chunk by chunk.
+    Peak memory is one chunk per worker, regardless of file size.  Results are
+    the same as `get_image_normalization_params` and
+    `get_image_normalization_params_targ`, in one pass over the data.
+    :param netcdf_file_names: 1-D list of paths to input files.
+    :param num_examples_per_chunk: Number of examples per chunk.
+    :param num_workers: Number of worker processes.
+    :param targ_LATinds: See doc for `read_image_file`.
+    :param targ_LONinds: Same.
+    :param minmax: See doc for `normalize_images_targ`.
+    :return: normalization_dict: See doc for `normalize_images`.
+    :return: normalization_dict_targ: See doc for `normalize_images_targ`.
+    """
+
+    chunk_tasks = [
+        t + (targ_LATinds, targ_LONinds)
+        for t in _get_chunk_tasks(netcdf_file_names, num_examples_per_chunk)
+    ]
+
+    norm_dict_by_predictor = None
+    norm_dict_targ = {}
+
+    for i, (these_predictor_dicts, this_targ_dict) in enumerate(
+            _map_chunks(_get_chunk_normalization_params, chunk_tasks,
+                        num_workers)):
+        print('Computed normalization params for chunk {0:d} of {1:d}...'.format(
+            i + 1, len(chunk_tasks)
+        ))
+
+        if norm_dict_by_predictor is None:
+            norm_dict_by_predictor = [{}] * len(these_predictor_dicts)
+
+        norm_dict_by_predictor = [
+            _merge_normalization_params(a, b)
+            for a, b in zip(norm_dict_by_predictor, these_predictor_dicts)
+        ]
+        norm_dict_targ = _merge_normalization_params(
+            norm_dict_targ, this_targ_dict)
+
+    normalization_dict = {}
+    for m in range(len(PREDICTOR_NAMES)):
+        normalization_dict[PREDICTOR_NAMES[m]] = numpy.array([
+            norm_dict_by_predictor[m][MEAN_VALUE_KEY],
+            _get_standard_deviation(norm_dict_by_predictor[m])
+        ])
+
+    normalization_dict_targ = {
+        TARGET_NAME: _get_target_normalization_params(norm_dict_targ, minmax)
+    }
+
+    return normalization_dict, normalization_dict_targ
+
+
+def _iterate_chunks(chunk_tasks, targ_LATinds=None, targ_LONinds=None):
+    """Reads chunks in order, prefetching the next chunk in a thread.
+    :param chunk_tasks: 1-D list of chunk tasks (see `_get_chunk_tasks`).
+    :param targ_LATinds: See doc for `read_image_file`.
+    :param targ_LONinds: Same.
+    :return: image_dict: See doc for `read_image_file`.
+    """
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as this_executor:
+        this_future = None
+
+        for i in range(len(chunk_tasks)):
+            if this_future is None:
+                this_future = this_executor.submit(
+                    _read_chunk, chunk_tasks[i], targ_LATinds, targ_LONinds)
+
+            this_image_dict = this_future.result()
+
+            if i + 1 < len(chunk_tasks):
+                this_future = this_executor.submit(
+                    _read_chunk, chunk_tasks[i + 1], targ_LATinds,
+                    targ_LONinds)
+
+            yield this_image_dict
+
+
+def apply_cnn_chunked(
+        cnn_model_object, netcdf_file_names, normalization_dict,
+        normalization_dict_targ, num_examples_per_chunk=NUM_EXAMPLES_PER_CHUNK,
+        num_examples_per_batch=None, verbose=True, targ_LATinds=None,
+        targ_LONinds=None):
+    """Applies trained CNN to many files, one chunk of rows at a time.
+    E = number of examples in all files
+    T = number of target values per example
+    Only one chunk of predictors is in memory at a time (plus the next one,
+    which is read in a background thread while the model runs).  The output is
+    preallocated as float32.
+    :param cnn_model_object: Trained instance of `keras.models.Model`.
+    :param netcdf_file_names: 1-D list of paths to input files.
+    :param normalization_dict: See doc for `normalize_images`.
+    :param normalization_dict_targ: See doc for `denormalize_images_targ`.
+    :param num_examples_per_chunk: Number of examples per chunk.
+    :param num_examples_per_batch: Batch size for `predict`.  If None, will
+        use the autotuned batch size (see `_get_inference_batch_size`).
+    :param verbose: Boolean flag.  If True, progress messages will be printed.
+    :param targ_LATinds: See doc for `read_image_file`.
+    :param targ_LONinds: Same.
+    :return: prediction_matrix: E-by-T numpy array of denormalized
+        predictions.
+    """
+
+    chunk_tasks = _get_chunk_tasks(netcdf_file_names, num_examples_per_chunk)
+    num_examples_per_batch = _get_inference_batch_size(
+        cnn_model_object, num_examples_per_batch)
+    num_examples = sum([t[2] - t[1] for t in chunk_tasks])
+
+    prediction_matrix = None
+    this_first_row = 0
+
+    for i, this_image_dict in enumerate(
+            _iterate_chunks(chunk_tasks, targ_LATinds, targ_LONinds)):
+        if verbose:
+            print('Applying model to chunk {0:d} of {1:d}...'.format(
+                i + 1, len(chunk_tasks)
+            ))
+
+        this_predictor_matrix, _ = normalize_images(
+            predictor_matrix=this_image_dict[PREDICTOR_MATRIX_KEY],
+            predictor_names=this_image_dict[PREDICTOR_NAMES_KEY],
+            normalization_dict=normalization_dict)
+
+        this_prediction_matrix = cnn_model_object.predict(
+            this_predictor_matrix.astype('float32'),
+            batch_size=num_examples_per_batch)
+        this_prediction_matrix = denormalize_images_targ(
+            this_prediction_matrix, this_image_dict[TARGET_NAME_KEY],
+            normalization_dict_targ)
+
+        if prediction_matrix is None:
+            prediction_matrix = numpy.full(
+                (num_examples, this_prediction_matrix.shape[1]), numpy.nan,
+                dtype=numpy.float32)
+
+        this_last_row = this_first_row + this_prediction_matrix.shape[0]
+        prediction_matrix[this_first_row:this_last_row, :] = (
+            this_prediction_matrix)
+        this_first_row = this_last_row
+
+    return prediction_matrix
+
+
+def _update_error_sums(error_sum_dict, forecast_matrix, target_matrix):
+    """Updates running error sums for one forecast.
+    :param error_sum_dict: Dictionary with keys "num_values", "error_sum",
+        "absolute_error_sum" and "squared_error_sum", each an array with one
+        value per target column.  May be empty.
+    :param forecast_matrix: E-by-T numpy array of forecasts.
+    :param target_matrix: E-by-T numpy array of observations.
+    :return: error_sum_dict: Same as input but updated.
+    """
+
+    error_matrix = forecast_matrix - target_matrix
+    is_valid_matrix = numpy.isfinite(error_matrix)
+    error_matrix[numpy.invert(is_valid_matrix)] = 0.
+
+    these_sums = {
+        NUM_VALUES_KEY: numpy.sum(is_valid_matrix, axis=0),
+        ERROR_SUM_KEY: numpy.sum(error_matrix, axis=0),
+        ABSOLUTE_ERROR_SUM_KEY: numpy.sum(numpy.absolute(error_matrix), axis=0),
+        SQUARED_ERROR_SUM_KEY: numpy.sum(error_matrix ** 2, axis=0)
+    }
+
+    if not error_sum_dict:
+        return these_sums
+
+    for this_key in these_sums:
+        error_sum_dict[this_key] = error_sum_dict[this_key] + these_sums[this_key]
+
+    return error_sum_dict
+
+
+def read_raw_forecasts(netcdf_file_name, first_row=0, last_row=None):
+    """Reads raw WRF rainfall, keeping missing values.
+    Unlike the predictor matrix from `read_image_file`, in which NaNs are
+    filled with 0, missing values stay NaN here so they can be excluded from
+    verification.
+    :param netcdf_file_name: Path to input file.
+    :param first_row: First row (example) to read.
+    :param last_row: Last row to read (exclusive).  If None, reads to the end.
+    :return: raw_forecast_matrix: E-by-T numpy array of raw WRF rainfall.
+    """
+
+    dataset_object = netCDF4.Dataset(netcdf_file_name)
+    raw_forecast_matrix = numpy.ma.filled(
+        dataset_object.variables[NETCDF_rr_NAME][first_row:last_row, ...]
+        .astype(float), numpy.nan)
+    dataset_object.close()
+
+    return numpy.reshape(
+        raw_forecast_matrix, (raw_forecast_matrix.shape[0], -1))
+
+
+def verify_cnn_chunked(
+        cnn_model_object, netcdf_file_names, normalization_dict,
+        normalization_dict_targ, num_examples_per_chunk=NUM_EXAMPLES_PER_CHUNK,
+        num_examples_per_batch=None, verbose=True):
+    """Scores CNN and raw WRF rainfall against observations, chunk by chunk.
+    T = number of target values per example (lead times x stations)
+    Memory use is bounded by one chunk of predictors plus a few length-T
+    arrays of running sums.  Both forecasts are scored on the same points: those
+    where the observation, the raw forecast (see `read_raw_forecasts`) and the
+    CNN forecast are all valid.
+    :param cnn_model_object: See doc for `apply_cnn_chunked`.
+    :param netcdf_file_names: Same.
+    :param normalization_dict: Same.
+    :param normalization_dict_targ: Same.
+    :param num_examples_per_chunk: Same.
+    :param num_examples_per_batch: Same.
+    :param verbose: Same.
+    :return: score_dict: Dictionary with keys "cnn" and "raw".  Each value is a
+        dictionary with the following keys.
+    score_dict[forecast]['rmse']: length-T numpy array of RMSE values.
+    score_dict[forecast]['mae']: length-T numpy array of mean absolute errors.
+    score_dict[forecast]['bias']: length-T numpy array of mean errors.
+    score_dict[forecast]['num_values']: length-T numpy array of sample sizes.
+    score_dict[forecast]['overall_rmse']: RMSE over all columns.
+    """
+
+    chunk_tasks = _get_chunk_tasks(netcdf_file_names, num_examples_per_chunk)
+    num_examples_per_batch = _get_inference_batch_size(
+        cnn_model_object, num_examples_per_batch)
+    error_sum_dict_by_forecast = {CNN_FORECAST_KEY: {}, RAW_FORECAST_KEY: {}}
+
+    for i, this_image_dict in enumerate(_iterate_chunks(chunk_tasks)):
+        if verbose:
+            print('Verifying chunk {0:d} of {1:d}...'.format(
+                i + 1, len(chunk_tasks)
+            ))
+
+        this_target_matrix = this_image_dict[TARGET_MATRIX_KEY] + 0.
+        this_raw_matrix = read_raw_forecasts(*chunk_tasks[i])
+
+        this_predictor_matrix, _ = normalize_images(
+            predictor_matrix=this_image_dict[PREDICTOR_MATRIX_KEY],
+            predictor_names=this_image_dict[PREDICTOR_NAMES_KEY],
+            normalization_dict=normalization_dict)
+
+        this_prediction_matrix = cnn_model_object.predict(
+            this_predictor_matrix.astype('float32'),
+            batch_size=num_examples_per_batch)
+        this_prediction_matrix = denormalize_images_targ(
+            this_prediction_matrix, this_image_dict[TARGET_NAME_KEY],
+            normalization_dict_targ)
+
+        # NaN targets are skipped by `_update_error_sums`.
+        this_target_matrix[numpy.invert(numpy.logical_and(
+            numpy.isfinite(this_raw_matrix),
+            numpy.isfinite(this_prediction_matrix)
+        ))] = numpy.nan
+
+        error_sum_dict_by_forecast[CNN_FORECAST_KEY] = _update_error_sums(
+            error_sum_dict_by_forecast[CNN_FORECAST_KEY],
+            this_prediction_matrix.astype(float), this_target_matrix)
+        error_sum_dict_by_forecast[RAW_FORECAST_KEY] = _update_error_sums(
+            error_sum_dict_by_forecast[RAW_FORECAST_KEY], this_raw_matrix,
+            this_target_matrix)
+
+    score_dict = {}
+
+    for this_forecast_key in error_sum_dict_by_forecast:
+        this_sum_dict = error_sum_dict_by_forecast[this_forecast_key]
+        these_counts = this_sum_dict[NUM_VALUES_KEY].astype(float)
+
+        score_dict[this_forecast_key] = {
+            RMSE_KEY: numpy.sqrt(
+                this_sum_dict[SQUARED_ERROR_SUM_KEY] / these_counts),
+            MAE_KEY: this_sum_dict[ABSOLUTE_ERROR_SUM_KEY] / these_counts,
+            BIAS_KEY: this_sum_dict[ERROR_SUM_KEY] / these_counts,
+            NUM_VALUES_KEY: this_sum_dict[NUM_VALUES_KEY],
+            OVERALL_RMSE_KEY: numpy.sqrt(
+                numpy.sum(this_sum_dict[SQUARED_ERROR_SUM_KEY]) /
+                numpy.sum(these_counts)
+            )
+        }
+
+        if verbose:
+            print('Overall RMSE for "{0:s}" = {1:.4f}'.format(
+                this_forecast_key, score_dict[this_forecast_key][
+                    OVERALL_RMSE_KEY]
+            ))
+
+    return score_dict
+
+
+def _check_day_zero_time_string(day_zero_time_string):
+    """Error-checks date of day 0.
+    :param day_zero_time_string: Date of day 0 for the "Days" variable.
+    :raises: ValueError: if `day_zero_time_string` is not a date in format
+        "%Y-%m-%d".
+    """
+
+    try:
+        time.strptime(str(day_zero_time_string), '%Y-%m-%d')
+    except ValueError:
+        error_string = (
+            'day_zero_time_string ("{0:s}") must be the date of day 0 in '
+            'format "%Y-%m-%d".'
+        ).format(str(day_zero_time_string))
+        raise ValueError(error_string)
+
+
+def _read_file_times_unix(dataset_object, day_zero_time_string):
+    """Reads valid times for each example in one NetCDF file.
+    The "Days" variable in the archive has units "nday", with no reference
+    date, so the date of day 0 must be known by the caller.
+    :param dataset_object: Instance of `netCDF4.Dataset`.
+    :param day_zero_time_string: Date of day 0 (format "%Y-%m-%d").  Ignored if
+        the units attribute of the time variable is "days since <date>".
+    :return: unix_times_sec: 1-D numpy array of times in Unix format.
+    """
+
+    time_variable_object = dataset_object.variables[NETCDF_TIME_NAME]
+    time_units = getattr(time_variable_object, 'units', '')
+
+    if time_units.startswith('days since'):
+        day_zero_time_string = time_units.split('since')[1].strip()[:10]
+
+    day_zero_unix_sec = time_strings_to_unix([day_zero_time_string])[0]
+    num_days = numpy.array(time_variable_object[:], dtype=numpy.int64)
+
+    return day_zero_unix_sec + num_days * DAYS_TO_SECONDS
+
+
+def read_file_times(netcdf_file_name, day_zero_time_string):
+    """Reads valid times for each example in one NetCDF file.
+    Only the time variable is read.
+    :param netcdf_file_name: Path to input file.
+    :param day_zero_time_string: See doc for `_read_file_times_unix`.
+    :return: unix_times_sec: 1-D numpy array of times in Unix format.
+    """
+
+    _check_day_zero_time_string(day_zero_time_string)
+
+    dataset_object = netCDF4.Dataset(netcdf_file_name)
+    unix_times_sec = _read_file_times_unix(dataset_object, day_zero_time_string)
+    dataset_object.close()
+
+    return unix_times_sec
+
+
+def _get_summary_stats(variable_object,
+                       num_examples_per_chunk=NUM_EXAMPLES_PER_CHUNK):
+    """Computes summary stats for one NetCDF variable, chunk by chunk.
+    :param variable_object: Instance of `netCDF4.Variable` (first dimension is
+        example).
+    :param num_examples_per_chunk: Number of examples read at once.
+    :return: summary_dict: Dictionary with keys "num_values",
+        "num_nan_values", "mean_value", "min_value" and "max_value" (the last
+        three are NaN if there are no finite values).
+    """
+
+    num_values = 0
+    num_nan_values = 0
+    value_sum = 0.
+    min_value = numpy.inf
+    max_value = -numpy.inf
+
+    for i in range(0, variable_object.shape[0], num_examples_per_chunk):
+        these_values = numpy.ma.filled(
+            variable_object[i:(i + num_examples_per_chunk), ...].astype(float),
+            numpy.nan)
+        this_num_values = these_values.size
+        these_values = these_values[numpy.isfinite(these_values)]
+
+        num_nan_values += int(this_num_values - these_values.size)
+        if these_values.size == 0:
+            continue
+
+        num_values += int(these_values.size)
+        value_sum += float(numpy.sum(these_values))
+        min_value = min([min_value, float(numpy.min(these_values))])
+        max_value = max([max_value, float(numpy.max(these_values))])
+
+    if num_values == 0:
+        return {
+            NUM_VALUES_KEY: 0, NUM_NAN_VALUES_KEY: num_nan_values,
+            MEAN_VALUE_KEY: numpy.nan, MIN_VALUE_KEY: numpy.nan,
+            MAX_VALUE_KEY: numpy.nan
+        }
+
+    return {
+        NUM_VALUES_KEY: num_values,
+        NUM_NAN_VALUES_KEY: num_nan_values,
+        MEAN_VALUE_KEY: value_sum / num_values,
+        MIN_VALUE_KEY: min_value,
+        MAX_VALUE_KEY: max_value
+    }
+
+
+def _get_file_index_entry(netcdf_file_name, day_zero_time_string):
+    """Creates file-index entry for one NetCDF file.
+    Row counts come from variable shapes and summary stats are computed chunk
+    by chunk, so no variable is read in full.
+    :param netcdf_file_name: Path to input file.
+    :param day_zero_time_string: See doc for `_read_file_times_unix`.
+    :return: file_entry_dict: Dictionary with keys listed in doc for
+        `build_file_index`.
+    """
+
+    dataset_object = netCDF4.Dataset(netcdf_file_name)
+    unix_times_sec = _read_file_times_unix(dataset_object, day_zero_time_string)
+
+    summary_dict = {}
+    for this_name in NETCDF_PREDICTOR_NAMES + [NETCDF_TARGET_NAME]:
+        if this_name not in dataset_object.variables:
+            continue
+
+        summary_dict[this_name] = _get_summary_stats(
+            dataset_object.variables[this_name])
+
+    file_entry_dict = {
+        FILE_NAME_KEY: netcdf_file_name,
+        FILE_SIZE_KEY: os.path.getsize(netcdf_file_name),
+        FILE_MTIME_KEY: os.path.getmtime(netcdf_file_name),
+        NUM_EXAMPLES_KEY: int(
+            dataset_object.variables[NETCDF_TARGET_NAME].shape[0]),
+        VARIABLE_NAMES_KEY: list(dataset_object.variables.keys()),
+        FIRST_TIME_KEY: int(numpy.min(unix_times_sec)),
+        LAST_TIME_KEY: int(numpy.max(unix_times_sec)),
+        TIMES_KEY: unix_times_sec.tolist(),
+        SUMMARY_STATS_KEY: summary_dict
+    }
+
+    dataset_object.close()
+    return file_entry_dict
+
+
+def build_file_index(netcdf_file_names, day_zero_time_string,
+                     index_file_name=None):
+    """Builds (or updates) persistent index of NetCDF files.
+    If `index_file_name` already exists (and was built with the same day 0),
+    entries for files whose size and modification time have not changed are
+    reused, so only new or modified files are opened.
+    :param netcdf_file_names: 1-D list of paths to input files.
+    :param day_zero_time_string: Date of day 0 for the "Days" variable (format
+        "%Y-%m-%d").  See doc for `_read_file_times_unix`.
+    :param index_file_name: Path to JSON index file.  If None, the index will
+        not be persisted.
+    :return: file_index_dict: Dictionary with the following keys.
+    file_index_dict['day_zero_time_string']: Same as input.
+    file_index_dict['file_entries']: 1-D list of dictionaries (one per file,
+        sorted by first time), each with the following keys.
+    entry['file_name']: Path to file.
+    entry['file_size_bytes']: File size.
+    entry['file_mtime']: Modification time.
+    entry['num_examples']: Number of rows (days).
+    entry['variable_names']: 1-D list of variables in file.
+    entry['first_time_unix_sec']: First valid time.
+    entry['last_time_unix_sec']: Last valid time.
+    entry['times_unix_sec']: 1-D list of valid times (one per row).
+    entry['summary_stats']: Dictionary with count, NaN count, mean, min and
+        max for each predictor and the target.
+    """
+
+    _check_day_zero_time_string(day_zero_time_string)
+
+    old_entry_dict_by_file = {}
+    if index_file_name is not None and os.path.isfile(index_file_name):
+        old_file_index_dict = read_file_index(index_file_name)
+
+        # Times in an index built with another day 0 are all wrong.
+        if (old_file_index_dict.get(DAY_ZERO_TIME_KEY) ==
+                day_zero_time_string):
+            for this_entry_dict in old_file_index_dict[FILE_ENTRIES_KEY]:
+                old_entry_dict_by_file[this_entry_dict[FILE_NAME_KEY]] = (
+                    this_entry_dict)
+
+    file_entry_dicts = []
+
+    for this_file_name in netcdf_file_names:
+        this_entry_dict = old_entry_dict_by_file.get(this_file_name)
+
+        if (this_entry_dict is not None and
+                this_entry_dict[FILE_SIZE_KEY] ==
+                os.path.getsize(this_file_name) and
+                this_entry_dict[FILE_MTIME_KEY] ==
+                os.path.getmtime(this_file_name)):
+            file_entry_dicts.append(this_entry_dict)
+            continue
+
+        print('Indexing "{0:s}"...'.format(this_file_name))
+        file_entry_dicts.append(
+            _get_file_index_entry(this_file_name, day_zero_time_string))
+
+    file_entry_dicts.sort(key=lambda d: d[FIRST_TIME_KEY])
+    file_index_dict = {
+        DAY_ZERO_TIME_KEY: day_zero_time_string,
+        FILE_ENTRIES_KEY: file_entry_dicts
+    }
+
+    if index_file_name is not None:
+        _create_directory(file_name=index_file_name)
+        with open(index_file_name, 'w') as this_file:
+            json.dump(file_index_dict, this_file)
+
+    return file_index_dict
+
+
+def read_file_index(index_file_name):
+    """Reads file index from JSON file.
+    :param index_file_name: Path to input file (written by `build_file_index`).
+    :return: file_index_dict: See doc for `build_file_index`.
+    """
+
+    with open(index_file_name) as this_file:
+        return json.load(this_file)
+
+
+def find_rows_in_date_range(file_index_dict, first_time_string,
+                            last_time_string):
+    """Finds all rows valid in a date range, using only the file index.
+    :param file_index_dict: Dictionary created by `build_file_index`.
+    :param first_time_string: First date in range (ISO-8601, e.g.
+        "2012-10-01").
+    :param last_time_string: Last date in range (inclusive).
+    :return: netcdf_file_names: 1-D list of files with at least one row in the
+        range.
+    :return: row_indices_by_file: 1-D list (same length) of numpy arrays, each
+        containing row indices within the file.
+    """
+
+    first_time_unix_sec, last_time_unix_sec = time_strings_to_unix(
+        [first_time_string, last_time_string])
+
+    netcdf_file_names = []
+    row_indices_by_file = []
+
+    for this_entry_dict in file_index_dict[FILE_ENTRIES_KEY]:
+        if (this_entry_dict[LAST_TIME_KEY] < first_time_unix_sec or
+                this_entry_dict[FIRST_TIME_KEY] > last_time_unix_sec):
+            continue
+
+        these_times_unix_sec = numpy.array(this_entry_dict[TIMES_KEY])
+        these_row_indices = numpy.where(numpy.logical_and(
+            these_times_unix_sec >= first_time_unix_sec,
+            these_times_unix_sec <= last_time_unix_sec
+        ))[0]
+
+        if len(these_row_indices) == 0:
+            continue
+
+        netcdf_file_names.append(this_entry_dict[FILE_NAME_KEY])
+        row_indices_by_file.append(these_row_indices)
+
+    return netcdf_file_names, row_indices_by_file
+
+
+def read_date_range(file_index_dict, first_time_string, last_time_string,
+                    predictor_names=None, targ_LATinds=None,
+                    targ_LONinds=None):
+    """Reads all rows valid in a date range, opening only the files involved.
+    :param file_index_dict: See doc for `find_rows_in_date_range`.
+    :param first_time_string: Same.
+    :param last_time_string: Same.
+    :param predictor_names: See doc for `ImageDataset`.
+    :param targ_LATinds: Same.
+    :param targ_LONinds: Same.
+    :return: image_dict: See doc for `read_image_file`, with one extra key.
+    image_dict['times_unix_sec']: 1-D numpy array of valid times (one per row).
+    """
+
+    netcdf_file_names, row_indices_by_file = find_rows_in_date_range(
+        file_index_dict=file_index_dict, first_time_string=first_time_string,
+        last_time_string=last_time_string)
+
+    if len(netcdf_file_names) == 0:
+        error_string = 'No rows found between {0:s} and {1:s}.'.format(
+            first_time_string, last_time_string)
+        raise ValueError(error_string)
+
+    image_dataset = ImageDataset(
+        netcdf_file_names, predictor_names=predictor_names,
+        targ_LATinds=targ_LATinds, targ_LONinds=targ_LONinds)
+
+    row_indices = numpy.concatenate([
+        image_dataset.row_offsets[i] + row_indices_by_file[i]
+        for i in range(len(netcdf_file_names))
+    ])
+
+    image_dict = image_dataset[row_indices]
+    image_dataset.close()
+
+    entry_dict_by_file = dict([
+        (d[FILE_NAME_KEY], d) for d in file_index_dict[FILE_ENTRIES_KEY]
+    ])
+    image_dict[TIMES_KEY] = numpy.concatenate([
+        numpy.array(entry_dict_by_file[f][TIMES_KEY])[r]
+        for f, r in zip(netcdf_file_names, row_indices_by_file)
+    ])
+
+    return image_dict
+
+
+def pack_training_shards(
+        netcdf_file_names, output_directory_name, normalization_dict=None,
+        normalization_dict_targ=None, max_examples_per_shard=100000,
+        targ_LATinds=None, targ_LONinds=None):
+    """Packs training files into large contiguous arrays on disk.
+    Each shard is a pair of .npy files (predictors and targets, both float32)
+    holding the examples from one or more whole input files.  Predictor NaNs
+    are already filled (see `read_image_file`).  If normalization dictionaries
+    are given, the arrays are stored pre-normalized, so batches can be read
+    straight out of the memory map by `shard_generator`.
+    :param netcdf_file_names: 1-D list of paths to input files.
+    :param output_directory_name: Name of output directory.
+    :param normalization_dict: See doc for `normalize_images`.  If None,
+        predictors will be stored unnormalized.
+    :param normalization_dict_targ: See doc for `normalize_images_targ`.  If
+        None, targets will be stored unnormalized.
+    :param max_examples_per_shard: Max number of examples per shard.  A file is
+        never split across shards, so a shard may exceed this if one file is
+        larger.
+    :param targ_LATinds: See doc for `read_image_file`.
+    :param targ_LONinds: Same.
+    :return: shard_metafile_name: Path to JSON file with the offset index (read
+        by `read_training_shards`).
+    """
+
+    _create_directory(directory_name=output_directory_name)
+
+    num_examples_by_file = numpy.array(
+        [_get_num_examples_in_file(f) for f in netcdf_file_names], dtype=int)
+
+    # Assign whole files to shards.
+    shard_index_by_file = numpy.full(len(netcdf_file_names), -1, dtype=int)
+    this_shard_index = 0
+    this_num_examples = 0
+
+    for i in range(len(netcdf_file_names)):
+        if (this_num_examples > 0 and
+                this_num_examples + num_examples_by_file[i] >
+                max_examples_per_shard):
+            this_shard_index += 1
+            this_num_examples = 0
+
+        shard_index_by_file[i] = this_shard_index
+        this_num_examples += num_examples_by_file[i]
+
+    num_shards = this_shard_index + 1
+    shard_file_names = []
+    file_row_offsets = numpy.concatenate((
+        numpy.array([0], dtype=int), numpy.cumsum(num_examples_by_file)
+    ))
+    predictor_names = None
+    target_name = None
+
+    for j in range(num_shards):
+        these_file_indices = numpy.where(shard_index_by_file == j)[0]
+        this_num_examples = int(numpy.sum(
+            num_examples_by_file[these_file_indices]
+        ))
+
+        this_predictor_file_name = '{0:s}/shard{1:06d}_predictors.npy'.format(
+            output_directory_name, j)
+        this_target_file_name = '{0:s}/shard{1:06d}_targets.npy'.format(
+            output_directory_name, j)
+
+        this_predictor_matrix = None
+        this_target_matrix = None
+        this_first_row = 0
+
+        for i in these_file_indices:
+            print('Packing "{0:s}" into shard {1:d} of {2:d}...'.format(
+                netcdf_file_names[i], j + 1, num_shards
+            ))
+
+            if (targ_LATinds is None) & (targ_LONinds is None):
+                this_image_dict = read_image_file(netcdf_file_names[i])
+            else:
+                this_image_dict = read_image_file(
+                    netcdf_file_names[i], targ_LATinds, targ_LONinds)
+
+            predictor_names = this_image_dict[PREDICTOR_NAMES_KEY]
+            target_name = this_image_dict[TARGET_NAME_KEY]
+            these_predictors = this_image_dict[PREDICTOR_MATRIX_KEY]
+            these_targets = this_image_dict[TARGET_MATRIX_KEY]
+
+            if normalization_dict is not None:
+                these_predictors, _ = normalize_images(
+                    predictor_matrix=these_predictors,
+                    predictor_names=predictor_names,
+                    normalization_dict=normalization_dict)
+
+            if normalization_dict_targ is not None:
+                these_targets, _ = normalize_images_targ(
+                    targ_matrix=these_targets, targ_names=target_name,
+                    normalization_dict=normalization_dict_targ)
+
+            if this_predictor_matrix is None:
+                this_predictor_matrix = numpy.lib.format.open_memmap(
+                    this_predictor_file_name, mode='w+', dtype=numpy.float32,
+                    shape=(this_num_examples,) + these_predictors.shape[1:])
+                this_target_matrix = numpy.lib.format.open_memmap(
+                    this_target_file_name, mode='w+', dtype=numpy.float32,
+                    shape=(this_num_examples,) + these_targets.shape[1:])
+
+            this_last_row = this_first_row + these_targets.shape[0]
+            this_predictor_matrix[this_first_row:this_last_row, ...] = (
+                these_predictors)
+            this_target_matrix[this_first_row:this_last_row, ...] = (
+                these_targets)
+            this_first_row = this_last_row
+
+        this_predictor_matrix.flush()
+        this_target_matrix.flush()
+        del this_predictor_matrix, this_target_matrix
+
+        shard_file_names.append(
+            [os.path.split(this_predictor_file_name)[1],
+             os.path.split(this_target_file_name)[1]]
+        )
+
+    shard_metadata_dict = _metadata_numpy_to_list({
+        SHARD_FILE_NAMES_KEY: shard_file_names,
+        SOURCE_FILES_KEY: list(netcdf_file_names),
+        SHARD_INDEX_BY_FILE_KEY: shard_index_by_file.tolist(),
+        FILE_ROW_OFFSETS_KEY: file_row_offsets.tolist(),
+        PREDICTOR_NAMES_KEY: predictor_names,
+        TARGET_NAME_KEY: target_name,
+        NORMALIZATION_DICT_KEY: normalization_dict,
+        NORMALIZATION_DICT_TARG_KEY: normalization_dict_targ
+    })
+
+    shard_metafile_name = '{0:s}/{1:s}'.format(
+        output_directory_name, SHARD_METAFILE_NAME)
+    with open(shard_metafile_name, 'w') as this_file:
+        json.dump(shard_metadata_dict, this_file)
+
+    return shard_metafile_name
+
+
+def read_training_shards(shard_directory_name):
+    """Opens training shards as read-only memory maps.
+    :param shard_directory_name: Name of directory created by
+        `pack_training_shards`.
+    :return: shard_dict: Dictionary with all keys in the JSON offset index,
+        plus the following.
+    shard_dict['shard_predictor_matrices']: 1-D list of memory-mapped predictor
+        arrays (one per shard).
+    shard_dict['shard_target_matrices']: 1-D list of memory-mapped target
+        arrays (one per shard).
+    """
+
+    with open('{0:s}/{1:s}'.format(
+            shard_directory_name, SHARD_METAFILE_NAME)) as this_file:
+        shard_dict = _metadata_list_to_numpy(json.load(this_file))
+
+    shard_dict[SHARD_PREDICTOR_MATRICES_KEY] = []
+    shard_dict[SHARD_TARGET_MATRICES_KEY] = []
+
+    for this_predictor_file_name, this_target_file_name in shard_dict[
+            SHARD_FILE_NAMES_KEY]:
+        shard_dict[SHARD_PREDICTOR_MATRICES_KEY].append(numpy.load(
+            '{0:s}/{1:s}'.format(
+                shard_directory_name, this_predictor_file_name),
+            mmap_mode='r'
+        ))
+        shard_dict[SHARD_TARGET_MATRICES_KEY].append(numpy.load(
+            '{0:s}/{1:s}'.format(shard_directory_name, this_target_file_name),
+            mmap_mode='r'
+        ))
+
+    return shard_dict
+
+
+def _normalization_dicts_equal(first_normalization_dict,
+                               second_normalization_dict):
+    """Determines whether two normalization dictionaries are the same.
+    :param first_normalization_dict: See doc for `normalize_images` or
+        `normalize_images_targ`.  May be None.
+    :param second_normalization_dict: Same.
+    :return: equal_flag: Boolean flag.
+    """
+
+    if first_normalization_dict is None or second_normalization_dict is None:
+        return first_normalization_dict is second_normalization_dict
+
+    if set(first_normalization_dict) != set(second_normalization_dict):
+        return False
+
+    for this_key in first_normalization_dict:
+        these_first_params = numpy.asarray(
+            first_normalization_dict[this_key], dtype=float)
+        these_second_params = numpy.asarray(
+            second_normalization_dict[this_key], dtype=float)
+
+        if these_first_params.shape != these_second_params.shape:
+            return False
+        if not numpy.allclose(these_first_params, these_second_params,
+                              rtol=1e-6, atol=0., equal_nan=True):
+            return False
+
+    return True
+
+
+def check_shard_normalization(shard_dict, normalization_dict,
+                              normalization_dict_targ,
+                              require_pre_normalized=False):
+    """Ensures that shards were packed with the given normalization params.
+    :param shard_dict: Dictionary created by `read_training_shards`.
+    :param normalization_dict: See doc for `normalize_images`.  If None, the
+        predictor params are not checked.
+    :param normalization_dict_targ: See doc for `normalize_images_targ`.  If
+        None, the target params are not checked.
+    :param require_pre_normalized: Boolean flag.  If True, shards packed
+        without normalization are also rejected.
+    :raises: ValueError: if pre-normalized shards were packed with different
+        params, or if `require_pre_normalized = True` and the shards are not
+        pre-normalized.
+    """
+
+    for this_dict_key, this_normalization_dict in [
+            (NORMALIZATION_DICT_KEY, normalization_dict),
+            (NORMALIZATION_DICT_TARG_KEY, normalization_dict_targ)
+    ]:
+        if this_normalization_dict is None:
+            continue
+
+        this_shard_normalization_dict = shard_dict[this_dict_key]
+
+        if this_shard_normalization_dict is None:
+            if not require_pre_normalized:
+                continue
+
+            error_string = (
+                'Shards were packed without normalization, but "{0:s}" is '
+                'required.'
+            ).format(this_dict_key)
+            raise ValueError(error_string)
+
+        if not _normalization_dicts_equal(
+                this_shard_normalization_dict, this_normalization_dict):
+            error_string = (
+                'Shards were packed with a different "{0:s}" than the one '
+                'given.'
+            ).format(this_dict_key)
+            raise ValueError(error_string)
+
+
+def get_random_batch_indices(num_examples, num_examples_per_batch):
+    """Splits a random permutation of all examples into batches.
+    Like `numpy.random.choice` in `deep_learning_generator`, each batch is a
+    random draw from the whole training set (not a run of consecutive days).
+    Indices within each batch are sorted, so that reading them from a memory
+    map touches the file in order.
+    :param num_examples: Total number of examples.
+    :param num_examples_per_batch: Number of examples per batch.
+    :return: batch_indices: 1-D list of numpy arrays, each with
+        `num_examples_per_batch` example indices.  Leftover examples (fewer
+        than one batch) are dropped.
+    """
+
+    num_batches = num_examples // num_examples_per_batch
+    permuted_indices = numpy.random.permutation(num_examples)[
+        :(num_batches * num_examples_per_batch)]
+
+    return [
+        numpy.sort(m) for m in
+        numpy.reshape(permuted_indices, (num_batches, num_examples_per_batch))
+    ]
+
+
+def read_shard_rows(shard_matrices, example_indices):
+    """Reads rows from shards, given indices over all shards.
+    :param shard_matrices: 1-D list of numpy arrays (or memory maps), one per
+        shard, with examples along the first axis.
+    :param example_indices: Sorted 1-D numpy array of example indices, counting
+        across shards in order.
+    :return: data_matrix: numpy array with the selected rows.
+    """
+
+    shard_offsets = numpy.cumsum([0] + [m.shape[0] for m in shard_matrices])
+    shard_indices = numpy.searchsorted(
+        shard_offsets, example_indices, side='right') - 1
+
+    return numpy.concatenate([
+        shard_matrices[j][
+            example_indices[shard_indices == j] - shard_offsets[j], ...]
+        for j in numpy.unique(shard_indices)
+    ], axis=0)
+
+
+def shard_generator(shard_directory_name, num_examples_per_batch,
+                    normalization_dict=None, normalization_dict_targ=None,
+                    generator_state_dict=None):
+    """Generates training examples from memory-mapped shards.
+    Each pass over the data, all examples are shuffled and split into batches
+    (see `get_random_batch_indices`), so each batch is a random sample of the
+    training set.  Rows are gathered from the memory map, so if the shards are
+    pre-normalized, only the batch itself is copied and nothing is decoded.
+    :param shard_directory_name: Name of directory created by
+        `pack_training_shards`.
+    :param num_examples_per_batch: Number of examples per training batch.
+    :param normalization_dict: See doc for `normalize_images`.  Used only if
+        predictors in the shards are not pre-normalized.  Otherwise, if not
+        None, this must match the params the shards were packed with.
+    :param normalization_dict_targ: See doc for `normalize_images_targ`.  Used
+        only if targets in the shards are not pre-normalized.  Otherwise, if
+        not None, this must match the params the shards were packed with.
+    :param generator_state_dict: Dictionary holding the position of the
+        generator (batches of the current pass and index of the next batch).
+        See doc for `deep_learning_generator`.
+    :return: predictor_matrix: See doc for `deep_learning_generator`.
+    :return: target_values: Same.
+    :raises: TypeError: if shards are not pre-normalized and the relevant
+        normalization dictionary is None.
+    :raises: ValueError: if there are fewer than `num_examples_per_batch`
+        examples, or if the shards were pre-normalized with other params (see
+        `check_shard_normalization`).
+    """
+
+    shard_dict = read_training_shards(shard_directory_name)
+    check_shard_normalization(
+        shard_dict, normalization_dict, normalization_dict_targ)
+    predictor_names = shard_dict[PREDICTOR_NAMES_KEY]
+    target_name = shard_dict[TARGET_NAME_KEY]
+
+    normalize_predictors = shard_dict[NORMALIZATION_DICT_KEY] is None
+    normalize_targets = shard_dict[NORMALIZATION_DICT_TARG_KEY] is None
+
+    if normalize_predictors and normalization_dict is None:
+        error_string = (
+            'Shards are not pre-normalized, so normalization_dict cannot be '
+            'None.')
+        raise TypeError(error_string)
+
+    if normalize_targets and normalization_dict_targ is None:
+        error_string = (
+            'Shards are not pre-normalized, so normalization_dict_targ cannot '
+            'be None.')
+        raise TypeError(error_string)
+
+    shard_predictor_matrices = shard_dict[SHARD_PREDICTOR_MATRICES_KEY]
+    shard_target_matrices = shard_dict[SHARD_TARGET_MATRICES_KEY]
+    num_examples = sum([m.shape[0] for m in shard_target_matrices])
+
+    if num_examples < num_examples_per_batch:
+        error_string = (
+            'Shards have {0:d} examples, fewer than one batch ({1:d}).'
+        ).format(num_examples, num_examples_per_batch)
+        raise ValueError(error_string)
+
+    if generator_state_dict is None:
+        generator_state_dict = {}
+
+    while True:
+        if (generator_state_dict.get(GENERATOR_NEXT_BATCH_KEY, 0) >=
+                len(generator_state_dict.get(GENERATOR_BATCH_INDICES_KEY, []))):
+            generator_state_dict[GENERATOR_BATCH_INDICES_KEY] = (
+                get_random_batch_indices(num_examples, num_examples_per_batch)
+            )
+            generator_state_dict[GENERATOR_NEXT_BATCH_KEY] = 0
+
+        these_indices = generator_state_dict[GENERATOR_BATCH_INDICES_KEY][
+            generator_state_dict[GENERATOR_NEXT_BATCH_KEY]]
+        generator_state_dict[GENERATOR_NEXT_BATCH_KEY] += 1
+
+        predictor_matrix = read_shard_rows(
+            shard_predictor_matrices, these_indices)
+        target_values = read_shard_rows(
+            shard_target_matrices, these_indices)
+
+        if normalize_predictors:
+            predictor_matrix, _ = normalize_images(
+                predictor_matrix=numpy.array(predictor_matrix),
+                predictor_names=predictor_names,
+                normalization_dict=normalization_dict)
+
+        if normalize_targets:
+            target_values, _ = normalize_images_targ(
+                targ_matrix=numpy.array(target_values),
+                targ_names=target_name,
+                normalization_dict=normalization_dict_targ)
+            target_values = target_values.astype('float32')
+
+        yield (predictor_matrix, target_values)
+
+
+def get_shared_dataset_dir_name(dataset_name,
+                                shared_memory_dir_name=SHARED_MEMORY_DIR_NAME):
+    """Returns directory holding a shared-memory dataset.
+    :param dataset_name: Name of dataset.
+    :param shared_memory_dir_name: Name of RAM-backed (tmpfs) directory.
+    :return: dataset_dir_name: Directory name (can be passed as
+        `training_shard_dir_name` to `train_cnn`).
+    """
+
+    return os.path.join(
+        shared_memory_dir_name, SHARED_DATASET_PREFIX + dataset_name)
+
+
+def create_shared_dataset(
+        netcdf_file_names, dataset_name, normalization_dict=None,
+        normalization_dict_targ=None, targ_LATinds=None, targ_LONinds=None,
+        shared_memory_dir_name=SHARED_MEMORY_DIR_NAME):
+    """Decodes dataset once into named shared memory.
+    Predictors and targets are written as one float32 shard (see
+    `pack_training_shards`) in a RAM-backed directory, with the JSON offset
+    index as the descriptor.  Any process on the node can then attach
+    (`attach_shared_dataset`) or train from it (`train_cnn` with
+    `training_shard_dir_name=get_shared_dataset_dir_name(dataset_name)`)
+    without a private copy, since memory-mapping tmpfs pages is zero-copy.
+    :param netcdf_file_names: 1-D list of paths to input files.
+    :param dataset_name: Name of dataset (unique on the node).
+    :param normalization_dict: See doc for `pack_training_shards`.
+    :param normalization_dict_targ: Same.
+    :param targ_LATinds: See doc for `read_image_file`.
+    :param targ_LONinds: Same.
+    :param shared_memory_dir_name: See doc for `get_shared_dataset_dir_name`.
+    :return: descriptor_file_name: Path to JSON descriptor.
+    :raises: ValueError: if the dataset already exists or would not fit in the
+        shared-memory directory.
+    """
+
+    dataset_dir_name = get_shared_dataset_dir_name(
+        dataset_name, shared_memory_dir_name)
+
+    if os.path.isdir(dataset_dir_name):
+        error_string = (
+            'Shared dataset "{0:s}" already exists (release it first).'
+        ).format(dataset_name)
+        raise ValueError(error_string)
+
+    image_dataset = ImageDataset(
+        netcdf_file_names, targ_LATinds=targ_LATinds,
+        targ_LONinds=targ_LONinds)
+    this_image_dict = image_dataset[0:1]
+    num_examples = len(image_dataset)
+    image_dataset.close()
+
+    num_bytes_needed = 4 * num_examples * (
+        this_image_dict[PREDICTOR_MATRIX_KEY][0, ...].size +
+        this_image_dict[TARGET_MATRIX_KEY][0, ...].size
+    )
+    this_stat = os.statvfs(shared_memory_dir_name)
+    num_bytes_available = this_stat.f_bavail * this_stat.f_frsize
+
+    if num_bytes_needed > num_bytes_available:
+        error_string = (
+            'Shared dataset needs {0:d} bytes, but only {1:d} are available in '
+            '"{2:s}".'
+        ).format(num_bytes_needed, num_bytes_available, shared_memory_dir_name)
+        raise ValueError(error_string)
+
+    # A partial directory would make every retry fail with "already exists".
+    try:
+        return pack_training_shards(
+            netcdf_file_names=netcdf_file_names,
+            output_directory_name=dataset_dir_name,
+            normalization_dict=normalization_dict,
+            normalization_dict_targ=normalization_dict_targ,
+            max_examples_per_shard=num_examples, targ_LATinds=targ_LATinds,
+            targ_LONinds=targ_LONinds)
+    except BaseException:
+        release_shared_dataset(dataset_name, shared_memory_dir_name)
+        raise
+
+
+def attach_shared_dataset(dataset_name,
+                          shared_memory_dir_name=SHARED_MEMORY_DIR_NAME):
+    """Attaches (zero-copy, read-only) to a shared-memory dataset.
+    :param dataset_name: Name of dataset.
+    :param shared_memory_dir_name: See doc for `get_shared_dataset_dir_name`.
+    :return: shard_dict: See doc for `read_training_shards`.
+    """
+
+    return read_training_shards(get_shared_dataset_dir_name(
+        dataset_name, shared_memory_dir_name))
+
+
+def release_shared_dataset(dataset_name,
+                           shared_memory_dir_name=SHARED_MEMORY_DIR_NAME):
+    """Frees a shared-memory dataset.
+    Processes still attached keep their mappings until they exit.
+    :param dataset_name: Name of dataset.
+    :param shared_memory_dir_name: See doc for `get_shared_dataset_dir_name`.
+    """
+
+    shutil.rmtree(
+        get_shared_dataset_dir_name(dataset_name, shared_memory_dir_name),
+        ignore_errors=True)
+
+
+def read_validation_data(validation_file_names, normalization_dict,
+                         normalization_dict_targ, targ_LATinds=None,
+                         targ_LONinds=None):
+    """Reads, normalizes and casts the full validation set once.
+    E = number of examples in all files
+    M = number of rows in each grid (lats)
+    N = number of columns in each grid (lons)
+    C = number of channels (predictor variables)
+    T = number of target values per example
+    Each file is normalized and cast to float32 before being concatenated, so
+    peak memory is one float64 file plus the float32 result.
+    :param validation_file_names: 1-D list of paths to input (NetCDF) files.
+    :param normalization_dict: See doc for `normalize_images`.
+    :param normalization_dict_targ: See doc for `normalize_images_targ`.
+    :return: predictor_matrix: E-by-M-by-N-by-C numpy array (float32) of
+        normalized predictor values.
+    :return: target_matrix: E-by-T numpy array (float32) of normalized target
+        values.
+    """
+
+    predictor_matrices = []
+    target_matrices = []
+
+    for this_file_name in validation_file_names:
+        print('Reading validation data from: "{0:s}"...'.format(
+            this_file_name))
+
+        this_image_dict = _read_training_file(
+            this_file_name, targ_LATinds, targ_LONinds)
+
+        this_predictor_matrix, _ = normalize_images(
+            predictor_matrix=this_image_dict[PREDICTOR_MATRIX_KEY],
+            predictor_names=this_image_dict[PREDICTOR_NAMES_KEY],
+            normalization_dict=normalization_dict)
+        predictor_matrices.append(this_predictor_matrix.astype('float32'))
+
+        this_target_matrix, _ = normalize_images_targ(
+            targ_matrix=this_image_dict[TARGET_MATRIX_KEY],
+            targ_names=this_image_dict[TARGET_NAME_KEY],
+            normalization_dict=normalization_dict_targ)
+        target_matrices.append(this_target_matrix.astype('float32'))
+
+    return (numpy.concatenate(predictor_matrices, axis=0),
+            numpy.concatenate(target_matrices, axis=0))
+
+
+class ResidentValidationCallback(keras.callbacks.Callback):
+    """Scores the whole in-memory validation set at the end of each epoch.
+    The loss is written to `logs['val_loss']`, so this callback must come
+    before `ModelCheckpoint` and `EarlyStopping` in the callback list.
+    """
+
+    def __init__(self, predictor_matrix, target_matrix,
+                 num_examples_per_batch=NUM_EXAMPLES_PER_VALIDATION_BATCH,
+                 verbose=True):
+        """Creates callback.
+        :param predictor_matrix: See output doc for `read_validation_data`.
+        :param target_matrix: Same.
+        :param num_examples_per_batch: Number of examples per evaluation batch.
+        :param verbose: Boolean flag.  If True, the validation loss will be
+            printed after each epoch.
+        """
+
+        super(ResidentValidationCallback, self).__init__()
+        self.predictor_matrix = predictor_matrix
+        self.target_matrix = target_matrix
+        self.num_examples_per_batch = num_examples_per_batch
+        self.verbose = verbose
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is None:
+            logs = {}
+
+        these_scores = self.model.evaluate(
+            self.predictor_matrix, self.target_matrix,
+            batch_size=self.num_examples_per_batch, verbose=0)
+        these_scores = numpy.atleast_1d(these_scores)
+
+        for this_name, this_score in zip(self.model.metrics_names,
+                                         these_scores):
+            logs['val_' + this_name] = this_score
+
+        if self.verbose:
+            print('Validation loss over {0:d} examples = {1:.6f}'.format(
+                self.predictor_matrix.shape[0], logs['val_loss']
+            ))
+
+
+def read_training_state(training_state_dir_name):
+    """Reads training state written by `TrainingStateCallback`.
+    :param training_state_dir_name: Name of directory with training state.
+    :return: training_state_dict: Dictionary with keys "epoch" (number of
+        epochs completed), "model_weights", "optimizer_weights",
+        "learning_rate", "callback_states", "python_rng_state",
+        "numpy_rng_state" and "generator_states".  If there is no saved state,
+        this is None.
+    """
+
+    training_state_file_name = '{0:s}/{1:s}'.format(
+        training_state_dir_name, TRAINING_STATE_FILE_NAME)
+
+    if not os.path.isfile(training_state_file_name):
+        return None
+
+    with open(training_state_file_name, 'rb') as this_file:
+        return pickle.load(this_file)
+
+
+class TrainingStateCallback(keras.callbacks.Callback):
+    """Checkpoints (and restores) everything needed to resume training.
+    The state holds model and optimizer weights, the learning rate, the state
+    of the other callbacks (early stopping, checkpoint, LR scheduler), the
+    Python and numpy RNG states used for sampling and the position of each
+    data generator.  Generators run in the training thread (`workers=0`), so
+    at the end of an epoch their position is exactly the batches consumed, and
+    a resumed run sees the same batch sequence as an uninterrupted one.  The
+    state is written atomically, so a preemption during the write leaves the
+    previous state intact.  This
+    callback must come last in the callback list, so that it saves the other
+    callbacks after they update and restores them after they reset.
+    """
+
+    def __init__(self, training_state_dir_name, callback_objects,
+                 training_state_dict=None, generator_state_dict_by_name=None,
+                 num_epochs_per_checkpoint=NUM_EPOCHS_PER_STATE_CHECKPOINT):
+        """Creates callback.
+        :param training_state_dir_name: Name of directory for training state.
+        :param callback_objects: 1-D list of other callbacks whose state is
+            saved.
+        :param training_state_dict: State to restore when training begins (see
+            doc for `read_training_state`).  If None, training starts fresh.
+        :param generator_state_dict_by_name: Dictionary of generator-state
+            dictionaries (see doc for `deep_learning_generator`), updated by the
+            generators in place.  A copy is saved at each checkpoint; restoring
+            it is up to the caller, since generators must be created with it.
+        :param num_epochs_per_checkpoint: Number of epochs between checkpoints.
+        """
+
+        super(TrainingStateCallback, self).__init__()
+        self.training_state_dir_name = training_state_dir_name
+        self.callback_objects = callback_objects
+        self.training_state_dict = training_state_dict
+        self.generator_state_dict_by_name = (
+            {} if generator_state_dict_by_name is None
+            else generator_state_dict_by_name
+        )
+        self.num_epochs_per_checkpoint = num_epochs_per_checkpoint
+
+    def on_train_begin(self, logs=None):
+        if self.training_state_dict is None:
+            return
+
+        print('Resuming training after epoch {0:d}...'.format(
+            self.training_state_dict[EPOCH_KEY]))
+
+        # The optimizer's weights exist by now, since the training function is
+        # built before callbacks are started.
+        self.model.set_weights(self.training_state_dict[MODEL_WEIGHTS_KEY])
+        self.model.optimizer.set_weights(
+            self.training_state_dict[OPTIMIZER_WEIGHTS_KEY])
+        K.set_value(self.model.optimizer.lr,
+                    self.training_state_dict[CURRENT_LEARNING_RATE_KEY])
+
+        for this_callback_object, this_state_dict in zip(
+                self.callback_objects,
+                self.training_state_dict[CALLBACK_STATES_KEY]):
+            for this_name, this_value in this_state_dict.items():
+                setattr(this_callback_object, this_name, this_value)
+
+        random.setstate(self.training_state_dict[PYTHON_RNG_STATE_KEY])
+        numpy.random.set_state(self.training_state_dict[NUMPY_RNG_STATE_KEY])
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.num_epochs_per_checkpoint != 0:
+            return
+
+        callback_states = []
+        for this_callback_object in self.callback_objects:
+            callback_states.append(dict([
+                (n, getattr(this_callback_object, n))
+                for n in CALLBACK_STATE_ATTRIBUTE_NAMES
+                if hasattr(this_callback_object, n)
+            ]))
+
+        training_state_dict = {
+            EPOCH_KEY: epoch + 1,
+            MODEL_WEIGHTS_KEY: self.model.get_weights(),
+            OPTIMIZER_WEIGHTS_KEY: self.model.optimizer.get_weights(),
+            CURRENT_LEARNING_RATE_KEY: float(
+                K.get_value(self.model.optimizer.lr)),
+            CALLBACK_STATES_KEY: callback_states,
+            PYTHON_RNG_STATE_KEY: random.getstate(),
+            NUMPY_RNG_STATE_KEY: numpy.random.get_state(),
+            GENERATOR_STATES_KEY: copy.deepcopy(
+                self.generator_state_dict_by_name)
+        }
+
+        _create_directory(directory_name=self.training_state_dir_name)
+        training_state_file_name = '{0:s}/{1:s}'.format(
+            self.training_state_dir_name, TRAINING_STATE_FILE_NAME)
+        temp_file_name = '{0:s}.tmp'.format(training_state_file_name)
+
+        with open(temp_file_name, 'wb') as this_file:
+            pickle.dump(training_state_dict, this_file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file_name, training_state_file_name)
+
+
+def _get_dense_layer_dimensions(num_input_units, num_hidden_layers):
+    """Returns number of units in each hidden dense layer.
+    Sizes decrease geometrically from the flattened features to
+    NUM_UNITS_IN_LAST_HIDDEN_LAYER (the Dense(100) bottleneck of the notebook
+    CNN).
+    :param num_input_units: Number of input units (flattened features).
+    :param num_hidden_layers: Number of hidden dense layers.
+    :return: num_units_by_layer: 1-D numpy array with number of units in each
+        hidden dense layer.
+    """
+
+    num_units_by_layer = numpy.logspace(
+        numpy.log10(num_input_units),
+        numpy.log10(NUM_UNITS_IN_LAST_HIDDEN_LAYER),
+        num=num_hidden_layers + 1)[1:]
+
+    return numpy.round(num_units_by_layer).astype(int)
+
+
+def check_output_activation(output_activation_name, minmax=None):
+    """Ensures that output activation fits the target normalization.
+    :param output_activation_name: Name of output activation (must be in
+        `VALID_OUTPUT_ACTIVATION_NAMES`; None or "linear" means no
+        activation).
+    :param minmax: See doc for `normalize_images_targ`.
+    :raises: ValueError: if the activation is not recognized, or if it is
+        bounded (relu or sigmoid) while targets are z-scores.
+    """
+
+    if output_activation_name not in VALID_OUTPUT_ACTIVATION_NAMES:
+        error_string = (
+            'Output activation ("{0:s}") is not in the following list:\n{1:s}'
+        ).format(str(output_activation_name),
+                 str(VALID_OUTPUT_ACTIVATION_NAMES))
+        raise ValueError(error_string)
+
+    if output_activation_name in BOUNDED_OUTPUT_ACTIVATION_NAMES and (
+            minmax is None):
+        error_string = (
+            'Output activation "{0:s}" can be used only with min-max scaled '
+            'targets.  Z-scored targets need a linear output.'
+        ).format(output_activation_name)
+        raise ValueError(error_string)
+
+
+def setup_cnn(num_grid_rows=3, num_grid_columns=169,
+              num_predictors=len(PREDICTOR_NAMES), num_targets=507,
+              num_conv_layer_sets=NUM_CONV_LAYER_SETS,
+              num_conv_layers_per_set=NUM_CONV_LAYERS_PER_SET,
+              num_dense_layers=NUM_DENSE_LAYERS,
+              loss_function='mse', learning_rate=LEARNING_RATE,
+              output_activation_name=None, minmax=None, print_report=True):
+    """Creates CNN (convolutional neural net) from the architecture constants.
+    Each conv-layer set has `num_conv_layers_per_set` conv layers (each
+    followed by leaky ReLU, optional dropout and optional batch normalization)
+    and then a max-pooling layer.  The number of filters starts at
+    NUM_PREDICTORS_TO_FIRST_NUM_FILTERS times the number of predictors and
+    doubles with each conv layer.  Pooling is clamped to the grid size, since
+    the grid has only 3 rows (lead times).
+    :param num_grid_rows: Number of rows in each grid (M).
+    :param num_grid_columns: Number of columns in each grid (N).
+    :param num_predictors: Number of predictors (C).
+    :param num_targets: Number of target values per example (T).
+    :param num_conv_layer_sets: Number of conv-layer sets.
+    :param num_conv_layers_per_set: Number of conv layers in each set.
+    :param num_dense_layers: Number of dense layers (including output layer).
+    :param loss_function: Loss function.
+    :param learning_rate: Learning rate for Adam.
+    :param output_activation_name: Activation of output layer (see
+        `check_output_activation`).  Default is linear.
+    :param minmax: See doc for `normalize_images_targ`.  Must be set for a
+        bounded output activation.
+    :param print_report: Boolean flag.  If True, will print the model summary
+        and the profiling report (see `profile_cnn`).
+    :return: cnn_model_object: Untrained (but compiled) instance of
+        `keras.models.Model`.
+    :raises: ValueError: if `check_output_activation` fails.
+    """
+
+    check_output_activation(output_activation_name, minmax)
+    regularizer_object = keras.regularizers.l1_l2(l1=L1_WEIGHT, l2=L2_WEIGHT)
+    input_layer_object = keras.layers.Input(
+        shape=(num_grid_rows, num_grid_columns, num_predictors))
+
+    current_num_filters = None
+    current_layer_object = input_layer_object
+
+    # Add convolutional layers.
+    for _ in range(num_conv_layer_sets):
+        for _ in range(num_conv_layers_per_set):
+            if current_num_filters is None:
+                current_num_filters = (
+                    num_predictors * NUM_PREDICTORS_TO_FIRST_NUM_FILTERS)
+            else:
+                current_num_filters *= 2
+
+            current_layer_object = keras.layers.Conv2D(
+                filters=current_num_filters,
+                kernel_size=(NUM_CONV_FILTER_ROWS, NUM_CONV_FILTER_COLUMNS),
+                strides=(1, 1), padding='same', data_format='channels_last',
+                dilation_rate=(1, 1), activation=None, use_bias=True,
+                kernel_initializer='glorot_uniform', bias_initializer='zeros',
+                kernel_regularizer=regularizer_object
+            )(current_layer_object)
+
+            current_layer_object = keras.layers.LeakyReLU(
+                alpha=SLOPE_FOR_RELU)(current_layer_object)
+
+            if CONV_LAYER_DROPOUT_FRACTION is not None:
+                current_layer_object = keras.layers.Dropout(
+                    rate=CONV_LAYER_DROPOUT_FRACTION)(current_layer_object)
+
+            if USE_BATCH_NORMALIZATION:
+                current_layer_object = keras.layers.BatchNormalization(
+                    axis=-1, center=True, scale=True)(current_layer_object)
+
+        these_dimensions = current_layer_object.get_shape().as_list()[1:3]
+        this_pool_size = (
+            min([NUM_POOLING_ROWS, these_dimensions[0]]),
+            min([NUM_POOLING_COLUMNS, these_dimensions[1]])
+        )
+
+        current_layer_object = keras.layers.MaxPooling2D(
+            pool_size=this_pool_size, strides=this_pool_size,
+            padding='valid', data_format='channels_last'
+        )(current_layer_object)
+
+    num_features = int(numpy.prod(
+        current_layer_object.get_shape().as_list()[1:]))
+    current_layer_object = keras.layers.Flatten()(current_layer_object)
+
+    # Add intermediate dense layers.
+    num_units_by_dense_layer = _get_dense_layer_dimensions(
+        num_input_units=num_features, num_hidden_layers=num_dense_layers - 1)
+
+    for k in range(num_dense_layers - 1):
+        current_layer_object = keras.layers.Dense(
+            int(num_units_by_dense_layer[k]), activation=None,
+            use_bias=True, kernel_initializer='glorot_uniform',
+            bias_initializer='zeros', kernel_regularizer=regularizer_object
+        )(current_layer_object)
+
+        current_layer_object = keras.layers.LeakyReLU(
+            alpha=SLOPE_FOR_RELU)(current_layer_object)
+
+        if DENSE_LAYER_DROPOUT_FRACTION is not None:
+            current_layer_object = keras.layers.Dropout(
+                rate=DENSE_LAYER_DROPOUT_FRACTION)(current_layer_object)
+
+        if USE_BATCH_NORMALIZATION:
+            current_layer_object = keras.layers.BatchNormalization(
+                axis=-1, center=True, scale=True)(current_layer_object)
+
+    # Add output layer.  Targets are normalized, so it is linear unless they
+    # are min-max scaled.
+    current_layer_object = keras.layers.Dense(
+        num_targets, activation=None, use_bias=True,
+        kernel_initializer='glorot_uniform', bias_initializer='zeros',
+        kernel_regularizer=regularizer_object
+    )(current_layer_object)
+
+    if output_activation_name not in [None, 'linear']:
+        current_layer_object = keras.layers.Activation(
+            output_activation_name)(current_layer_object)
+
+    cnn_model_object = keras.models.Model(
+        inputs=input_layer_object, outputs=current_layer_object)
+    cnn_model_object.compile(
+        loss=loss_function,
+        optimizer=keras.optimizers.Adam(lr=learning_rate))
+
+    if print_report:
+        cnn_model_object.summary()
+        profile_cnn(cnn_model_object)
+
+    return cnn_model_object
+
+
+def _get_layer_flops(layer_object):
+    """Returns number of floating-point operations in one layer (per example).
+    Multiply-adds count as 2 operations.  Dropout, flatten and input layers are
+    free at inference time.
+    :param layer_object: Instance of `keras.layers.Layer`.
+    :return: num_flops: Number of operations.
+    """
+
+    layer_type = type(layer_object).__name__
+    num_outputs = int(numpy.prod(layer_object.output_shape[1:]))
+
+    if layer_type == 'Conv2D':
+        return 2 * num_outputs * int(
+            numpy.prod(layer_object.kernel_size) *
+            layer_object.input_shape[-1])
+
+    if layer_type == 'Dense':
+        return 2 * num_outputs * int(layer_object.input_shape[-1])
+
+    if layer_type == 'BatchNormalization':
+        return 2 * num_outputs
+
+    if layer_type in ['LeakyReLU', 'Activation']:
+        return num_outputs
+
+    if layer_type in ['MaxPooling2D', 'AveragePooling2D']:
+        return num_outputs * int(numpy.prod(layer_object.pool_size))
+
+    return 0
+
+
+def profile_cnn(cnn_model_object, num_examples_per_batch=1,
+                num_repeats=NUM_PROFILING_REPEATS, verbose=True):
+    """Reports cost of each layer: parameters, FLOPs, memory and CPU latency.
+    Latency is measured by running a copy of each layer alone (on random input
+    of the right shape) `num_repeats` times and taking the median, so it
+    includes per-call overhead but not the other layers.  The copies are
+    pinned to the CPU, so the report gives CPU latency even on a GPU node.
+    :param cnn_model_object: Instance of `keras.models.Model`.
+    :param num_examples_per_batch: Batch size for latency measurements.
+    :param num_repeats: Number of timed calls per layer.
+    :param verbose: Boolean flag.  If True, will print the report as a table.
+    :return: report_dict: Dictionary with the following keys.
+    report_dict['layer_reports']: 1-D list of dictionaries, one per layer, each
+        with keys "layer_name", "layer_type", "output_shape", "num_params",
+        "num_flops" (per example), "activation_bytes" (float32 output, per
+        example) and "latency_sec" (per batch).
+    report_dict['num_params']: Total number of parameters.
+    report_dict['num_flops']: Total FLOPs per example.
+    report_dict['activation_bytes']: Total activation memory per example.
+    report_dict['latency_sec']: Sum of per-layer latencies.
+    """
+
+    layer_reports = []
+
+    for this_layer_object in cnn_model_object.layers:
+        this_layer_type = type(this_layer_object).__name__
+        this_latency_sec = 0.
+
+        if this_layer_type != 'InputLayer':
+            # Timed on a copy, since calling the layer itself on a new input
+            # would give it a second inbound node (making `layer.output`
+            # ambiguous for `_get_sub_model`).  Ops are placed when the graph
+            # is built, so the copy is built under the CPU device scope.
+            with tensorflow.device('/cpu:0'):
+                this_copy_object = type(this_layer_object).from_config(
+                    this_layer_object.get_config())
+                this_input_layer_object = keras.layers.Input(
+                    shape=this_layer_object.input_shape[1:])
+                this_model_object = keras.models.Model(
+                    inputs=this_input_layer_object,
+                    outputs=this_copy_object(this_input_layer_object))
+                this_copy_object.set_weights(this_layer_object.get_weights())
+
+                this_input_matrix = numpy.random.normal(size=(
+                    (num_examples_per_batch,) +
+                    this_layer_object.input_shape[1:]
+                )).astype('float32')
+                this_model_object.predict_on_batch(this_input_matrix)
+
+                these_latencies_sec = []
+                for _ in range(num_repeats):
+                    this_start_time_unix_sec = time.time()
+                    this_model_object.predict_on_batch(this_input_matrix)
+                    these_latencies_sec.append(
+                        time.time() - this_start_time_unix_sec)
+
+            this_latency_sec = float(numpy.median(these_latencies_sec))
+
+        layer_reports.append({
+            LAYER_NAME_KEY: this_layer_object.name,
+            LAYER_TYPE_KEY: this_layer_type,
+            OUTPUT_SHAPE_KEY: this_layer_object.output_shape[1:],
+            NUM_PARAMS_KEY: this_layer_object.count_params(),
+            NUM_FLOPS_KEY: _get_layer_flops(this_layer_object),
+            ACTIVATION_BYTES_KEY:
+                4 * int(numpy.prod(this_layer_object.output_shape[1:])),
+            LATENCY_KEY: this_latency_sec
+        })
+
+    report_dict = {LAYER_REPORTS_KEY: layer_reports}
+    for this_key in [NUM_PARAMS_KEY, NUM_FLOPS_KEY, ACTIVATION_BYTES_KEY,
+                     LATENCY_KEY]:
+        report_dict[this_key] = sum([r[this_key] for r in layer_reports])
+
+    if not verbose:
+        return report_dict
+
+    print('{0:<24s} {1:<20s} {2:>10s} {3:>12s} {4:>12s} {5:>12s}'.format(
+        'Layer', 'Output shape', 'Params', 'FLOPs', 'Act. bytes',
+        'Latency (ms)'))
+
+    for this_report in layer_reports + [dict(
+            report_dict, layer_name='Total', output_shape='')]:
+        print('{0:<24s} {1:<20s} {2:>10d} {3:>12d} {4:>12d} {5:>12.3f}'.format(
+            this_report[LAYER_NAME_KEY], str(this_report[OUTPUT_SHAPE_KEY]),
+            this_report[NUM_PARAMS_KEY], this_report[NUM_FLOPS_KEY],
+            this_report[ACTIVATION_BYTES_KEY],
+            1000 * this_report[LATENCY_KEY]
+        ))
+
+    return report_dict
+
+
+def train_cnn(
+        cnn_model_object, training_file_names, normalization_dict,
+        normalization_dict_targ, num_examples_per_batch, num_epochs,
+        num_training_batches_per_epoch, output_model_file_name,
+        validation_file_names=None, num_validation_batches_per_epoch=None,
+    targ_LATinds=None, targ_LONinds=None, resident_validation=False,
+    training_shard_dir_name=None, callback_objects=None, num_threads=None,
+    training_state_dir_name=None, resume=False, rain_sampling_dict=None):
+    
+    """Trains CNN (convolutional neural net).
+    :param cnn_model_object: Untrained instance of `keras.models.Model` (may be
+        created by `setup_cnn`).
+    :param training_file_names: 1-D list of paths to training files (must be
+        readable by `read_image_file`).
+    :param normalization_dict: See doc for `deep_learning_generator`.
+    param normalization_dict_targ: See doc for `deep_learning_generator`.
+    :param num_examples_per_batch: Same.
+    :param num_epochs: Number of epochs.
+    :param num_training_batches_per_epoch: Number of training batches furnished
+        to model in each epoch.
+    :param output_model_file_name: Path to output file.  The model will be saved
+        as an HDF5 file (extension should be ".h5", but this is not enforced).
+    :param validation_file_names: 1-D list of paths to training files (must be
+        readable by `read_image_file`).  If `validation_file_names is None`,
+        will omit on-the-fly validation.
+    :param num_validation_batches_per_epoch:
+        [used only if `validation_file_names is not None`]
+        Number of validation batches furnished to model in each epoch.  Ignored
+        if `resident_validation = True`.
+    :param resident_validation: Boolean flag.  If True, the validation set will
+        be read and normalized once (see `read_validation_data`), kept in
+        memory and scored in full at the end of each epoch.  If False, each
+        epoch is validated on `num_validation_batches_per_epoch` batches from
+        `deep_learning_generator`.
+    :param training_shard_dir_name: Name of directory created by
+        `pack_training_shards` from `training_file_names`.  If not None,
+        training batches will be read from these memory-mapped shards (see
+        `shard_generator`) instead of the NetCDF files.
+    :param callback_objects: 1-D list of extra Keras callbacks, run after the
+        built-in ones (so they see `val_loss` in the epoch logs).
+    :param num_threads: Max number of threads used by TensorFlow (for each of
+        the intra-op and inter-op pools).  If not None, ops pinned to the GPU
+        may also fall back to the CPU, so this can be used on CPU-only nodes
+        running several trainings at once.
+    :param training_state_dir_name: Name of directory for training-state
+        checkpoints (see `TrainingStateCallback`), written after every epoch.
+        If None, no training state is saved.
+    :param resume: Boolean flag.  If True and `training_state_dir_name`
+        holds a saved state, training resumes after the last saved epoch
+        (with the saved weights, optimizer, callback and RNG states and
+        generator positions), so the batch sequence is the same as without
+        the interruption.
+        `cnn_model_object` must have the same architecture and optimizer.
+    :param rain_sampling_dict: Dictionary created by `get_rain_sampling_dict`.
+        If not None, training batches oversample heavy-rain examples and are
+        weighted to keep the loss unbiased (see `deep_learning_generator`).
+        Cannot be used with `training_shard_dir_name`.
+    :return: cnn_metadata_dict: Dictionary with the following keys.
+    cnn_metadata_dict['training_file_names']: See input doc.
+    cnn_metadata_dict['normalization_dict']: Same.
+    cnn_metadata_dict['normalization_dict_targ']: Same.
+    cnn_metadata_dict['num_examples_per_batch']: Same.
+    cnn_metadata_dict['num_training_batches_per_epoch']: Same.
+    cnn_metadata_dict['validation_file_names']: Same.
+    cnn_metadata_dict['num_validation_batches_per_epoch']: Same.
+    cnn_metadata_dict['resident_validation']: Same.
+    cnn_metadata_dict['training_shard_dir_name']: Same.
+    cnn_metadata_dict['training_state_dir_name']: Same.
+    cnn_metadata_dict['rain_sampling_dict']: Same.
+    :raises: ValueError: if both `training_shard_dir_name` and
+        `rain_sampling_dict` are given.
+    """
+
+    if training_shard_dir_name is not None and rain_sampling_dict is not None:
+        error_string = (
+            'Importance sampling (rain_sampling_dict) is not supported with '
+            'training shards.')
+        raise ValueError(error_string)
     
+    #configure GPU: 
+    config = tensorflow.ConfigProto(allow_soft_placement=False, log_device_placement=False)
+    config.gpu_options.allow_growth = True
+    if num_threads is not None:
+        config.allow_soft_placement = True
+        config.intra_op_parallelism_threads = num_threads
+        config.inter_op_parallelism_threads = num_threads
+    sess = tensorflow.Session(config=config)
+    K.set_session(sess)
+
+
+    _create_directory(file_name=output_model_file_name)
+
+    if validation_file_names is None:
+        checkpoint_object = keras.callbacks.ModelCheckpoint(
+            filepath=output_model_file_name, monitor='loss', verbose=1,
+            save_best_only=False, save_weights_only=False, mode='min',
+            period=1)
+    else:
+        checkpoint_object = keras.callbacks.ModelCheckpoint(
+            filepath=output_model_file_name, monitor='val_loss', verbose=1,
+            save_best_only=True, save_weights_only=False, mode='min',
+            period=1)
+
+    list_of_callback_objects = [checkpoint_object]
+    
+    if callback_objects is None:
+        callback_objects = []
+
     print('Normalization dict targ:', normalization_dict_targ)
     cnn_metadata_dict = {
         TRAINING_FILES_KEY: training_file_names,
@@ -846,28 +3423,73 @@ def train_cnn(
         NUM_EXAMPLES_PER_BATCH_KEY: num_examples_per_batch,
         NUM_TRAINING_BATCHES_KEY: num_training_batches_per_epoch,
         VALIDATION_FILES_KEY: validation_file_names,
-        NUM_VALIDATION_BATCHES_KEY: num_validation_batches_per_epoch
+        NUM_VALIDATION_BATCHES_KEY: num_validation_batches_per_epoch,
+        RESIDENT_VALIDATION_KEY: resident_validation,
+        TRAINING_SHARD_DIR_KEY: training_shard_dir_name,
+        TRAINING_STATE_DIR_KEY: training_state_dir_name,
+        RAIN_SAMPLING_DICT_KEY: rain_sampling_dict
+    }
+
+    training_state_dict = None
+    initial_epoch = 0
+    generator_state_dict_by_name = {
+        TRAINING_GENERATOR_NAME: {}, VALIDATION_GENERATOR_NAME: {}
     }
+
+    if training_state_dir_name is not None and resume:
+        training_state_dict = read_training_state(training_state_dir_name)
+
+        if training_state_dict is None:
+            print('No training state in "{0:s}", so starting at epoch 0.'.format(
+                training_state_dir_name))
+        else:
+            initial_epoch = training_state_dict[EPOCH_KEY]
+            generator_state_dict_by_name.update(copy.deepcopy(
+                training_state_dict.get(GENERATOR_STATES_KEY, {})))
     
-    if (targ_LATinds is None) & (targ_LONinds is None):
+    if training_shard_dir_name is not None:
+        training_generator = shard_generator(
+            shard_directory_name=training_shard_dir_name,
+            num_examples_per_batch=num_examples_per_batch,
+            normalization_dict=normalization_dict,
+            normalization_dict_targ=normalization_dict_targ,
+            generator_state_dict=generator_state_dict_by_name[
+                TRAINING_GENERATOR_NAME])
+    elif (targ_LATinds is None) & (targ_LONinds is None):
         training_generator = deep_learning_generator(
             netcdf_file_names=training_file_names,
             num_examples_per_batch=num_examples_per_batch,
             normalization_dict=normalization_dict,
-            normalization_dict_targ=normalization_dict_targ)
+            normalization_dict_targ=normalization_dict_targ,
+            rain_sampling_dict=rain_sampling_dict,
+            generator_state_dict=generator_state_dict_by_name[
+                TRAINING_GENERATOR_NAME])
     else:
         training_generator = deep_learning_generator(
             netcdf_file_names=training_file_names,
             num_examples_per_batch=num_examples_per_batch,
             normalization_dict=normalization_dict,
             normalization_dict_targ=normalization_dict_targ,
-            targ_LATinds=targ_LATinds, targ_LONinds=targ_LONinds)
+            targ_LATinds=targ_LATinds, targ_LONinds=targ_LONinds,
+            rain_sampling_dict=rain_sampling_dict,
+            generator_state_dict=generator_state_dict_by_name[
+                TRAINING_GENERATOR_NAME])
 
     if validation_file_names is None:
+        list_of_callback_objects += callback_objects
+
+        if training_state_dir_name is not None:
+            list_of_callback_objects.append(TrainingStateCallback(
+                training_state_dir_name=training_state_dir_name,
+                callback_objects=list(list_of_callback_objects),
+                training_state_dict=training_state_dict,
+                generator_state_dict_by_name=generator_state_dict_by_name))
+
         cnn_model_object.fit_generator(
             generator=training_generator,
             steps_per_epoch=num_training_batches_per_epoch, epochs=num_epochs,
-            verbose=1, callbacks=list_of_callback_objects, workers=0)
+            verbose=1, callbacks=list_of_callback_objects, workers=0,
+            initial_epoch=initial_epoch)
 
         return cnn_metadata_dict
 
@@ -876,20 +3498,65 @@ def train_cnn(
         patience=NUM_EPOCHS_FOR_EARLY_STOPPING, verbose=1, mode='min')
 
     list_of_callback_objects.append(early_stopping_object)
+    list_of_callback_objects += callback_objects
+
+    if resident_validation:
+        validation_predictor_matrix, validation_target_matrix = (
+            read_validation_data(
+                validation_file_names=validation_file_names,
+                normalization_dict=normalization_dict,
+                normalization_dict_targ=normalization_dict_targ,
+                targ_LATinds=targ_LATinds, targ_LONinds=targ_LONinds)
+        )
+
+        # Must run before the checkpoint and early-stopping callbacks, which
+        # read `val_loss` from the epoch logs.
+        list_of_callback_objects.insert(0, ResidentValidationCallback(
+            predictor_matrix=validation_predictor_matrix,
+            target_matrix=validation_target_matrix))
+
+        if training_state_dir_name is not None:
+            list_of_callback_objects.append(TrainingStateCallback(
+                training_state_dir_name=training_state_dir_name,
+                callback_objects=list(list_of_callback_objects),
+                training_state_dict=training_state_dict,
+                generator_state_dict_by_name=generator_state_dict_by_name))
+
+        with tensorflow.device("/device:GPU:0"):
+            K.get_session().run(tensorflow.global_variables_initializer())
+            cnn_model_object.fit_generator(
+                generator=training_generator,
+                steps_per_epoch=num_training_batches_per_epoch,
+                epochs=num_epochs, verbose=1,
+                callbacks=list_of_callback_objects, workers=0,
+                initial_epoch=initial_epoch)
+
+        return cnn_metadata_dict
 
     if (targ_LATinds is None) & (targ_LONinds is None):
         validation_generator = deep_learning_generator(
             netcdf_file_names=validation_file_names,
             num_examples_per_batch=num_examples_per_batch,
             normalization_dict=normalization_dict,
-            normalization_dict_targ=normalization_dict_targ)
+            normalization_dict_targ=normalization_dict_targ,
+            generator_state_dict=generator_state_dict_by_name[
+                VALIDATION_GENERATOR_NAME])
     else:
         validation_generator = deep_learning_generator(
             netcdf_file_names=validation_file_names,
             num_examples_per_batch=num_examples_per_batch,
             normalization_dict=normalization_dict,
             normalization_dict_targ=normalization_dict_targ,
-            targ_LATinds=targ_LATinds, targ_LONinds=targ_LONinds)
+            targ_LATinds=targ_LATinds, targ_LONinds=targ_LONinds,
+            generator_state_dict=generator_state_dict_by_name[
+                VALIDATION_GENERATOR_NAME])
+
+    if training_state_dir_name is not None:
+        list_of_callback_objects.append(TrainingStateCallback(
+            training_state_dir_name=training_state_dir_name,
+            callback_objects=list(list_of_callback_objects),
+            training_state_dict=training_state_dict,
+            generator_state_dict_by_name=generator_state_dict_by_name))
 
     with tensorflow.device("/device:GPU:0"):
         K.get_session().run(tensorflow.global_variables_initializer())
@@ -898,7 +3565,8 @@ def train_cnn(
             steps_per_epoch=num_training_batches_per_epoch, epochs=num_epochs,
             verbose=1, callbacks=list_of_callback_objects, workers=0,
             validation_data=validation_generator,
-            validation_steps=num_validation_batches_per_epoch)
+            validation_steps=num_validation_batches_per_epoch,
+            initial_epoch=initial_epoch)
 
     return cnn_metadata_dict
 
@@ -927,41 +3595,266 @@ def _create_directory(directory_name=None, file_name=None):
             
             
             
+def _get_peak_memory_bytes():
+    """Returns peak resident memory of this process.
+    On Linux this reads VmHWM, which `_reset_peak_memory` can reset, so peaks
+    can be measured per probe.  Elsewhere it falls back to `ru_maxrss`, which
+    only ever grows.
+    :return: peak_memory_bytes: Peak resident memory.
+    """
+
+    try:
+        with open('/proc/self/status') as this_file:
+            for this_line in this_file:
+                if this_line.startswith('VmHWM:'):
+                    return int(this_line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_memory():
+    """Resets peak resident memory of this process (Linux only)."""
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as this_file:
+            this_file.write('5')
+    except IOError:
+        pass
+
+
+def _get_batch_size_tuning_key(model_file_name):
+    """Returns key for one (model file, host) pair in the tuning file.
+    :param model_file_name: Path to model file.
+    :return: tuning_key: String key.
+    """
+
+    return '{0:s}|{1:s}'.format(
+        os.path.abspath(model_file_name), socket.gethostname())
+
+
+def _read_batch_size_tuning_file(tuning_file_name):
+    """Reads all batch-size tuning results.
+    :param tuning_file_name: Path to JSON file.
+    :return: tuning_dict: Dictionary with one entry per (model file, host).  If
+        the file does not exist, this is empty.
+    """
+
+    if not os.path.isfile(tuning_file_name):
+        return {}
+
+    with open(tuning_file_name) as this_file:
+        return json.load(this_file)
+
+
+def autotune_batch_size(
+        cnn_model_object, model_file_name, predictor_matrix=None,
+        candidate_batch_sizes=CANDIDATE_INFERENCE_BATCH_SIZES,
+        num_repeats=3, max_memory_bytes=None,
+        tuning_file_name=BATCH_SIZE_TUNING_FILE_NAME):
+    """Finds the fastest inference batch size for a model on this host.
+    Each candidate is timed on the same probe set (best of `num_repeats`), and
+    the peak resident memory during the probe is recorded.  The winner is saved
+    under (model file, host), so `apply_cnn` and the chunked inference methods
+    pick it up automatically.
+    :param cnn_model_object: Trained instance of `keras.models.Model`.
+    :param model_file_name: Path to file from which the model was read.
+    :param predictor_matrix: E-by-M-by-N-by-C numpy array of normalized
+        predictors to probe with.  If None, will use random z-scores with
+        E = 4 * largest candidate.
+    :param candidate_batch_sizes: 1-D list of batch sizes to try.
+    :param num_repeats: Number of timed repeats per candidate.
+    :param max_memory_bytes: Max peak memory allowed.  Candidates above this are
+        not eligible.  If None, there is no limit.
+    :param tuning_file_name: Path to JSON file with tuning results.
+    :return: best_batch_size: Batch size with the highest throughput.
+    :return: result_dicts: 1-D list of dictionaries (one per candidate), each
+        with keys "batch_size", "examples_per_second" and "peak_memory_bytes".
+    """
+
+    if predictor_matrix is None:
+        predictor_matrix = numpy.random.normal(size=(
+            (4 * max(candidate_batch_sizes),) +
+            tuple(cnn_model_object.input_shape[1:])
+        )).astype('float32')
+
+    num_examples = predictor_matrix.shape[0]
+    result_dicts = []
+
+    for this_batch_size in candidate_batch_sizes:
+        # Warm-up call, so graph setup is not counted.
+        cnn_model_object.predict(
+            predictor_matrix[:this_batch_size, ...], batch_size=this_batch_size)
+
+        _reset_peak_memory()
+        this_best_time_sec = numpy.inf
+
+        for _ in range(num_repeats):
+            this_start_time_sec = time.time()
+            cnn_model_object.predict(
+                predictor_matrix, batch_size=this_batch_size)
+            this_best_time_sec = min(
+                [this_best_time_sec, time.time() - this_start_time_sec])
+
+        result_dicts.append({
+            BATCH_SIZE_KEY: this_batch_size,
+            THROUGHPUT_KEY: num_examples / this_best_time_sec,
+            PEAK_MEMORY_KEY: _get_peak_memory_bytes()
+        })
+
+        print((
+            'Batch size = {0:d} ... throughput = {1:.1f} examples/s ... peak '
+            'memory = {2:.1f} MB'
+        ).format(
+            this_batch_size, result_dicts[-1][THROUGHPUT_KEY],
+            result_dicts[-1][PEAK_MEMORY_KEY] / 1e6
+        ))
+
+    eligible_dicts = [
+        d for d in result_dicts
+        if max_memory_bytes is None or d[PEAK_MEMORY_KEY] <= max_memory_bytes
+    ]
+    if len(eligible_dicts) == 0:
+        eligible_dicts = [min(result_dicts, key=lambda d: d[PEAK_MEMORY_KEY])]
+
+    best_batch_size = max(
+        eligible_dicts, key=lambda d: d[THROUGHPUT_KEY]
+    )[BATCH_SIZE_KEY]
+    print('Best batch size = {0:d}'.format(best_batch_size))
+
+    tuning_dict = _read_batch_size_tuning_file(tuning_file_name)
+    tuning_dict[_get_batch_size_tuning_key(model_file_name)] = {
+        BATCH_SIZE_KEY: best_batch_size,
+        PROBE_RESULTS_KEY: result_dicts
+    }
+
+    _create_directory(file_name=tuning_file_name)
+    with open(tuning_file_name, 'w') as this_file:
+        json.dump(tuning_dict, this_file, indent=2)
+
+    _MODEL_FILE_NAMES[cnn_model_object] = model_file_name
+    _TUNED_BATCH_SIZES[_get_batch_size_tuning_key(model_file_name)] = (
+        best_batch_size)
+
+    return best_batch_size, result_dicts
+
+
+def get_tuned_batch_size(model_file_name,
+                         tuning_file_name=BATCH_SIZE_TUNING_FILE_NAME):
+    """Returns the saved batch size for a model on this host.
+    :param model_file_name: Path to model file.
+    :param tuning_file_name: Path to JSON file with tuning results.
+    :return: batch_size: Tuned batch size, or None if the model has not been
+        tuned on this host.
+    """
+
+    tuning_key = _get_batch_size_tuning_key(model_file_name)
+
+    if tuning_key not in _TUNED_BATCH_SIZES:
+        this_dict = _read_batch_size_tuning_file(tuning_file_name).get(
+            tuning_key)
+        _TUNED_BATCH_SIZES[tuning_key] = (
+            None if this_dict is None else this_dict[BATCH_SIZE_KEY]
+        )
+
+    return _TUNED_BATCH_SIZES[tuning_key]
+
+
+def _get_inference_batch_size(cnn_model_object, num_examples_per_batch=None):
+    """Returns batch size to use for inference.
+    :param cnn_model_object: Instance of `keras.models.Model`.
+    :param num_examples_per_batch: Requested batch size.  If None, will use the
+        tuned batch size for this model and host (if the model was read by
+        `read_keras_model` and has been tuned by `autotune_batch_size`), or else
+        `NUM_EXAMPLES_PER_INFERENCE_BATCH`.
+    :return: num_examples_per_batch: Batch size.
+    """
+
+    if num_examples_per_batch is not None:
+        return num_examples_per_batch
+
+    model_file_name = _MODEL_FILE_NAMES.get(cnn_model_object)
+    if model_file_name is not None:
+        this_batch_size = get_tuned_batch_size(model_file_name)
+
+        if this_batch_size is not None:
+            return this_batch_size
+
+    return NUM_EXAMPLES_PER_INFERENCE_BATCH
+
+
+def _get_sub_model(cnn_model_object, output_layer_names):
+    """Returns truncated model with the given output layers (cached).
+    Each (model, layer set) pair is built once.  The cache holds weak
+    references to the full models, so entries go away with the models.
+    :param cnn_model_object: Trained instance of `keras.models.Model`.
+    :param output_layer_names: 1-D list of layer names.
+    :return: model_object_to_use: Instance of `keras.models.Model` whose
+        outputs are the given layers, in the given order.
+    """
+
+    sub_model_dict = _SUB_MODEL_CACHE.setdefault(cnn_model_object, {})
+    cache_key = tuple(output_layer_names)
+
+    if cache_key not in sub_model_dict:
+        sub_model_dict[cache_key] = keras.models.Model(
+            inputs=cnn_model_object.input,
+            outputs=[
+                cnn_model_object.get_layer(name=n).output
+                for n in output_layer_names
+            ]
+        )
+
+    return sub_model_dict[cache_key]
+
+
 def apply_cnn(cnn_model_object, predictor_matrix, verbose=True,
-              output_layer_name=None):
+              output_layer_name=None, num_examples_per_batch=None):
     """Applies trained CNN (convolutional neural net) to new data.
     E = number of examples in file
     M = number of rows in each grid
     N = number of columns in each grid
     C = number of channels (predictor variables)
+    T = number of target values per example
     :param cnn_model_object: Trained instance of `keras.models.Model`.
     :param predictor_matrix: E-by-M-by-N-by-C numpy array of predictor values.
     :param verbose: Boolean flag.  If True, progress messages will be printed.
-    :param output_layer_name: Name of output layer.  If
+    :param output_layer_name: Name of output layer, or 1-D list of names.  If
         `output_layer_name is None`, this method will use the actual output
         layer, so will return predictions.  If `output_layer_name is not None`,
-        will return "features" (outputs from the given layer).
+        will return "features" (outputs from the given layer).  If a list, the
+        outputs of all given layers are computed in one forward pass (through a
+        cached sub-model, see `_get_sub_model`).
+    :param num_examples_per_batch: Number of examples per batch.  If None,
+        will use the autotuned batch size (see `_get_inference_batch_size`).
     If `output_layer_name is None`...
-    :return: forecast_probabilities: length-E numpy array with forecast
-        probabilities of positive class (label = 1).
-    If `output_layer_name is not None`...
+    :return: prediction_matrix: E-by-T numpy array of predictions.
+    If `output_layer_name` is a string...
     :return: feature_matrix: numpy array of features (outputs from the given
         layer).  There is no guarantee on the shape of this array, except that
         the first axis has length E.
+    If `output_layer_name` is a list...
+    :return: feature_matrices: 1-D list of feature matrices, in the same order
+        as `output_layer_name`.
     """
 
     num_examples = predictor_matrix.shape[0]
-    num_examples_per_batch = 1000
+    num_examples_per_batch = _get_inference_batch_size(
+        cnn_model_object, num_examples_per_batch)
+    return_list = isinstance(output_layer_name, (list, tuple))
 
     if output_layer_name is None:
         model_object_to_use = cnn_model_object
+    elif return_list:
+        model_object_to_use = _get_sub_model(
+            cnn_model_object, output_layer_name)
     else:
-        model_object_to_use = keras.models.Model(
-            inputs=cnn_model_object.input,
-            outputs=cnn_model_object.get_layer(name=output_layer_name).output
-        )
+        model_object_to_use = _get_sub_model(
+            cnn_model_object, [output_layer_name])
 
-    output_array = None
+    output_arrays = None
 
     for i in range(0, num_examples, num_examples_per_batch):
         this_first_index = i
@@ -974,25 +3867,366 @@ def apply_cnn(cnn_model_object, predictor_matrix, verbose=True,
                 this_first_index, this_last_index, num_examples
             ))
 
-        these_indices = numpy.linspace(
-            this_first_index, this_last_index,
-            num=this_last_index - this_first_index + 1, dtype=int)
-
-        this_output_array = model_object_to_use.predict(
-            predictor_matrix[these_indices, ...],
+        these_output_arrays = model_object_to_use.predict(
+            predictor_matrix[this_first_index:(this_last_index + 1), ...],
             batch_size=num_examples_per_batch)
 
-        if output_layer_name is None:
-            this_output_array = this_output_array[:, -1]
+        if not isinstance(these_output_arrays, list):
+            these_output_arrays = [these_output_arrays]
 
-        if output_array is None:
-            output_array = this_output_array + 0.
-        else:
-            output_array = numpy.concatenate(
-                (output_array, this_output_array), axis=0
+        # Preallocate once the output shapes are known, then fill in place.
+        if output_arrays is None:
+            output_arrays = [
+                numpy.empty((num_examples,) + a.shape[1:], dtype=a.dtype)
+                for a in these_output_arrays
+            ]
+
+        for j in range(len(output_arrays)):
+            output_arrays[j][this_first_index:(this_last_index + 1), ...] = (
+                these_output_arrays[j])
+
+    if return_list:
+        return output_arrays
+
+    return output_arrays[0]
+
+
+def get_file_hash(file_name):
+    """Returns SHA-256 hash of file contents.
+    :param file_name: Path to file.
+    :return: hash_string: Hexadecimal hash.
+    """
+
+    hash_object = hashlib.sha256()
+
+    with open(file_name, 'rb') as this_file:
+        for this_block in iter(
+                lambda: this_file.read(NUM_BYTES_PER_HASH_BLOCK), b''):
+            hash_object.update(this_block)
+
+    return hash_object.hexdigest()
+
+
+def _get_model_hash(cnn_model_object):
+    """Returns SHA-256 hash of model architecture and weights.
+    The hash depends only on what the model computes, not on which file it was
+    read from, so retraining (or loading other weights) changes the hash.
+    :param cnn_model_object: Instance of `keras.models.Model`.
+    :return: hash_string: Hexadecimal hash.
+    """
+
+    hash_object = hashlib.sha256()
+    hash_object.update(cnn_model_object.to_json().encode('utf-8'))
+
+    for this_weight_matrix in cnn_model_object.get_weights():
+        hash_object.update(str(this_weight_matrix.shape).encode('utf-8'))
+        hash_object.update(
+            numpy.ascontiguousarray(this_weight_matrix).tobytes())
+
+    return hash_object.hexdigest()
+
+
+def _get_normalization_hash(normalization_dict):
+    """Returns SHA-256 hash of normalization dictionary.
+    :param normalization_dict: See doc for `normalize_images`.
+    :return: hash_string: Hexadecimal hash.
+    """
+
+    json_string = json.dumps(
+        dict([(k, numpy.asarray(v).tolist())
+              for k, v in normalization_dict.items()]),
+        sort_keys=True)
+
+    return hashlib.sha256(json_string.encode('utf-8')).hexdigest()
+
+
+def get_inference_cache_key(
+        cnn_model_object, netcdf_file_name, normalization_dict,
+        normalization_dict_targ, targ_LATinds=None, targ_LONinds=None):
+    """Returns cache key for one (input file, model, normalization) tuple.
+    :param cnn_model_object: Trained instance of `keras.models.Model`.
+    :param netcdf_file_name: Path to input file.
+    :param normalization_dict: See doc for `normalize_images`.
+    :param normalization_dict_targ: See doc for `denormalize_images_targ`.
+    :param targ_LATinds: See doc for `read_image_file`.
+    :param targ_LONinds: Same.
+    :return: cache_key: Hexadecimal hash.
+    """
+
+    hash_object = hashlib.sha256()
+
+    for this_string in [
+            get_file_hash(netcdf_file_name), _get_model_hash(cnn_model_object),
+            _get_normalization_hash(normalization_dict),
+            _get_normalization_hash(normalization_dict_targ),
+            json.dumps([None if targ_LATinds is None
+                        else numpy.asarray(targ_LATinds).tolist(),
+                        None if targ_LONinds is None
+                        else numpy.asarray(targ_LONinds).tolist()])
+    ]:
+        hash_object.update(this_string.encode('utf-8'))
+
+    return hash_object.hexdigest()
+
+
+def apply_cnn_cached(
+        cnn_model_object, netcdf_file_name, normalization_dict,
+        normalization_dict_targ, cache_directory_name=INFERENCE_CACHE_DIR_NAME,
+        num_examples_per_batch=None, verbose=True, targ_LATinds=None,
+        targ_LONinds=None):
+    """Applies trained CNN to one file, serving the result from disk if cached.
+    E = number of examples in file
+    T = number of target values per example
+    Results are keyed by a hash of the input-file contents, the model
+    (architecture and weights) and both normalization dictionaries (see
+    `get_inference_cache_key`), so any change to these is a cache miss and
+    stale entries are never served.
+    :param cnn_model_object: Trained instance of `keras.models.Model`.
+    :param netcdf_file_name: Path to input file.
+    :param normalization_dict: See doc for `normalize_images`.
+    :param normalization_dict_targ: See doc for `denormalize_images_targ`.
+    :param cache_directory_name: Name of cache directory.
+    :param num_examples_per_batch: See doc for `apply_cnn`.
+    :param verbose: Boolean flag.  If True, progress messages will be printed.
+    :param targ_LATinds: See doc for `read_image_file`.
+    :param targ_LONinds: Same.
+    :return: prediction_matrix: E-by-T numpy array of denormalized predictions
+        (the "CNN_rr" values).
+    """
+
+    cache_key = get_inference_cache_key(
+        cnn_model_object=cnn_model_object, netcdf_file_name=netcdf_file_name,
+        normalization_dict=normalization_dict,
+        normalization_dict_targ=normalization_dict_targ,
+        targ_LATinds=targ_LATinds, targ_LONinds=targ_LONinds)
+    cache_file_name = os.path.join(
+        cache_directory_name, cache_key + CACHE_FILE_EXTENSION)
+
+    if os.path.isfile(cache_file_name):
+        if verbose:
+            print('Reading cached predictions for "{0:s}" from "{1:s}"...'.format(
+                netcdf_file_name, cache_file_name))
+
+        with numpy.load(cache_file_name) as this_file:
+            return this_file[PREDICTION_MATRIX_KEY]
+
+    image_dict = read_image_file(netcdf_file_name, targ_LATinds, targ_LONinds)
+    predictor_matrix, _ = normalize_images(
+        predictor_matrix=image_dict[PREDICTOR_MATRIX_KEY],
+        predictor_names=image_dict[PREDICTOR_NAMES_KEY],
+        normalization_dict=normalization_dict)
+
+    prediction_matrix = apply_cnn(
+        cnn_model_object, predictor_matrix.astype('float32'), verbose=verbose,
+        num_examples_per_batch=num_examples_per_batch)
+    prediction_matrix = denormalize_images_targ(
+        prediction_matrix, image_dict[TARGET_NAME_KEY], normalization_dict_targ
+    ).astype(numpy.float32)
+
+    if verbose:
+        print('Writing predictions for "{0:s}" to cache...'.format(
+            netcdf_file_name))
+
+    # Written under a temporary name and renamed, so that an interrupted write
+    # never leaves a truncated entry behind.
+    _create_directory(directory_name=cache_directory_name)
+    temp_file_name = '{0:s}.{1:d}.tmp{2:s}'.format(
+        cache_file_name, os.getpid(), CACHE_FILE_EXTENSION)
+    numpy.savez(temp_file_name, prediction_matrix=prediction_matrix,
+                cache_key=numpy.array(cache_key))
+    os.replace(temp_file_name, cache_file_name)
+
+    return prediction_matrix
+
+
+def write_post_processed_file(
+        output_file_name, cnn_prediction_matrix, raw_prediction_matrix,
+        observation_matrix, days):
+    """Writes post-processed forecasts to NetCDF file.
+    E = number of examples (days)
+    L = number of lead times
+    S = number of stations
+    The file has the layout read by `verification.verify_files`.
+    :param output_file_name: Path to output file.
+    :param cnn_prediction_matrix: E-by-L-by-S numpy array of denormalized CNN
+        forecasts (may also be E-by-(L*S)).
+    :param raw_prediction_matrix: E-by-L-by-S numpy array of raw WRF
+        forecasts.
+    :param observation_matrix: E-by-L-by-S numpy array of observations (may
+        also be E-by-(L*S)).
+    :param days: length-E numpy array of "Days" values.
+    """
+
+    matrix_shape = raw_prediction_matrix.shape
+    _create_directory(file_name=output_file_name)
+
+    dataset_object = netCDF4.Dataset(output_file_name, 'w', format='NETCDF4')
+    dataset_object.description = 'Post-Processed Precip Forecast'
+
+    dataset_object.createDimension(NETCDF_TIME_NAME, None)
+    dataset_object.createDimension('Lead times', matrix_shape[1])
+    dataset_object.createDimension('Staz', matrix_shape[2])
+    dimension_names = (NETCDF_TIME_NAME, 'Lead times', 'Staz')
+
+    dataset_object.createVariable(
+        NETCDF_TIME_NAME, numpy.float32, (NETCDF_TIME_NAME,))[:] = days
+    dataset_object.createVariable('Lead times', numpy.float32, ('Lead times',))
+    dataset_object.createVariable('Staz', 'f4', ('Staz',))
+
+    dataset_object.createVariable(
+        'CNN_rr', numpy.float32, dimension_names
+    )[:] = numpy.reshape(cnn_prediction_matrix, matrix_shape)
+    dataset_object.createVariable(
+        NETCDF_rr_NAME, 'f8', dimension_names)[:] = raw_prediction_matrix
+    dataset_object.createVariable(
+        NETCDF_TARGET_NAME, 'f8', dimension_names
+    )[:] = numpy.reshape(observation_matrix, matrix_shape)
+
+    dataset_object.close()
+
+
+def _get_mc_dropout_model(cnn_model_object):
+    """Returns copy of model with dropout active at inference time (cached).
+    The layers (and weights) are shared with the original model.  Dropout
+    layers are called with `training=True`; all other layers, including batch
+    normalization, keep their inference behaviour.
+    :param cnn_model_object: Trained instance of `keras.models.Model`, whose
+        layers must form a simple chain (like the notebook CNN).
+    :return: mc_dropout_model_object: Instance of `keras.models.Model`.
+    """
+
+    if cnn_model_object not in _MC_DROPOUT_MODEL_CACHE:
+        input_layer_object = keras.layers.Input(
+            shape=tuple(cnn_model_object.input_shape[1:]))
+        layer_object = input_layer_object
+
+        for this_layer_object in cnn_model_object.layers:
+            if isinstance(this_layer_object, keras.layers.InputLayer):
+                continue
+
+            if isinstance(this_layer_object, keras.layers.Dropout):
+                layer_object = this_layer_object(layer_object, training=True)
+            else:
+                layer_object = this_layer_object(layer_object)
+
+        _MC_DROPOUT_MODEL_CACHE[cnn_model_object] = keras.models.Model(
+            inputs=input_layer_object, outputs=layer_object)
+
+    return _MC_DROPOUT_MODEL_CACHE[cnn_model_object]
+
+
+def apply_cnn_mc_dropout(
+        cnn_model_object, predictor_matrix,
+        num_replicates=NUM_MC_DROPOUT_REPLICATES,
+        quantile_levels=MC_DROPOUT_QUANTILE_LEVELS,
+        normalization_dict_targ=None, target_name=TARGET_NAME,
+        num_examples_per_batch=None, return_members=False, verbose=True):
+    """Applies trained CNN with Monte Carlo dropout.
+    E = number of examples
+    T = number of target values per example (lead times x stations)
+    Q = number of quantile levels
+    R = number of replicates
+    Each batch of examples is tiled into R stochastic replicas and run as one
+    large batch with dropout active (see `_get_mc_dropout_model`).  The
+    replicas are reduced to mean, standard deviation and quantiles straight
+    away, so the full E-by-R-by-T ensemble is kept only if
+    `return_members = True`.
+    :param cnn_model_object: Trained instance of `keras.models.Model`.
+    :param predictor_matrix: E-by-M-by-N-by-C numpy array of normalized
+        predictor values.
+    :param num_replicates: Number of stochastic replicates (R).
+    :param quantile_levels: 1-D list of quantile levels in [0, 1].
+    :param normalization_dict_targ: See doc for `denormalize_images_targ`.  If
+        given, members are denormalized before being reduced.  If None, results
+        are in normalized units.
+    :param target_name: Name of target variable (used only for
+        denormalization).
+    :param num_examples_per_batch: Number of forward passes (examples times
+        replicates) per call to `predict`.  If None, will use the autotuned
+        batch size (see `_get_inference_batch_size`).
+    :param return_members: Boolean flag.  If True, will also return all
+        replicates.
+    :param verbose: Boolean flag.  If True, progress messages will be printed.
+    :return: mc_dropout_dict: Dictionary with the following keys.
+    mc_dropout_dict['mean_matrix']: E-by-T numpy array of ensemble means.
+    mc_dropout_dict['stdev_matrix']: E-by-T numpy array of ensemble standard
+        deviations.
+    mc_dropout_dict['quantile_matrix']: E-by-Q-by-T numpy array of quantiles.
+    mc_dropout_dict['quantile_levels']: length-Q numpy array of quantile
+        levels.
+    mc_dropout_dict['member_matrix']: [only if `return_members = True`]
+        E-by-R-by-T numpy array of replicates.
+    """
+
+    mc_dropout_model_object = _get_mc_dropout_model(cnn_model_object)
+    num_examples = predictor_matrix.shape[0]
+    quantile_levels = numpy.array(quantile_levels, dtype=float)
+
+    num_passes_per_batch = _get_inference_batch_size(
+        cnn_model_object, num_examples_per_batch)
+    num_examples_per_batch = max([num_passes_per_batch // num_replicates, 1])
+
+    mc_dropout_dict = None
+
+    for i in range(0, num_examples, num_examples_per_batch):
+        this_last_index = min([i + num_examples_per_batch, num_examples])
+
+        if verbose:
+            print((
+                'Applying model with MC dropout to examples {0:d}-{1:d} of '
+                '{2:d}...'
+            ).format(i, this_last_index - 1, num_examples))
+
+        this_tiled_matrix = numpy.repeat(
+            predictor_matrix[i:this_last_index, ...], num_replicates, axis=0)
+        this_member_matrix = mc_dropout_model_object.predict(
+            this_tiled_matrix, batch_size=this_tiled_matrix.shape[0])
+
+        if normalization_dict_targ is not None:
+            this_member_matrix = denormalize_images_targ(
+                this_member_matrix, target_name, normalization_dict_targ)
+
+        this_member_matrix = numpy.reshape(
+            this_member_matrix,
+            (this_last_index - i, num_replicates) +
+            this_member_matrix.shape[1:]
+        )
+
+        if mc_dropout_dict is None:
+            these_dims = this_member_matrix.shape[2:]
+            mc_dropout_dict = {
+                MC_MEAN_MATRIX_KEY: numpy.empty(
+                    (num_examples,) + these_dims, dtype=numpy.float32),
+                MC_STDEV_MATRIX_KEY: numpy.empty(
+                    (num_examples,) + these_dims, dtype=numpy.float32),
+                MC_QUANTILE_MATRIX_KEY: numpy.empty(
+                    (num_examples, len(quantile_levels)) + these_dims,
+                    dtype=numpy.float32),
+                MC_QUANTILE_LEVELS_KEY: quantile_levels
+            }
+
+            if return_members:
+                mc_dropout_dict[MC_MEMBER_MATRIX_KEY] = numpy.empty(
+                    (num_examples, num_replicates) + these_dims,
+                    dtype=numpy.float32)
+
+        mc_dropout_dict[MC_MEAN_MATRIX_KEY][i:this_last_index, ...] = (
+            numpy.mean(this_member_matrix, axis=1))
+        mc_dropout_dict[MC_STDEV_MATRIX_KEY][i:this_last_index, ...] = (
+            numpy.std(this_member_matrix, axis=1, ddof=1))
+
+        if len(quantile_levels) > 0:
+            mc_dropout_dict[MC_QUANTILE_MATRIX_KEY][i:this_last_index, ...] = (
+                numpy.swapaxes(numpy.percentile(
+                    this_member_matrix, 100 * quantile_levels, axis=1
+                ), 0, 1)
             )
 
-    return output_array
+        if return_members:
+            mc_dropout_dict[MC_MEMBER_MATRIX_KEY][i:this_last_index, ...] = (
+                this_member_matrix)
+
+    return mc_dropout_dict
 
 
 def get_latlon_ind(latlonfolder):
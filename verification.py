@@ -0,0 +1,733 @@
+"""Streaming verification of post-processed rainfall forecasts.
+
+Post-processed files have dimensions Days x Lead times x Staz, with CNN
+forecasts ("CNN_rr"), raw WRF forecasts ("rr") and observations ("rr_obs").
+Scores are accumulated chunk by chunk in mergeable sums, so any number of files
+can be verified in one pass with bounded memory.
+"""
+import multiprocessing
+import netCDF4
+import numpy
+
+CNN_FORECAST_NAME = 'CNN_rr'
+RAW_FORECAST_NAME = 'rr'
+OBSERVATION_NAME = 'rr_obs'
+FORECAST_NAMES = [CNN_FORECAST_NAME, RAW_FORECAST_NAME]
+
+# Thresholds (mm) for contingency-table scores.
+RAIN_THRESHOLDS_MM = [1., 5., 10., 20., 50.]
+NUM_DAYS_PER_CHUNK = 365
+
+NUM_VALUES_KEY = 'num_values'
+ERROR_SUM_KEY = 'error_sum'
+ABSOLUTE_ERROR_SUM_KEY = 'absolute_error_sum'
+SQUARED_ERROR_SUM_KEY = 'squared_error_sum'
+FORECAST_SUM_KEY = 'forecast_sum'
+OBSERVATION_SUM_KEY = 'observation_sum'
+FORECAST_SQUARED_SUM_KEY = 'forecast_squared_sum'
+OBSERVATION_SQUARED_SUM_KEY = 'observation_squared_sum'
+PRODUCT_SUM_KEY = 'product_sum'
+NUM_HITS_KEY = 'num_hits'
+NUM_MISSES_KEY = 'num_misses'
+NUM_FALSE_ALARMS_KEY = 'num_false_alarms'
+NUM_CORRECT_NULLS_KEY = 'num_correct_nulls'
+
+CONTINUOUS_SUM_KEYS = [
+    NUM_VALUES_KEY, ERROR_SUM_KEY, ABSOLUTE_ERROR_SUM_KEY,
+    SQUARED_ERROR_SUM_KEY, FORECAST_SUM_KEY, OBSERVATION_SUM_KEY,
+    FORECAST_SQUARED_SUM_KEY, OBSERVATION_SQUARED_SUM_KEY, PRODUCT_SUM_KEY
+]
+CONTINGENCY_SUM_KEYS = [
+    NUM_HITS_KEY, NUM_MISSES_KEY, NUM_FALSE_ALARMS_KEY, NUM_CORRECT_NULLS_KEY
+]
+
+RMSE_KEY = 'rmse'
+MAE_KEY = 'mae'
+BIAS_KEY = 'bias'
+CORRELATION_KEY = 'correlation'
+POD_KEY = 'pod'
+FAR_KEY = 'far'
+ETS_KEY = 'ets'
+THRESHOLDS_KEY = 'thresholds_mm'
+
+NUM_BOOTSTRAP_REPLICATES = 1000
+BOOTSTRAP_SCORE_NAMES = [RMSE_KEY, MAE_KEY, BIAS_KEY, CORRELATION_KEY]
+IMPROVEMENT_KEY = 'improvement'
+LOWER_BOUND_KEY = 'lower_bound'
+UPPER_BOUND_KEY = 'upper_bound'
+P_VALUE_KEY = 'p_value'
+DOMAIN_IMPROVEMENT_KEY = 'domain_improvement'
+DOMAIN_LOWER_BOUND_KEY = 'domain_lower_bound'
+DOMAIN_UPPER_BOUND_KEY = 'domain_upper_bound'
+DOMAIN_P_VALUE_KEY = 'domain_p_value'
+
+
+def _safe_divide(numerator_matrix, denominator_matrix):
+    """Divides arrays, returning NaN where the denominator is zero.
+    :param numerator_matrix: numpy array.
+    :param denominator_matrix: numpy array (same shape).
+    :return: quotient_matrix: numpy array (same shape).
+    """
+
+    numerator_matrix = numpy.asarray(numerator_matrix, dtype=float)
+    denominator_matrix = numpy.asarray(denominator_matrix, dtype=float)
+    quotient_matrix = numpy.full(numerator_matrix.shape, numpy.nan)
+
+    numpy.divide(numerator_matrix, denominator_matrix, out=quotient_matrix,
+                 where=denominator_matrix != 0)
+    return quotient_matrix
+
+
+class VerificationAccumulator(object):
+    """Mergeable running sums for verifying one forecast.
+    L = number of lead times
+    S = number of stations
+    K = number of thresholds
+    Continuous sums have shape L x S; contingency-table counts have shape
+    K x L x S.  Pairs where the forecast or observation is not finite are
+    skipped.
+    """
+
+    def __init__(self, thresholds_mm=RAIN_THRESHOLDS_MM):
+        """Creates empty accumulator.
+        :param thresholds_mm: 1-D list of rain thresholds (mm).  An event is
+            rainfall >= threshold.
+        """
+
+        self.thresholds_mm = numpy.array(thresholds_mm, dtype=float)
+        self.sum_dict = None
+
+    def _initialize(self, spatial_shape):
+        """Allocates zeroed sums.
+        :param spatial_shape: Shape of one day (L x S).
+        """
+
+        self.sum_dict = {}
+
+        for this_key in CONTINUOUS_SUM_KEYS:
+            self.sum_dict[this_key] = numpy.zeros(spatial_shape)
+
+        for this_key in CONTINGENCY_SUM_KEYS:
+            self.sum_dict[this_key] = numpy.zeros(
+                (len(self.thresholds_mm),) + tuple(spatial_shape))
+
+    def update(self, forecast_matrix, observation_matrix):
+        """Adds one chunk of forecast-observation pairs.
+        D = number of days in chunk
+        :param forecast_matrix: D-by-L-by-S numpy array of forecasts (mm).
+        :param observation_matrix: D-by-L-by-S numpy array of observations
+            (mm).
+        :return: self
+        """
+
+        forecast_matrix = numpy.asarray(forecast_matrix, dtype=float)
+        observation_matrix = numpy.asarray(observation_matrix, dtype=float)
+
+        if self.sum_dict is None:
+            self._initialize(forecast_matrix.shape[1:])
+
+        is_valid_matrix = numpy.logical_and(
+            numpy.isfinite(forecast_matrix), numpy.isfinite(observation_matrix)
+        )
+        forecast_matrix = numpy.where(is_valid_matrix, forecast_matrix, 0.)
+        observation_matrix = numpy.where(
+            is_valid_matrix, observation_matrix, 0.)
+        error_matrix = forecast_matrix - observation_matrix
+
+        self.sum_dict[NUM_VALUES_KEY] += numpy.sum(is_valid_matrix, axis=0)
+        self.sum_dict[ERROR_SUM_KEY] += numpy.sum(error_matrix, axis=0)
+        self.sum_dict[ABSOLUTE_ERROR_SUM_KEY] += numpy.sum(
+            numpy.absolute(error_matrix), axis=0)
+        self.sum_dict[SQUARED_ERROR_SUM_KEY] += numpy.sum(
+            error_matrix ** 2, axis=0)
+        self.sum_dict[FORECAST_SUM_KEY] += numpy.sum(forecast_matrix, axis=0)
+        self.sum_dict[OBSERVATION_SUM_KEY] += numpy.sum(
+            observation_matrix, axis=0)
+        self.sum_dict[FORECAST_SQUARED_SUM_KEY] += numpy.sum(
+            forecast_matrix ** 2, axis=0)
+        self.sum_dict[OBSERVATION_SQUARED_SUM_KEY] += numpy.sum(
+            observation_matrix ** 2, axis=0)
+        self.sum_dict[PRODUCT_SUM_KEY] += numpy.sum(
+            forecast_matrix * observation_matrix, axis=0)
+
+        # All thresholds at once: K x D x L x S boolean arrays.
+        these_thresholds = self.thresholds_mm.reshape(
+            (-1,) + (1,) * forecast_matrix.ndim)
+        forecast_event_matrix = numpy.logical_and(
+            forecast_matrix[numpy.newaxis, ...] >= these_thresholds,
+            is_valid_matrix)
+        observed_event_matrix = numpy.logical_and(
+            observation_matrix[numpy.newaxis, ...] >= these_thresholds,
+            is_valid_matrix)
+
+        self.sum_dict[NUM_HITS_KEY] += numpy.sum(
+            numpy.logical_and(forecast_event_matrix, observed_event_matrix),
+            axis=1)
+        self.sum_dict[NUM_MISSES_KEY] += numpy.sum(
+            observed_event_matrix & ~forecast_event_matrix, axis=1)
+        self.sum_dict[NUM_FALSE_ALARMS_KEY] += numpy.sum(
+            forecast_event_matrix & ~observed_event_matrix, axis=1)
+        self.sum_dict[NUM_CORRECT_NULLS_KEY] += numpy.sum(
+            is_valid_matrix[numpy.newaxis, ...] &
+            ~forecast_event_matrix & ~observed_event_matrix,
+            axis=1)
+
+        return self
+
+    def merge(self, other_accumulator):
+        """Adds sums from another accumulator (e.g., from another process).
+        :param other_accumulator: Instance of `VerificationAccumulator` with the
+            same thresholds.
+        :return: self
+        :raises: ValueError: if thresholds differ.
+        """
+
+        if not numpy.array_equal(self.thresholds_mm,
+                                 other_accumulator.thresholds_mm):
+            raise ValueError('Cannot merge accumulators with different '
+                             'thresholds.')
+
+        if other_accumulator.sum_dict is None:
+            return self
+
+        if self.sum_dict is None:
+            self.sum_dict = dict([
+                (k, v.copy()) for k, v in other_accumulator.sum_dict.items()
+            ])
+            return self
+
+        for this_key in self.sum_dict:
+            self.sum_dict[this_key] += other_accumulator.sum_dict[this_key]
+
+        return self
+
+    def get_scores(self, aggregate_axes=None):
+        """Computes scores from the running sums.
+        :param aggregate_axes: Axes of the L x S grid to pool before computing
+            scores.  None gives scores per lead time and station; (1,) gives
+            scores per lead time; (0, 1) gives domain-wide scores.
+        :return: score_dict: Dictionary with the following keys.  Continuous
+            scores have the pooled L x S shape; contingency scores have K
+            prepended.
+        score_dict['num_values']: Number of valid pairs.
+        score_dict['rmse']: Root mean squared error.
+        score_dict['mae']: Mean absolute error.
+        score_dict['bias']: Mean error (forecast minus observation).
+        score_dict['correlation']: Pearson correlation.
+        score_dict['pod']: Probability of detection.
+        score_dict['far']: False-alarm ratio.
+        score_dict['ets']: Equitable threat score.
+        score_dict['thresholds_mm']: length-K numpy array of thresholds.
+        """
+
+        sum_dict = {}
+        for this_key in CONTINUOUS_SUM_KEYS:
+            sum_dict[this_key] = self.sum_dict[this_key]
+            if aggregate_axes is not None:
+                sum_dict[this_key] = numpy.sum(
+                    sum_dict[this_key], axis=tuple(aggregate_axes))
+
+        for this_key in CONTINGENCY_SUM_KEYS:
+            sum_dict[this_key] = self.sum_dict[this_key]
+            if aggregate_axes is not None:
+                sum_dict[this_key] = numpy.sum(
+                    sum_dict[this_key],
+                    axis=tuple([a + 1 for a in aggregate_axes]))
+
+        num_values = sum_dict[NUM_VALUES_KEY]
+        forecast_mean = _safe_divide(sum_dict[FORECAST_SUM_KEY], num_values)
+        observation_mean = _safe_divide(
+            sum_dict[OBSERVATION_SUM_KEY], num_values)
+        covariance = (
+            _safe_divide(sum_dict[PRODUCT_SUM_KEY], num_values) -
+            forecast_mean * observation_mean
+        )
+        forecast_variance = (
+            _safe_divide(sum_dict[FORECAST_SQUARED_SUM_KEY], num_values) -
+            forecast_mean ** 2
+        )
+        observation_variance = (
+            _safe_divide(sum_dict[OBSERVATION_SQUARED_SUM_KEY], num_values) -
+            observation_mean ** 2
+        )
+
+        num_hits = sum_dict[NUM_HITS_KEY]
+        num_misses = sum_dict[NUM_MISSES_KEY]
+        num_false_alarms = sum_dict[NUM_FALSE_ALARMS_KEY]
+        num_total = num_hits + num_misses + num_false_alarms + sum_dict[
+            NUM_CORRECT_NULLS_KEY]
+        num_random_hits = _safe_divide(
+            (num_hits + num_misses) * (num_hits + num_false_alarms), num_total)
+
+        return {
+            NUM_VALUES_KEY: num_values,
+            RMSE_KEY: numpy.sqrt(_safe_divide(
+                sum_dict[SQUARED_ERROR_SUM_KEY], num_values)),
+            MAE_KEY: _safe_divide(
+                sum_dict[ABSOLUTE_ERROR_SUM_KEY], num_values),
+            BIAS_KEY: _safe_divide(sum_dict[ERROR_SUM_KEY], num_values),
+            CORRELATION_KEY: _safe_divide(
+                covariance,
+                numpy.sqrt(numpy.maximum(
+                    forecast_variance * observation_variance, 0.))
+            ),
+            POD_KEY: _safe_divide(num_hits, num_hits + num_misses),
+            FAR_KEY: _safe_divide(num_false_alarms, num_hits + num_false_alarms),
+            ETS_KEY: _safe_divide(
+                num_hits - num_random_hits,
+                num_hits + num_misses + num_false_alarms - num_random_hits),
+            THRESHOLDS_KEY: self.thresholds_mm
+        }
+
+
+def _read_variable_chunk(dataset_object, variable_name, first_day, last_day):
+    """Reads one chunk of days for one variable, with NaN for missing values.
+    :param dataset_object: Instance of `netCDF4.Dataset`.
+    :param variable_name: Name of variable.
+    :param first_day: First day index (inclusive).
+    :param last_day: Last day index (exclusive).
+    :return: data_matrix: D-by-L-by-S numpy array.
+    """
+
+    return numpy.ma.filled(
+        dataset_object.variables[variable_name][first_day:last_day, ...]
+        .astype(float), numpy.nan)
+
+
+def _verify_one_file(argument_tuple):
+    """Verifies one post-processed file, chunk by chunk.
+    All forecasts are scored on the same points: those where the observation
+    and every forecast are finite.
+    :param argument_tuple: Tuple (file_name, forecast_names,
+        observation_name, thresholds_mm, num_days_per_chunk).
+    :return: accumulator_dict: Dictionary with one `VerificationAccumulator`
+        per forecast name.
+    """
+
+    (post_processed_file_name, forecast_names, observation_name,
+     thresholds_mm, num_days_per_chunk) = argument_tuple
+
+    accumulator_dict = dict([
+        (n, VerificationAccumulator(thresholds_mm)) for n in forecast_names
+    ])
+    dataset_object = netCDF4.Dataset(post_processed_file_name)
+    num_days = dataset_object.variables[observation_name].shape[0]
+
+    for this_first_day in range(0, num_days, num_days_per_chunk):
+        this_last_day = min([this_first_day + num_days_per_chunk, num_days])
+        this_observation_matrix = _read_variable_chunk(
+            dataset_object, observation_name, this_first_day, this_last_day)
+        these_forecast_matrices = [
+            _read_variable_chunk(
+                dataset_object, n, this_first_day, this_last_day)
+            for n in forecast_names
+        ]
+
+        # Observations are masked wherever any forecast is missing, so each
+        # accumulator skips the same pairs.
+        for this_forecast_matrix in these_forecast_matrices:
+            this_observation_matrix[
+                numpy.invert(numpy.isfinite(this_forecast_matrix))
+            ] = numpy.nan
+
+        for this_forecast_name, this_forecast_matrix in zip(
+                forecast_names, these_forecast_matrices):
+            accumulator_dict[this_forecast_name].update(
+                this_forecast_matrix, this_observation_matrix)
+
+    dataset_object.close()
+    return accumulator_dict
+
+
+def verify_files(post_processed_file_names, forecast_names=FORECAST_NAMES,
+                 observation_name=OBSERVATION_NAME,
+                 thresholds_mm=RAIN_THRESHOLDS_MM,
+                 num_days_per_chunk=NUM_DAYS_PER_CHUNK, num_workers=1,
+                 verbose=True):
+    """Verifies forecasts in one or many post-processed NetCDF files.
+    Forecasts are compared on a joint sample (see `_verify_one_file`).
+    :param post_processed_file_names: 1-D list of paths to input files.
+    :param forecast_names: 1-D list of forecast variables to verify.
+    :param observation_name: Name of observation variable.
+    :param thresholds_mm: See doc for `VerificationAccumulator`.
+    :param num_days_per_chunk: Number of days read at once.
+    :param num_workers: Number of worker processes (files are spread over
+        workers and their accumulators merged).
+    :param verbose: Boolean flag.  If True, domain-wide scores will be printed.
+    :return: accumulator_dict: Dictionary with one `VerificationAccumulator`
+        per forecast name.  Call `get_scores` on each to get scores.
+    """
+
+    argument_tuples = [
+        (f, forecast_names, observation_name, thresholds_mm, num_days_per_chunk)
+        for f in post_processed_file_names
+    ]
+
+    accumulator_dict = dict([
+        (n, VerificationAccumulator(thresholds_mm)) for n in forecast_names
+    ])
+
+    if num_workers == 1:
+        these_results = map(_verify_one_file, argument_tuples)
+    else:
+        this_pool = multiprocessing.Pool(processes=num_workers)
+        these_results = this_pool.imap_unordered(
+            _verify_one_file, argument_tuples)
+
+    for this_accumulator_dict in these_results:
+        for this_forecast_name in forecast_names:
+            accumulator_dict[this_forecast_name].merge(
+                this_accumulator_dict[this_forecast_name])
+
+    if num_workers != 1:
+        this_pool.close()
+        this_pool.join()
+
+    if verbose:
+        for this_forecast_name in forecast_names:
+            this_score_dict = accumulator_dict[this_forecast_name].get_scores(
+                aggregate_axes=(0, 1))
+
+            print((
+                '"{0:s}": RMSE = {1:.3f} mm ... MAE = {2:.3f} mm ... bias = '
+                '{3:.3f} mm ... correlation = {4:.3f}'
+            ).format(
+                this_forecast_name, this_score_dict[RMSE_KEY],
+                this_score_dict[MAE_KEY], this_score_dict[BIAS_KEY],
+                this_score_dict[CORRELATION_KEY]
+            ))
+
+            for k in range(len(thresholds_mm)):
+                print((
+                    '    >= {0:.0f} mm: POD = {1:.3f} ... FAR = {2:.3f} ... '
+                    'ETS = {3:.3f}'
+                ).format(
+                    thresholds_mm[k], this_score_dict[POD_KEY][k],
+                    this_score_dict[FAR_KEY][k], this_score_dict[ETS_KEY][k]
+                ))
+
+    return accumulator_dict
+
+
+def _get_daily_sums(forecast_matrix, observation_matrix):
+    """Computes per-day sums used by the bootstrap.
+    D = number of days
+    P = number of points (lead times x stations)
+    :param forecast_matrix: D-by-L-by-S numpy array of forecasts.
+    :param observation_matrix: D-by-L-by-S numpy array of observations.
+    :return: daily_sum_matrix: Q-by-D-by-P numpy array, where Q is the length
+        of `CONTINUOUS_SUM_KEYS` (in that order).
+    """
+
+    num_days = forecast_matrix.shape[0]
+    forecast_matrix = numpy.reshape(
+        numpy.asarray(forecast_matrix, dtype=float), (num_days, -1))
+    observation_matrix = numpy.reshape(
+        numpy.asarray(observation_matrix, dtype=float), (num_days, -1))
+
+    is_valid_matrix = numpy.logical_and(
+        numpy.isfinite(forecast_matrix), numpy.isfinite(observation_matrix))
+    forecast_matrix = numpy.where(is_valid_matrix, forecast_matrix, 0.)
+    observation_matrix = numpy.where(is_valid_matrix, observation_matrix, 0.)
+    error_matrix = forecast_matrix - observation_matrix
+
+    return numpy.stack([
+        is_valid_matrix.astype(float), error_matrix,
+        numpy.absolute(error_matrix), error_matrix ** 2, forecast_matrix,
+        observation_matrix, forecast_matrix ** 2, observation_matrix ** 2,
+        forecast_matrix * observation_matrix
+    ], axis=0)
+
+
+def _get_scores_from_sums(sum_matrix, score_names):
+    """Computes continuous scores from stacked sums.
+    :param sum_matrix: numpy array whose first axis follows
+        `CONTINUOUS_SUM_KEYS`.
+    :param score_names: 1-D list of scores (from "rmse", "mae", "bias",
+        "correlation").
+    :return: score_dict: Dictionary with one array per score, each with the
+        shape of `sum_matrix[0, ...]`.
+    """
+
+    these_sums = dict(zip(CONTINUOUS_SUM_KEYS, sum_matrix))
+    num_values = these_sums[NUM_VALUES_KEY]
+    score_dict = {}
+
+    if RMSE_KEY in score_names:
+        score_dict[RMSE_KEY] = numpy.sqrt(_safe_divide(
+            these_sums[SQUARED_ERROR_SUM_KEY], num_values))
+    if MAE_KEY in score_names:
+        score_dict[MAE_KEY] = _safe_divide(
+            these_sums[ABSOLUTE_ERROR_SUM_KEY], num_values)
+    if BIAS_KEY in score_names:
+        score_dict[BIAS_KEY] = _safe_divide(
+            these_sums[ERROR_SUM_KEY], num_values)
+
+    if CORRELATION_KEY in score_names:
+        forecast_mean = _safe_divide(these_sums[FORECAST_SUM_KEY], num_values)
+        observation_mean = _safe_divide(
+            these_sums[OBSERVATION_SUM_KEY], num_values)
+        covariance = (
+            _safe_divide(these_sums[PRODUCT_SUM_KEY], num_values) -
+            forecast_mean * observation_mean
+        )
+        variance_product = (
+            (_safe_divide(these_sums[FORECAST_SQUARED_SUM_KEY], num_values) -
+             forecast_mean ** 2) *
+            (_safe_divide(these_sums[OBSERVATION_SQUARED_SUM_KEY], num_values) -
+             observation_mean ** 2)
+        )
+        score_dict[CORRELATION_KEY] = _safe_divide(
+            covariance, numpy.sqrt(numpy.maximum(variance_product, 0.)))
+
+    return score_dict
+
+
+def _get_score_improvements(cnn_sum_matrix, raw_sum_matrix, score_names):
+    """Computes improvement of CNN over raw forecast for each score.
+    Improvement is positive when the CNN is better: raw minus CNN for RMSE and
+    MAE, |raw bias| minus |CNN bias| for bias, and CNN minus raw for
+    correlation.
+    :param cnn_sum_matrix: Stacked sums for CNN (see `_get_scores_from_sums`).
+    :param raw_sum_matrix: Same but for raw forecast.
+    :param score_names: See doc for `_get_scores_from_sums`.
+    :return: improvement_dict: Dictionary with one array per score.
+    """
+
+    cnn_score_dict = _get_scores_from_sums(cnn_sum_matrix, score_names)
+    raw_score_dict = _get_scores_from_sums(raw_sum_matrix, score_names)
+    improvement_dict = {}
+
+    for this_score_name in score_names:
+        if this_score_name == CORRELATION_KEY:
+            improvement_dict[this_score_name] = (
+                cnn_score_dict[this_score_name] -
+                raw_score_dict[this_score_name]
+            )
+        else:
+            improvement_dict[this_score_name] = (
+                numpy.absolute(raw_score_dict[this_score_name]) -
+                numpy.absolute(cnn_score_dict[this_score_name])
+            )
+
+    return improvement_dict
+
+
+_BOOTSTRAP_DAILY_SUMS = None
+
+
+def _set_bootstrap_daily_sums(daily_sum_matrix):
+    """Stores daily sums in a worker process (pool initializer).
+    :param daily_sum_matrix: See doc for `_run_bootstrap_batch`.
+    """
+
+    global _BOOTSTRAP_DAILY_SUMS
+    _BOOTSTRAP_DAILY_SUMS = daily_sum_matrix
+
+
+def _run_bootstrap_batch(argument_tuple):
+    """Runs one batch of bootstrap replicates.
+    B = number of replicates in batch
+    P = number of points
+    :param argument_tuple: Tuple (random_seed, num_replicates, score_names,
+        daily_sum_matrix).  `daily_sum_matrix` is a 2Q-by-D-by-P array (CNN
+        sums stacked on raw sums); if None, the array set by
+        `_set_bootstrap_daily_sums` is used.
+    :return: improvement_dict: Dictionary with one B-by-P array per score.
+    :return: domain_improvement_dict: Dictionary with one length-B array per
+        score (points pooled).
+    """
+
+    random_seed, num_replicates, score_names, daily_sum_matrix = argument_tuple
+    if daily_sum_matrix is None:
+        daily_sum_matrix = _BOOTSTRAP_DAILY_SUMS
+
+    num_sums = daily_sum_matrix.shape[0] // 2
+    num_days = daily_sum_matrix.shape[1]
+
+    # Resampling days with replacement is the same as drawing how many times
+    # each day is picked, so all replicates are one matrix product.
+    count_matrix = numpy.random.RandomState(random_seed).multinomial(
+        num_days, numpy.full(num_days, 1. / num_days), size=num_replicates
+    ).astype(float)
+
+    replicate_sum_matrix = numpy.einsum(
+        'bd,qdp->qbp', count_matrix, daily_sum_matrix)
+    improvement_dict = _get_score_improvements(
+        replicate_sum_matrix[:num_sums, ...],
+        replicate_sum_matrix[num_sums:, ...], score_names)
+
+    domain_sum_matrix = numpy.sum(replicate_sum_matrix, axis=-1)
+    domain_improvement_dict = _get_score_improvements(
+        domain_sum_matrix[:num_sums, ...], domain_sum_matrix[num_sums:, ...],
+        score_names)
+
+    return improvement_dict, domain_improvement_dict
+
+
+def bootstrap_improvement(
+        cnn_forecast_matrix, raw_forecast_matrix, observation_matrix,
+        num_replicates=NUM_BOOTSTRAP_REPLICATES,
+        confidence_level=0.95, score_names=BOOTSTRAP_SCORE_NAMES,
+        num_replicates_per_batch=500, num_workers=1, random_seed=None):
+    """Bootstraps improvement of CNN over raw WRF forecasts.
+    D = number of days
+    L = number of lead times
+    S = number of stations
+    Days are resampled with replacement (whole days, so spatial correlation is
+    kept).  Each batch of replicates is drawn at once as a matrix of day
+    counts and scored with one matrix product over per-day sums, optionally
+    spread over a process pool.
+    :param cnn_forecast_matrix: D-by-L-by-S numpy array of CNN forecasts.
+    :param raw_forecast_matrix: D-by-L-by-S numpy array of raw forecasts.
+    :param observation_matrix: D-by-L-by-S numpy array of observations.
+    :param num_replicates: Number of bootstrap replicates.
+    :param confidence_level: Confidence level for intervals.
+    :param score_names: 1-D list of scores (from "rmse", "mae", "bias",
+        "correlation").
+    :param num_replicates_per_batch: Number of replicates drawn at once.
+    :param num_workers: Number of worker processes.
+    :param random_seed: Seed for reproducible resampling.
+    :return: bootstrap_dict: Dictionary with one entry per score.  Each value is
+        a dictionary with the following keys.
+    bootstrap_dict[score]['improvement']: L-by-S numpy array with improvement
+        on the full sample (positive = CNN better; see
+        `_get_score_improvements`).
+    bootstrap_dict[score]['lower_bound']: L-by-S array with lower end of the
+        confidence interval.
+    bootstrap_dict[score]['upper_bound']: Same but upper end.
+    bootstrap_dict[score]['p_value']: L-by-S array with fraction of replicates
+        where the CNN is not better.
+    bootstrap_dict[score]['domain_improvement']: Improvement with all stations
+        and lead times pooled (scalar).
+    bootstrap_dict[score]['domain_lower_bound']: Same but lower end.
+    bootstrap_dict[score]['domain_upper_bound']: Same but upper end.
+    bootstrap_dict[score]['domain_p_value']: Same but p-value.
+    """
+
+    cnn_forecast_matrix = numpy.asarray(cnn_forecast_matrix, dtype=float)
+    raw_forecast_matrix = numpy.asarray(raw_forecast_matrix, dtype=float)
+    observation_matrix = numpy.asarray(observation_matrix, dtype=float)
+
+    # Both systems are scored on the same points, so that each resampled day
+    # gives a paired comparison.
+    is_valid_matrix = numpy.logical_and(
+        numpy.isfinite(cnn_forecast_matrix),
+        numpy.isfinite(raw_forecast_matrix))
+    is_valid_matrix = numpy.logical_and(
+        is_valid_matrix, numpy.isfinite(observation_matrix))
+    observation_matrix = numpy.where(
+        is_valid_matrix, observation_matrix, numpy.nan)
+
+    spatial_shape = observation_matrix.shape[1:]
+    daily_sum_matrix = numpy.concatenate((
+        _get_daily_sums(cnn_forecast_matrix, observation_matrix),
+        _get_daily_sums(raw_forecast_matrix, observation_matrix)
+    ), axis=0)
+    num_sums = daily_sum_matrix.shape[0] // 2
+
+    full_sum_matrix = numpy.sum(daily_sum_matrix, axis=1)
+    full_improvement_dict = _get_score_improvements(
+        full_sum_matrix[:num_sums, ...], full_sum_matrix[num_sums:, ...],
+        score_names)
+    full_domain_sum_matrix = numpy.sum(full_sum_matrix, axis=-1)
+    full_domain_improvement_dict = _get_score_improvements(
+        full_domain_sum_matrix[:num_sums], full_domain_sum_matrix[num_sums:],
+        score_names)
+
+    seed_generator = numpy.random.RandomState(random_seed)
+    batch_sizes = [
+        min([num_replicates_per_batch, num_replicates - i])
+        for i in range(0, num_replicates, num_replicates_per_batch)
+    ]
+    batch_seeds = seed_generator.randint(0, 2 ** 31 - 1, size=len(batch_sizes))
+
+    if num_workers == 1:
+        batch_results = [
+            _run_bootstrap_batch((s, n, score_names, daily_sum_matrix))
+            for s, n in zip(batch_seeds, batch_sizes)
+        ]
+    else:
+        this_pool = multiprocessing.Pool(
+            processes=num_workers, initializer=_set_bootstrap_daily_sums,
+            initargs=(daily_sum_matrix,))
+        batch_results = this_pool.map(
+            _run_bootstrap_batch,
+            [(s, n, score_names, None) for s, n in zip(batch_seeds, batch_sizes)]
+        )
+        this_pool.close()
+        this_pool.join()
+
+    lower_percentile = 50. * (1 - confidence_level)
+    upper_percentile = 100. - lower_percentile
+    bootstrap_dict = {}
+
+    for this_score_name in score_names:
+        this_replicate_matrix = numpy.concatenate(
+            [r[0][this_score_name] for r in batch_results], axis=0)
+        this_domain_vector = numpy.concatenate(
+            [r[1][this_score_name] for r in batch_results], axis=0)
+
+        bootstrap_dict[this_score_name] = {
+            IMPROVEMENT_KEY: numpy.reshape(
+                full_improvement_dict[this_score_name], spatial_shape),
+            LOWER_BOUND_KEY: numpy.reshape(numpy.nanpercentile(
+                this_replicate_matrix, lower_percentile, axis=0
+            ), spatial_shape),
+            UPPER_BOUND_KEY: numpy.reshape(numpy.nanpercentile(
+                this_replicate_matrix, upper_percentile, axis=0
+            ), spatial_shape),
+            P_VALUE_KEY: numpy.reshape(
+                numpy.mean(this_replicate_matrix <= 0, axis=0), spatial_shape),
+            DOMAIN_IMPROVEMENT_KEY:
+                full_domain_improvement_dict[this_score_name],
+            DOMAIN_LOWER_BOUND_KEY: numpy.nanpercentile(
+                this_domain_vector, lower_percentile),
+            DOMAIN_UPPER_BOUND_KEY: numpy.nanpercentile(
+                this_domain_vector, upper_percentile),
+            DOMAIN_P_VALUE_KEY: numpy.mean(this_domain_vector <= 0)
+        }
+
+        print((
+            'Improvement in {0:s} (CNN vs. raw) = {1:.4f}, {2:.0f}% interval '
+            '= [{3:.4f}, {4:.4f}], p = {5:.4f}'
+        ).format(
+            this_score_name,
+            bootstrap_dict[this_score_name][DOMAIN_IMPROVEMENT_KEY],
+            100 * confidence_level,
+            bootstrap_dict[this_score_name][DOMAIN_LOWER_BOUND_KEY],
+            bootstrap_dict[this_score_name][DOMAIN_UPPER_BOUND_KEY],
+            bootstrap_dict[this_score_name][DOMAIN_P_VALUE_KEY]
+        ))
+
+    return bootstrap_dict
+
+
+def bootstrap_files(post_processed_file_names, **kwargs):
+    """Bootstraps improvement of CNN over raw forecasts in post-processed files.
+    :param post_processed_file_names: 1-D list of paths to input files.
+    :param kwargs: Keyword arguments for `bootstrap_improvement`.
+    :return: bootstrap_dict: See doc for `bootstrap_improvement`.
+    """
+
+    matrix_lists = dict([
+        (n, []) for n in [CNN_FORECAST_NAME, RAW_FORECAST_NAME,
+                          OBSERVATION_NAME]
+    ])
+
+    for this_file_name in post_processed_file_names:
+        dataset_object = netCDF4.Dataset(this_file_name)
+
+        for this_variable_name in matrix_lists:
+            matrix_lists[this_variable_name].append(_read_variable_chunk(
+                dataset_object, this_variable_name, 0,
+                dataset_object.variables[this_variable_name].shape[0]
+            ))
+
+        dataset_object.close()
+
+    return bootstrap_improvement(
+        numpy.concatenate(matrix_lists[CNN_FORECAST_NAME], axis=0),
+        numpy.concatenate(matrix_lists[RAW_FORECAST_NAME], axis=0),
+        numpy.concatenate(matrix_lists[OBSERVATION_NAME], axis=0),
+        **kwargs)